@@ -1,38 +1,55 @@
-import json
-from pathlib import Path
+import multiprocessing
+import os
+from contextlib import nullcontext
 
-import pydicom
+from PyQt6.QtCore import QThread
 from PyQt6.QtGui import QIcon, QAction
 from PyQt6.QtWidgets import (
     QApplication,
     QMainWindow,
     QFileDialog,
-    QTableWidget,
+    QTableView,
     QPushButton,
     QVBoxLayout,
     QWidget,
-    QRadioButton,
     QLabel,
-    QButtonGroup,
     QMenuBar,
     QMenu,
-    QTableWidgetItem,
     QHeaderView,
     QHBoxLayout,
     QLineEdit,
     QProgressBar,
     QMessageBox,
     QInputDialog,
+    QSpinBox,
+    QCheckBox,
 )
 
+# Only modules needed to show the window are imported here. Modules which
+# import pydicom, numpy or cryptography are imported by the actions using them,
+# so the window appears before they are loaded.
+from utilities.actions import ACTION_COLUMNS, Action
 from utilities.config_manager import load_config, save_config, auto_select
-from utilities.encryption_manager import encrypt, decrypt, detect_if_encrypted
-from utilities.helper_function import load_dcm_files, get_tags
-from utilities.json_wrapper import try_serialize
+from utilities.processing_worker import ProcessingWorker
+from utilities.quarantine import Quarantine, quarantine_path_for
+from utilities.run_metrics import NO_METRICS, RunMetrics, report_path_for
+from utilities.tag_table_model import (
+    ActionDelegate,
+    TagFilterProxyModel,
+    TagTableModel,
+)
+
+# Files per series whose values are read for the tag table statistics
+TAG_SAMPLES_PER_SERIES = 10
+
 
 class DICOMAnonymizer(QMainWindow):
     def __init__(self):
         super().__init__()
+        self.worker = None
+        self.worker_thread = None
+        self.run_metrics = None
+        self.run_quarantine = None
         self.init_ui()
 
     def init_ui(self):
@@ -59,10 +76,15 @@ class DICOMAnonymizer(QMainWindow):
         """Setup the main layout and add widgets."""
         main_layout = QVBoxLayout()
 
-        # Folder Selector
+        # Folder and Archive Selector
+        select_layout = QHBoxLayout()
         self.folderBtn = QPushButton("Select Folder", self)
         self.folderBtn.clicked.connect(self.select_folder)
-        main_layout.addWidget(self.folderBtn)
+        select_layout.addWidget(self.folderBtn)
+        self.archiveBtn = QPushButton("Select Archive", self)
+        self.archiveBtn.clicked.connect(self.select_archive)
+        select_layout.addWidget(self.archiveBtn)
+        main_layout.addLayout(select_layout)
 
         # Search Fields
         self.setup_search_fields(main_layout)
@@ -82,29 +104,50 @@ class DICOMAnonymizer(QMainWindow):
         self.processBtn.clicked.connect(self.process_files)
         main_layout.addWidget(self.processBtn)
 
-        # Progress bar
+        # Progress bar, throughput and cancel button
+        progress_layout = QHBoxLayout()
         self.progressBar = QProgressBar(self)
-        main_layout.addWidget(self.progressBar)
+        progress_layout.addWidget(self.progressBar)
         self.progressBar.setValue(0)
         self.progressBar.hide()
 
+        self.statusLabel = QLabel("", self)
+        progress_layout.addWidget(self.statusLabel)
+
+        self.cancelBtn = QPushButton("Cancel", self)
+        self.cancelBtn.clicked.connect(self.cancel_processing)
+        self.cancelBtn.hide()
+        progress_layout.addWidget(self.cancelBtn)
+        main_layout.addLayout(progress_layout)
+
+        # Stage breakdown of the last run with a stage report
+        self.metricsLabel = QLabel("", self)
+        self.metricsLabel.hide()
+        main_layout.addWidget(self.metricsLabel)
+
         centralWidget = QWidget(self)
         centralWidget.setLayout(main_layout)
         self.setCentralWidget(centralWidget)
 
     def setup_table(self, main_layout):
-        self.tagsTable = QTableWidget(0, 8)
-        self.tagsTable.setHorizontalHeaderLabels(
-            [
-                "Tag (Flag)",
-                "Tag Name",
-                "value",
-                "Unchanged",
-                "Change",
-                "Dummy value",
-                "Delete",
-                "Encrypt",
-            ]
+        self.tagsModel = TagTableModel(self)
+        self.tagsProxy = TagFilterProxyModel(self)
+        self.tagsProxy.setSourceModel(self.tagsModel)
+
+        self.tagsTable = QTableView(self)
+        self.tagsTable.setModel(self.tagsProxy)
+        self.actionDelegate = ActionDelegate(self.tagsTable)
+        for column in ACTION_COLUMNS:
+            self.tagsTable.setItemDelegateForColumn(column, self.actionDelegate)
+        self.tagsTable.setEditTriggers(
+            QTableView.EditTrigger.DoubleClicked
+            | QTableView.EditTrigger.SelectedClicked
+            | QTableView.EditTrigger.AnyKeyPressed
+        )
+        # Single line rows of a fixed height, so the view never measures its rows
+        self.tagsTable.setWordWrap(False)
+        self.tagsTable.verticalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.Fixed
         )
         self.tagsTable.horizontalHeader().setSectionResizeMode(
             1, QHeaderView.ResizeMode.Stretch
@@ -136,26 +179,9 @@ class DICOMAnonymizer(QMainWindow):
 
     def filter_table(self):
         """Filter table rows based on search criteria."""
-        # Get search criteria
-        search_tag = self.searchTag.text().lower()
-        search_tag_name = self.searchTagName.text().lower()
-        search_value = self.searchValue.text().lower()
-
-        for row in range(self.tagsTable.rowCount()):
-            tag_flag = self.tagsTable.item(row, 0).text().lower()
-            tag_name = self.tagsTable.item(row, 1).text().lower()
-            value = self.tagsTable.cellWidget(row, 2).text().lower()
-
-            # Show or hide the row based on search criteria
-            match = True
-            if search_tag and search_tag not in tag_flag:
-                match = False
-            if search_tag_name and search_tag_name not in tag_name:
-                match = False
-            if search_value and search_value not in value:
-                match = False
-
-            self.tagsTable.setRowHidden(row, not match)
+        self.tagsProxy.set_filters(
+            self.searchTag.text(), self.searchTagName.text(), self.searchValue.text()
+        )
 
     def setup_radio_buttons(self, main_layout):
         radio_layout = QHBoxLayout()
@@ -166,18 +192,59 @@ class DICOMAnonymizer(QMainWindow):
         radio_layout.addWidget(self.passwordLabel)
         radio_layout.addWidget(self.passwordInput)
 
+        self.workersLabel = QLabel("Workers:")
+        self.workersInput = QSpinBox(self)
+        self.workersInput.setRange(1, os.cpu_count() or 1)
+        self.workersInput.setValue(1)
+        radio_layout.addWidget(self.workersLabel)
+        radio_layout.addWidget(self.workersInput)
+
+        self.skipUnchangedCheckbox = QCheckBox("Skip unchanged files", self)
+        self.skipUnchangedCheckbox.setChecked(True)
+        radio_layout.addWidget(self.skipUnchangedCheckbox)
+
+        self.remapUidsCheckbox = QCheckBox("Remap UIDs", self)
+        radio_layout.addWidget(self.remapUidsCheckbox)
+
+        self.stageReportCheckbox = QCheckBox("Stage report", self)
+        radio_layout.addWidget(self.stageReportCheckbox)
+
         main_layout.addLayout(radio_layout)
 
     def select_folder(self):
+        from utilities.scan_manifest import ScanManifest
+
         folder = QFileDialog.getExistingDirectory(self, "Select Folder")
         if folder:
             self.folder = folder
+            self.manifest = ScanManifest.build(folder, TAG_SAMPLES_PER_SERIES)
+            self.get_dicom_tags()
+
+    def select_archive(self):
+        from utilities.archive_io import ARCHIVE_FORMATS
+        from utilities.scan_manifest import ScanManifest
+
+        suffixes = " ".join(f"*{suffix}" for suffix in ARCHIVE_FORMATS)
+        archive, _ = QFileDialog.getOpenFileName(
+            self, "Select Archive", filter=f"Archives ({suffixes})"
+        )
+        if archive:
+            self.folder = archive
+            self.manifest = ScanManifest.build_archive(archive, TAG_SAMPLES_PER_SERIES)
             self.get_dicom_tags()
+            if self.manifest.not_dicom:
+                self.statusLabel.setText(
+                    f"{len(self.manifest.not_dicom)} members are not DICOM files "
+                    "and will be left out of the output archive"
+                )
 
     def get_dicom_tags(self):
-        self.tagsTable.setRowCount(0)
+        from utilities.dataset_walker import tag_for_keyword
+        from utilities.helper_function import get_tags
+
+        self.tagsModel.set_tags([])
         try:
-            tags_set = get_tags(self.folder)
+            tags_set = get_tags(self.folder, self.manifest)
         except ValueError:
             # Show a dialog to input password for decryption
             password, ok = QInputDialog.getText(
@@ -186,145 +253,279 @@ class DICOMAnonymizer(QMainWindow):
             if ok:
                 self.decrypt_files(password)
             return
-        for tag_flag, tag_name, value in sorted(tags_set, key=lambda x: x[1]):
-            row_position = self.tagsTable.rowCount()
-            self.tagsTable.insertRow(row_position)
-            self.tagsTable.setItem(row_position, 0, QTableWidgetItem(tag_flag))
-            self.tagsTable.setItem(row_position, 1, QTableWidgetItem(tag_name))
-
-            value_input = QLineEdit(value)
-            self.tagsTable.setCellWidget(row_position, 2, value_input)
-
-            self.add_actions_to_row(row_position)
-
-    def add_actions_to_row(self, row):
-        radio_group = QButtonGroup(self)
-        unchanged_radio = QRadioButton("")
-        change_dummy_radio = QRadioButton("")
-        change_value_radio = QRadioButton("")
-        delete_radio = QRadioButton("")
-        encryptRadio = QRadioButton("")
-
-        radio_group.addButton(unchanged_radio)
-        radio_group.addButton(change_dummy_radio)
-        radio_group.addButton(change_value_radio)
-        radio_group.addButton(delete_radio)
-        radio_group.addButton(encryptRadio)
-
-        self.tagsTable.setCellWidget(row, 3, unchanged_radio)
-        self.tagsTable.setCellWidget(row, 4, change_dummy_radio)
-        self.tagsTable.setCellWidget(row, 5, change_value_radio)
-        self.tagsTable.setCellWidget(row, 6, delete_radio)
-        self.tagsTable.setCellWidget(row, 7, encryptRadio)
-        unchanged_radio.setChecked(True)
+        inventory = self.manifest.inventory
+
+        def tooltip(tag_name):
+            stats = inventory.stats.get(tag_for_keyword(tag_name))
+            return stats.describe(inventory.total_files) if stats else None
+
+        self.tagsModel.set_tags(sorted(tags_set, key=lambda x: x[1]), tooltip)
+        self.filter_table()
 
     def save_config(self):
-        save_config(self.tagsTable, "config.ini")
+        save_config(self.tagsModel, "config.ini")
 
     def load_config(self):
-        load_config(self.tagsTable, "config.ini")
+        load_config(self.tagsModel, "config.ini")
 
     def auto_select(self):
-        auto_select(self.tagsTable)
+        auto_select(self.tagsModel)
 
     def process_files(self):
+        from utilities.archive_io import (
+            anonymize_archive,
+            archive_output_path,
+            archive_stem,
+            is_archive,
+        )
+        from utilities.encryption_manager import EncryptionKey
+        from utilities.parallel_engine import anonymize_files
+        from utilities.pseudonymizer import Pseudonymizer, mapping_path_for
+        from utilities.run_index import RunIndex, record_processed, split_pending
+
         if self.is_encrypt_selected() and not self.passwordInput.text():
             QMessageBox.critical(
                 self, "Error", "Please provide an encryption password!"
             )
             return
+        remap_uids = self.remapUidsCheckbox.isChecked()
+        pseudonymize = self.is_pseudonymize_selected() or remap_uids
+        if pseudonymize and not self.passwordInput.text():
+            QMessageBox.critical(
+                self, "Error", "Please provide a password for the pseudonyms!"
+            )
+            return
 
-        dummy_ds = pydicom.dcmread(pydicom.data.get_testdata_file("CT_small.dcm"))
-        total_files = len(list(load_dcm_files(self.folder)))
-        self.progressBar.setMaximum(total_files)
-        self.progressBar.show()
-
-        for idx, dcm_file in enumerate(load_dcm_files(self.folder)):
-            self.process_single_file(dcm_file, dummy_ds)
-            self.progressBar.setValue(idx + 1)
-
-    def process_single_file(self, dcm_file, dummy_ds):
-        output_filepath = dcm_file.replace(self.folder, self.folder + "_anonymized")
-        ds = pydicom.dcmread(dcm_file)
-        encryption_flags = {}
-        for row in range(self.tagsTable.rowCount()):
-            tag_name = self.tagsTable.item(row, 1).text()
-            if tag_name in ds:
-                flag = self.process_tag(ds, tag_name, row, dummy_ds)
-                if flag:
-                    encryption_flags[str(flag["tag"])] = flag
-        if len(encryption_flags.keys()) > 0:
+        manifest = self.manifest
+        folder = self.folder
+        archive = is_archive(folder)
+        if archive:
+            # Archives are written in one go and always processed in full
+            output_folder = archive_output_path(folder)
+            input_name, output_name = archive_stem(folder), archive_stem(output_folder)
+            index = None
+        else:
+            output_folder = folder + "_anonymized"
+            input_name, output_name = folder, output_folder
+            index = RunIndex(output_folder)
+        password = self.passwordInput.text()
+        pseudonymizer = None
+        if pseudonymize:
+            pseudonymizer = Pseudonymizer.derive(password, mapping_path_for(input_name))
+        plan = self.build_plan(pseudonymizer, remap_uids)
+        workers = self.workersInput.value()
+        entries = list(manifest)
+        metrics = RunMetrics() if self.stageReportCheckbox.isChecked() else None
+        stages = NO_METRICS if metrics is None else metrics
+        if index is not None and self.skipUnchangedCheckbox.isChecked():
+            with stages.stage("index"):
+                entries, _ = split_pending(manifest, plan, index, output_folder)
+
+        def job(report, is_cancelled):
             try:
-                serialized_json = json.dumps(encryption_flags)
-            except TypeError:
-                serialized_json = json.dumps(try_serialize(encryption_flags))
-            encrypted_data = encrypt(
-                serialized_json, self.passwordInput.text()
+                return anonymize(report, is_cancelled)
+            finally:
+                if metrics is not None:
+                    metrics.write_report(
+                        report_path_for(output_name),
+                        input=folder,
+                        output=output_folder,
+                        workers=workers,
+                        cancelled=is_cancelled(),
+                    )
+
+        def anonymize(report, is_cancelled):
+            # Only files which were completely written end up in the index,
+            # files which fail are quarantined
+            quarantine = Quarantine(folder, quarantine_path_for(input_name))
+            with index or nullcontext(), pseudonymizer or nullcontext(), quarantine:
+                # Derive the encryption key once for the whole run
+                key = None
+                if plan.encrypts:
+                    with stages.stage("kdf"):
+                        key = EncryptionKey.derive(password)
+                by_path = {entry.path: entry for entry in entries}
+                if archive:
+                    # Members failing the scan are read again and quarantined
+                    # with their content if they fail again
+                    anonymize_archive(
+                        folder,
+                        output_folder,
+                        plan,
+                        password,
+                        workers,
+                        key=key,
+                        progress_callback=lambda paths: report(
+                            [by_path[path] for path in paths if path in by_path]
+                        ),
+                        should_cancel=is_cancelled,
+                        error_callback=quarantine.add,
+                        metrics=metrics,
+                    )
+                    return quarantine.failures
+                for path, error in manifest.errors:
+                    quarantine.add(path, error)
+                stages.count("errors", len(manifest.errors))
+
+                def files_done(paths):
+                    done = [by_path[path] for path in paths]
+                    with stages.stage("index"):
+                        record_processed(
+                            manifest,
+                            plan,
+                            index,
+                            [e for e in done if not quarantine.failed(e.path)],
+                        )
+                    report(done)
+
+                anonymize_files(
+                    list(by_path),
+                    folder,
+                    output_folder,
+                    plan,
+                    password,
+                    workers,
+                    key=key,
+                    progress_callback=files_done,
+                    should_cancel=is_cancelled,
+                    error_callback=quarantine.add,
+                    metrics=metrics,
+                )
+            return quarantine.failures
+
+        self.run_metrics = metrics
+        self.run_quarantine = quarantine_path_for(input_name)
+        self.run_in_background(job, entries)
+
+    def run_in_background(self, job, entries):
+        """Run a job over the given files in a worker thread."""
+        self.progressBar.setMaximum(len(entries))
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.statusLabel.setText("")
+        self.metricsLabel.hide()
+        self.cancelBtn.setEnabled(True)
+        self.cancelBtn.show()
+        self.processBtn.setEnabled(False)
+        self.folderBtn.setEnabled(False)
+        self.archiveBtn.setEnabled(False)
+
+        self.worker_thread = QThread(self)
+        self.worker = ProcessingWorker(job, entries)
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.update_progress)
+        self.worker.failed.connect(self.processing_failed)
+        self.worker.finished.connect(self.processing_finished)
+        self.worker.finished.connect(self.worker_thread.quit)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+        self.worker_thread.finished.connect(self.worker_thread.deleteLater)
+        self.worker_thread.start()
+
+    def is_processing(self):
+        return self.worker is not None
+
+    def cancel_processing(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancelBtn.setEnabled(False)
+            self.statusLabel.setText("Cancelling...")
+
+    def update_progress(self, value, status):
+        self.progressBar.setValue(value)
+        self.statusLabel.setText(status)
+
+    def processing_failed(self, message):
+        QMessageBox.critical(self, "Error", message)
+
+    def processing_finished(self, done, cancelled, failures):
+        if cancelled:
+            self.statusLabel.setText(f"Cancelled after {done} files")
+        if failures:
+            text = f"{len(failures)} files could not be processed."
+            if self.run_quarantine is not None:
+                text += f" They were copied to {self.run_quarantine}."
+            message = QMessageBox(QMessageBox.Icon.Warning, "Error", text, parent=self)
+            message.setDetailedText(
+                "\n".join(f"{path}: {error}" for path, error in failures)
             )
-            ds.add_new((0x0019, 0x0101), "OB", encrypted_data.encode())
-        Path(output_filepath).parent.mkdir(parents=True, exist_ok=True)
-        ds.save_as(output_filepath)
-
-    def process_tag(self, ds, tag_name, row, dummy_ds):
-        action = self.get_action_for_row(row)
-        tag = pydicom.datadict.tag_for_keyword(tag_name)
-        if action == "Change with Dummy Value":
-            ds[tag].value = dummy_ds.get(tag_name, "")
-        elif action == "Change with Value":
-            new_value = self.tagsTable.cellWidget(row, 2).text()
-            ds[tag].value = new_value
-        elif action == "Delete":
-            del ds[tag]
-        elif action == "Encrypt":
-            data = {
-                "tag": ds[tag].tag,
-                "value": ds[tag].value,
-                "name": ds[tag].name,
-                "VR": ds[tag].VR,
-            }
-            del ds[tag]
-            return data
+            message.exec()
+        if self.run_metrics is not None:
+            self.metricsLabel.setText(self.run_metrics.describe())
+            self.metricsLabel.show()
+            self.run_metrics = None
+        self.run_quarantine = None
+        self.cancelBtn.hide()
+        self.processBtn.setEnabled(True)
+        self.folderBtn.setEnabled(True)
+        self.archiveBtn.setEnabled(True)
+        self.worker = None
+        self.worker_thread = None
+
+    def closeEvent(self, event):
+        if self.worker_thread is not None:
+            self.worker.cancel()
+            self.worker_thread.wait()
+        super().closeEvent(event)
+
+    def build_plan(self, pseudonymizer=None, remap_uids=False):
+        """Compile the tag table into a plan."""
+        from utilities.anonymization_plan import AnonymizationPlan
+        from utilities.dummy_values import dummy_values
+
+        return AnonymizationPlan.compile(
+            self.tagsModel.rows(), dummy_values(), pseudonymizer, remap_uids
+        )
 
     def get_action_for_row(self, row):
-        if self.tagsTable.cellWidget(row, 3).isChecked():
-            return "Unchanged"
-        elif self.tagsTable.cellWidget(row, 5).isChecked():
-            return "Change with Dummy Value"
-        elif self.tagsTable.cellWidget(row, 4).isChecked():
-            return "Change with Value"
-        elif self.tagsTable.cellWidget(row, 6).isChecked():
-            return "Delete"
-        elif self.tagsTable.cellWidget(row, 7).isChecked():
-            return "Encrypt"
+        return self.tagsModel.action(row)
 
     def is_encrypt_selected(self):
-        for row in range(self.tagsTable.rowCount()):
-            if self.tagsTable.cellWidget(row, 7).isChecked():
-                return True
-        return False
+        return self.tagsModel.has_action(Action.ENCRYPT)
+
+    def is_pseudonymize_selected(self):
+        return self.tagsModel.has_action(Action.PSEUDONYMIZE)
 
     def findRowForTag(self, tag_name):
         """Find the row in the table corresponding to a given DICOM tag."""
-        for row in range(self.tagsTable.rowCount()):
-            if self.tagsTable.item(row, 1).text() == tag_name:
-                return row
-        return None
+        return self.tagsModel.find_row(tag_name)
 
     def decrypt_files(self, password):
-        for dcm_file in load_dcm_files(self.folder):
-            output_filepath = dcm_file.replace(self.folder, self.folder + "_decrypted")
-            ds = pydicom.dcmread(dcm_file)
-            if detect_if_encrypted(ds):
-                data = ds[(0x0019, 0x0101)].value.decode()
-                data_decripted = json.loads(decrypt(data, password))
-                for key in data_decripted.keys():
-                    tag = data_decripted[key]
-                    ds.add_new(tag["tag"], tag["VR"], tag["value"])
-            Path(output_filepath).parent.mkdir(exist_ok=True, parents=True)
-            ds.save_as(output_filepath)
+        from utilities.archive_io import is_archive
+        from utilities.reidentification import reidentify_files, verify_password
+
+        entries = list(self.manifest)
+        folder = self.folder
+        if is_archive(folder):
+            QMessageBox.critical(
+                self, "Error", "Encrypted archives have to be extracted first."
+            )
+            return
+        workers = self.workersInput.value()
+        try:
+            key = verify_password(entries, password)
+        except ValueError as e:
+            QMessageBox.critical(self, "Error", str(e))
+            return
+
+        def job(report, is_cancelled):
+            by_path = {entry.path: entry for entry in entries}
+            return reidentify_files(
+                list(by_path),
+                folder,
+                folder + "_decrypted",
+                password,
+                workers,
+                key=key,
+                progress_callback=lambda paths: report([by_path[p] for p in paths]),
+                should_cancel=is_cancelled,
+            )
+
+        self.run_in_background(job, entries)
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = QApplication([])
     window = DICOMAnonymizer()
     window.show()
@@ -0,0 +1,830 @@
+"""
+Command line interface of the DICOM Anonymizer.
+
+Anonymizes a folder of DICOM files with a config.ini saved from the GUI,
+without a display and without importing PyQt6. A ZIP or TAR archive is
+anonymized into a new archive of the same format, without extracting it.
+With --listen, instances received over the network (C-STORE) are anonymized
+on the fly and written to the output folder or forwarded to another node.
+Large inputs can be split into shards of whole studies with --plan-shards,
+processed by separate processes or hosts with --shard and merged into the
+output folder with --merge-shards.
+
+Files which can not be processed do not stop the run, they are copied to the
+quarantine folder with an error manifest and the exit status is 2.
+
+Usage:
+    python DicomAnonymizerCLI.py INPUT [-o OUTPUT] [-c config.ini] [-w WORKERS]
+                                 [--password PASSWORD] [--remap-uids]
+                                 [--pseudonym-map PATH]
+                                 [--quarantine PATH] [--full] [--dry-run]
+                                 [--summary-json PATH] [--report]
+                                 [--metrics-jsonl PATH] [--metrics-interval S]
+    python DicomAnonymizerCLI.py --listen [HOST:]PORT [-o OUTPUT]
+                                 [--forward AE@HOST:PORT] [--ae-title AE]
+                                 [--forward-associations N] [-c config.ini]
+                                 [-w WORKERS]
+    python DicomAnonymizerCLI.py INPUT --plan-shards N [--shard-manifest PATH]
+    python DicomAnonymizerCLI.py [INPUT] --shard K --shard-manifest PATH
+                                 [-o OUTPUT] [-c config.ini] [-w WORKERS]
+    python DicomAnonymizerCLI.py --merge-shards --shard-manifest PATH
+                                 [-o OUTPUT] [--pseudonym-map PATH]
+                                 [--quarantine PATH] [--summary-json PATH]
+
+Runs with --shard take the options of the first form from --password on, runs
+with --listen take them too except --full and --dry-run.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import Counter
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.archive_io import (
+    anonymize_archive,
+    archive_output_path,
+    archive_stem,
+    archive_suffix,
+    is_archive,
+)
+from utilities.config_manager import read_config
+from utilities.dummy_values import dummy_values
+from utilities.encryption_manager import EncryptionKey
+from utilities.parallel_engine import anonymize_files
+from utilities.pixel_redaction import RedactionRules
+from utilities.pseudonymizer import MAPPING_SUFFIX, Pseudonymizer, mapping_path_for
+from utilities.quarantine import QUARANTINE_SUFFIX, Quarantine, quarantine_path_for
+from utilities.run_index import RunIndex, record_processed, split_pending
+from utilities.run_metrics import (
+    DEFAULT_METRICS_INTERVAL,
+    NO_METRICS,
+    MetricsStream,
+    RunMetrics,
+    report_path_for,
+)
+from utilities.scan_manifest import ManifestEntry, ScanManifest
+from utilities.sharding import (
+    SHARD_FOLDER_SUFFIX,
+    SHARDS_SUFFIX,
+    ShardPlan,
+    merge_shards,
+    shard_manifest_path_for,
+    shard_output_path,
+)
+
+PASSWORD_ENV = "DICOM_ANONYMIZER_PASSWORD"
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Anonymize a folder of DICOM files with a saved config."
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        help="Folder or ZIP/TAR archive containing the DICOM files.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=(
+            "Output folder, or output archive for an input archive. "
+            "Defaults to <input>_anonymized."
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        default="config.ini",
+        help="Config saved from the GUI. Defaults to config.ini.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--password",
+        default=os.environ.get(PASSWORD_ENV, ""),
+        help=(
+            "Password for tags set to Encrypt or Pseudonymize. "
+            f"Defaults to ${PASSWORD_ENV}."
+        ),
+    )
+    parser.add_argument(
+        "--dummy-modality",
+        metavar="MODALITY",
+        help=(
+            "Modality named by the dummy descriptions, such as CT or MR. "
+            "Defaults to descriptions naming no modality."
+        ),
+    )
+    parser.add_argument(
+        "--redact-pixels",
+        metavar="RULES",
+        help=(
+            "JSON file of rectangles to blank in the pixel data, by "
+            "manufacturer, model, rows and columns."
+        ),
+    )
+    parser.add_argument(
+        "--remap-uids",
+        action="store_true",
+        help=(
+            "Replace every instance UID without a rule of its own, including "
+            "UIDs in sequences. Requires --password."
+        ),
+    )
+    parser.add_argument(
+        "--pseudonym-map",
+        help=(
+            "SQLite file recording the pseudonyms and their original values. "
+            f"Defaults to <input>{MAPPING_SUFFIX}."
+        ),
+    )
+    parser.add_argument(
+        "--quarantine",
+        help=(
+            "Folder the files which can not be processed are copied to, with "
+            f"an error manifest. Defaults to <input>{QUARANTINE_SUFFIX}."
+        ),
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Process all files, also those unchanged since the last run.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report what would be changed, do not write any file.",
+    )
+    parser.add_argument(
+        "--summary-json",
+        help="Write a JSON summary of the run to this path, '-' for stdout.",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Time every stage of the run and write a report to <output>_report.json.",
+    )
+    parser.add_argument(
+        "--metrics-jsonl",
+        help="Append the metrics of the run to this JSON lines file while it runs.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=DEFAULT_METRICS_INTERVAL,
+        help=(
+            "Seconds between two lines of --metrics-jsonl. "
+            f"Defaults to {DEFAULT_METRICS_INTERVAL:g}."
+        ),
+    )
+    parser.add_argument(
+        "--listen",
+        metavar="[HOST:]PORT",
+        help=(
+            "Receive instances over C-STORE instead of reading an input, "
+            "until interrupted. Requires --output or --forward."
+        ),
+    )
+    parser.add_argument(
+        "--ae-title",
+        default="ANONYMIZER",
+        help="AE title of --listen. Defaults to ANONYMIZER.",
+    )
+    parser.add_argument(
+        "--forward",
+        metavar="AE@HOST:PORT",
+        help="Send the anonymized instances received with --listen to this node.",
+    )
+    parser.add_argument(
+        "--forward-associations",
+        type=int,
+        default=4,
+        help="Associations kept open to the --forward node. Defaults to 4.",
+    )
+    parser.add_argument(
+        "--plan-shards",
+        type=int,
+        metavar="N",
+        help=(
+            "Split the studies of the input into N shards of about the same "
+            "size and write a shard manifest, without processing any file."
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        metavar="K",
+        help=(
+            "Only process shard K of --shard-manifest, into "
+            f"<output>{SHARD_FOLDER_SUFFIX}K. The input defaults to the "
+            "planned input."
+        ),
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="Merge the processed shards of --shard-manifest into the output.",
+    )
+    parser.add_argument(
+        "--shard-manifest",
+        help=(
+            "Shard manifest. Written by --plan-shards to "
+            f"<input>{SHARDS_SUFFIX} by default."
+        ),
+    )
+    args = parser.parse_args(argv)
+    sharded = args.shard is not None or args.merge_shards
+    if args.listen is None and args.input is None and not sharded:
+        parser.error("an input is required unless --listen is given")
+    if sharded and args.shard_manifest is None:
+        parser.error("--shard and --merge-shards require --shard-manifest")
+    if args.shard is not None and args.merge_shards:
+        parser.error("--shard and --merge-shards exclude each other")
+    if args.merge_shards and args.input is not None:
+        parser.error("--merge-shards takes no input")
+    if (args.plan_shards is not None or sharded) and (
+        args.listen is not None or args.dry_run
+    ):
+        parser.error("shards take no --listen and no --dry-run")
+    if args.plan_shards is not None and (sharded or args.plan_shards < 1):
+        parser.error("--plan-shards takes a number of shards of at least 1")
+    if args.listen is not None:
+        if args.input is not None or args.dry_run:
+            parser.error("--listen takes no input and no --dry-run")
+        if args.output is None and args.forward is None:
+            parser.error("--listen requires --output or --forward")
+    return args
+
+
+def parse_listen(listen: str) -> Tuple[str, int]:
+    """Split the address of --listen into host and port, all hosts by default."""
+    host, _, port = listen.rpartition(":")
+    return host, int(port)
+
+
+def count_tag_actions(entries: List[ManifestEntry], plan: AnonymizationPlan) -> Counter:
+    """
+    Count how many tags each action changes over the given files.
+
+    Parameters:
+        entries (List[ManifestEntry]): Scanned files.
+        plan (AnonymizationPlan): Compiled rules.
+
+    Returns:
+        Counter: Number of tags per action name.
+    """
+    counts = Counter()
+    for entry in entries:
+        for tag in entry.tags:
+            rule = plan.rules.get(tag)
+            if rule is not None:
+                counts[rule.action.value] += 1
+    return counts
+
+
+def process_entries(
+    manifest: ScanManifest,
+    entries: List[ManifestEntry],
+    output_folder: str,
+    plan: AnonymizationPlan,
+    args: argparse.Namespace,
+    index: RunIndex,
+    quarantine: Quarantine,
+    metrics: Optional[RunMetrics] = None,
+    stream: Optional[MetricsStream] = None,
+) -> int:
+    """
+    Anonymize the given files of a manifest and record them in the run index.
+
+    Every file is recorded as soon as it is written, so an interrupted run
+    resumes after the last written file. Files which fail are quarantined and
+    not recorded.
+
+    Parameters:
+        manifest (ScanManifest): Scan of the input folder.
+        entries (List[ManifestEntry]): Files to process.
+        output_folder (str): Output folder.
+        plan (AnonymizationPlan): Compiled rules.
+        args (argparse.Namespace): Command line arguments.
+        index (RunIndex): Index of the output folder.
+        quarantine (Quarantine): Quarantine of the files which fail.
+        metrics (Optional[RunMetrics], optional): Metrics of the run.
+            Defaults to None.
+        stream (Optional[MetricsStream], optional): Stream the metrics are
+            written to while the files are processed. Defaults to None.
+
+    Returns:
+        int: Number of processed files, without failed files.
+    """
+    if not entries:
+        return 0
+    stages = NO_METRICS if metrics is None else metrics
+    key = None
+    if plan.encrypts:
+        with stages.stage("kdf"):
+            key = EncryptionKey.derive(args.password)
+
+    by_path = {entry.path: entry for entry in entries}
+    processed = 0
+
+    def files_done(paths: List[str]) -> None:
+        nonlocal processed
+        done = [by_path[path] for path in paths if not quarantine.failed(path)]
+        processed += len(done)
+        with stages.stage("index"):
+            record_processed(manifest, plan, index, done)
+        if stream is not None:
+            stream.update()
+
+    anonymize_files(
+        list(by_path),
+        manifest.folder,
+        output_folder,
+        plan,
+        args.password,
+        args.workers,
+        key=key,
+        progress_callback=files_done,
+        error_callback=quarantine.add,
+        metrics=metrics,
+    )
+    return processed
+
+
+def process_archive(
+    manifest: ScanManifest,
+    output_path: str,
+    plan: AnonymizationPlan,
+    args: argparse.Namespace,
+    quarantine: Quarantine,
+    metrics: Optional[RunMetrics] = None,
+    stream: Optional[MetricsStream] = None,
+) -> int:
+    """
+    Anonymize the members of an archive into a new archive.
+
+    The output archive is written in one go, so archives are always processed
+    in full and not recorded in a run index. Members which fail are
+    quarantined and left out of the output archive.
+
+    Parameters:
+        manifest (ScanManifest): Scan of the input archive.
+        output_path (str): Output archive.
+        plan (AnonymizationPlan): Compiled rules.
+        args (argparse.Namespace): Command line arguments.
+        quarantine (Quarantine): Quarantine of the members which fail.
+        metrics (Optional[RunMetrics], optional): Metrics of the run.
+            Defaults to None.
+        stream (Optional[MetricsStream], optional): Stream the metrics are
+            written to while the members are processed. Defaults to None.
+
+    Returns:
+        int: Number of processed members, without failed members.
+    """
+    stages = NO_METRICS if metrics is None else metrics
+    key = None
+    if plan.encrypts and len(manifest):
+        with stages.stage("kdf"):
+            key = EncryptionKey.derive(args.password)
+
+    processed = 0
+
+    def members_done(paths: List[str]) -> None:
+        nonlocal processed
+        processed += sum(not quarantine.failed(path) for path in paths)
+        if stream is not None:
+            stream.update()
+
+    anonymize_archive(
+        manifest.folder,
+        output_path,
+        plan,
+        args.password,
+        args.workers,
+        key=key,
+        progress_callback=members_done,
+        error_callback=quarantine.add,
+        metrics=metrics,
+    )
+    return processed
+
+
+def write_summary(summary: dict, path: str) -> None:
+    """Write the summary of a run as JSON to a file, or to stdout for '-'."""
+    if path == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, "w") as fp:
+            json.dump(summary, fp, indent=2)
+
+
+def listen(
+    args: argparse.Namespace,
+    plan: AnonymizationPlan,
+    output_folder: Optional[str],
+    quarantine: Quarantine,
+    metrics: Optional[RunMetrics] = None,
+    stream: Optional[MetricsStream] = None,
+) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Receive and anonymize instances until the process is interrupted.
+
+    Parameters:
+        args (argparse.Namespace): Command line arguments.
+        plan (AnonymizationPlan): Compiled rules.
+        output_folder (Optional[str]): Folder the instances are written to.
+        quarantine (Quarantine): Quarantine of the instances which fail.
+        metrics (Optional[RunMetrics], optional): Metrics of the run.
+            Defaults to None.
+        stream (Optional[MetricsStream], optional): Stream the metrics are
+            written to while instances are received. Defaults to None.
+
+    Returns:
+        Tuple[int, List[Tuple[str, str]]]: Number of stored instances and the
+            name and error message of every failed instance.
+    """
+    # pynetdicom is only imported when instances are received
+    from utilities.dicom_receiver import AssociationPool, DicomReceiver, parse_node
+
+    stages = NO_METRICS if metrics is None else metrics
+    key = None
+    if plan.encrypts:
+        with stages.stage("kdf"):
+            key = EncryptionKey.derive(args.password)
+    forward = None
+    if args.forward:
+        forward = AssociationPool(
+            *parse_node(args.forward),
+            size=args.forward_associations,
+            calling_ae_title=args.ae_title,
+        )
+    receiver = DicomReceiver(
+        plan,
+        args.password,
+        output_folder,
+        forward,
+        args.workers,
+        key=key,
+        quarantine=quarantine,
+        metrics=metrics,
+        progress_callback=stream and (lambda names: stream.update()),
+        ae_title=args.ae_title,
+    )
+    host, port = parse_listen(args.listen)
+    # Stop like on Ctrl+C when run as a service
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with forward or nullcontext():
+        receiver.start(host, port)
+        print(f"Listening as {args.ae_title} on port {receiver.port}, Ctrl+C stops")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            receiver.stop()
+    return receiver.stored, receiver.failures
+
+
+def plan_shards(args: argparse.Namespace, folder: str, start: float) -> int:
+    """
+    Split the studies of an input folder into shards and write the manifest.
+
+    Parameters:
+        args (argparse.Namespace): Command line arguments.
+        folder (str): Input folder.
+        start (float): Start time of the run, from time.perf_counter.
+
+    Returns:
+        int: Exit status.
+    """
+    if is_archive(folder):
+        print("Error: only folders can be split into shards.", file=sys.stderr)
+        return 1
+    # Shards only need the study and size of every file, no tag values
+    manifest = ScanManifest.build(folder, sample_per_series=0)
+    plan = ShardPlan.plan(manifest, args.plan_shards)
+    path = args.shard_manifest or shard_manifest_path_for(folder)
+    plan.write(path)
+    summary = {
+        "input": folder,
+        "shard_manifest": path,
+        "files": len(manifest) + len(manifest.errors),
+        "bytes": manifest.total_size,
+        "shards": [
+            {
+                "index": shard.index,
+                "studies": len(shard.studies),
+                "files": len(shard.files),
+                "bytes": shard.bytes,
+            }
+            for shard in plan.shards
+        ],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if args.summary_json:
+        write_summary(summary, args.summary_json)
+    else:
+        for shard in summary["shards"]:
+            print(
+                f"Shard {shard['index']}: {shard['studies']} studies, "
+                f"{shard['files']} files, {shard['bytes'] / 1024 / 1024:.1f} MB"
+            )
+        print(f"Wrote {path} in {summary['seconds']} s")
+    return 0
+
+
+def merge_shard_outputs(args: argparse.Namespace, start: float) -> int:
+    """
+    Merge the processed shards of a shard manifest into the output folder.
+
+    Parameters:
+        args (argparse.Namespace): Command line arguments.
+        start (float): Start time of the run, from time.perf_counter.
+
+    Returns:
+        int: Exit status, 2 if files of any shard failed.
+    """
+    plan = ShardPlan.read(args.shard_manifest)
+    output_folder = args.output or plan.folder + "_anonymized"
+    try:
+        result = merge_shards(plan, output_folder, args.pseudonym_map, args.quarantine)
+    except FileNotFoundError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if result["report"] is not None:
+        write_summary(
+            {"input": plan.folder, "output": output_folder, **result["report"]},
+            report_path_for(output_folder),
+        )
+    summary = {
+        "input": plan.folder,
+        "output": output_folder,
+        "shards": len(plan),
+        "files": result["files"],
+        "failed": result["failed"],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if args.summary_json:
+        write_summary(summary, args.summary_json)
+    else:
+        print(
+            f"Merged {result['files']} files of {len(plan)} shards "
+            f"into {output_folder} in {summary['seconds']} s"
+        )
+        if result["failed"]:
+            print(
+                f"{result['failed']} files failed, see "
+                f"{args.quarantine or quarantine_path_for(plan.folder)}",
+                file=sys.stderr,
+            )
+    return 2 if result["failed"] else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    start = time.perf_counter()
+    if args.merge_shards:
+        return merge_shard_outputs(args, start)
+    shard_plan = None
+    if args.shard is not None:
+        shard_plan = ShardPlan.read(args.shard_manifest)
+        if not 0 <= args.shard < len(shard_plan):
+            print(
+                f"Error: the shard manifest has {len(shard_plan)} shards.",
+                file=sys.stderr,
+            )
+            return 1
+    folder = args.input and os.path.normpath(args.input)
+    if shard_plan is not None and folder is None:
+        folder = shard_plan.folder
+    if args.plan_shards is not None:
+        return plan_shards(args, folder, start)
+    archive = folder is not None and is_archive(folder)
+    if args.listen is not None:
+        output_folder = args.output and os.path.normpath(args.output)
+        # Mapping file, quarantine and report are named after the output
+        # folder, or the AE title if instances are only forwarded
+        input_name = output_name = output_folder or args.ae_title
+    elif archive:
+        output_folder = args.output or archive_output_path(folder)
+        if archive_suffix(output_folder) is None:
+            print(
+                "Error: the output of an archive must be a ZIP or TAR archive.",
+                file=sys.stderr,
+            )
+            return 1
+        # Mapping file, quarantine and report are named after the archives
+        input_name, output_name = archive_stem(folder), archive_stem(output_folder)
+    else:
+        output_folder = args.output or folder + "_anonymized"
+        input_name, output_name = folder, output_folder
+        if shard_plan is not None:
+            # Every shard has its own output folder, mapping file, quarantine
+            # and report, which are merged by --merge-shards
+            output_folder = shard_output_path(output_folder, args.shard)
+            input_name = output_name = output_folder
+
+    rows = read_config(args.config)
+    needs_password = {Action.ENCRYPT, Action.PSEUDONYMIZE} & {row[1] for row in rows}
+    if needs_password and not args.password:
+        actions = " or ".join(sorted(action.value for action in needs_password))
+        print(
+            f"Error: tags are set to {actions}, "
+            f"provide --password or ${PASSWORD_ENV}.",
+            file=sys.stderr,
+        )
+        return 1
+    if args.remap_uids and not args.password:
+        print(
+            f"Error: --remap-uids requires --password or ${PASSWORD_ENV}.",
+            file=sys.stderr,
+        )
+        return 1
+    pseudonymizer = None
+    if Action.PSEUDONYMIZE in needs_password or args.remap_uids:
+        # A dry run does not record any pseudonym
+        mapping_path = None
+        if not args.dry_run:
+            mapping_path = args.pseudonym_map or mapping_path_for(input_name)
+        pseudonymizer = Pseudonymizer.derive(args.password, mapping_path)
+    redaction = None
+    if args.redact_pixels:
+        redaction = RedactionRules.read(args.redact_pixels)
+    plan = AnonymizationPlan.compile(
+        rows,
+        dummy_values(args.dummy_modality),
+        pseudonymizer,
+        args.remap_uids,
+        redaction,
+    )
+
+    metrics = None
+    if (args.report or args.metrics_jsonl) and not args.dry_run:
+        metrics = RunMetrics()
+    stages = NO_METRICS if metrics is None else metrics
+
+    if args.listen is not None:
+        # Failed instances are quarantined as <calling AE title>/<name>
+        quarantine = Quarantine(
+            os.curdir, args.quarantine or quarantine_path_for(input_name)
+        )
+        stream = None
+        if args.metrics_jsonl:
+            stream = MetricsStream(args.metrics_jsonl, metrics, args.metrics_interval)
+        with pseudonymizer or nullcontext(), stream or nullcontext(), quarantine:
+            stored, failures = listen(
+                args, plan, output_folder, quarantine, metrics, stream
+            )
+        info = {
+            "listen": args.listen,
+            "ae_title": args.ae_title,
+            "output": output_folder,
+            "forward": args.forward,
+            "config": args.config,
+            "workers": args.workers,
+        }
+        if args.report and metrics is not None:
+            metrics.write_report(report_path_for(output_name), **info)
+        summary = {
+            **info,
+            "stored": stored,
+            "failed": len(failures),
+            "errors": quarantine.manifest_path if failures else None,
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+        if args.summary_json:
+            write_summary(summary, args.summary_json)
+        else:
+            print(f"Stored {stored} instances in {summary['seconds']} s")
+            if failures:
+                print(
+                    f"{len(failures)} instances failed, see {summary['errors']}",
+                    file=sys.stderr,
+                )
+        return 2 if failures else 0
+
+    # A dry run must not create the output folder
+    index = None
+    if not archive and (not args.dry_run or os.path.isdir(output_folder)):
+        index = RunIndex(output_folder)
+    quarantine = Quarantine(folder, args.quarantine or quarantine_path_for(input_name))
+    with index or nullcontext():
+        known = None
+        if index is not None and not args.full:
+            # Files finished by an earlier or interrupted run are not read again
+            known = index.known_entries(folder)
+        with stages.stage("scan"):
+            if archive:
+                manifest = ScanManifest.build_archive(folder)
+            else:
+                manifest = ScanManifest.build(
+                    folder,
+                    known=known,
+                    paths=shard_plan and shard_plan.paths(args.shard, folder),
+                )
+        entries, skipped, processed = list(manifest), [], 0
+        failures = manifest.errors
+        if index is not None and not args.full:
+            with stages.stage("index"):
+                entries, skipped = split_pending(manifest, plan, index, output_folder)
+        if not args.dry_run:
+            stream = None
+            if args.metrics_jsonl:
+                stream = MetricsStream(
+                    args.metrics_jsonl, metrics, args.metrics_interval
+                )
+            with pseudonymizer or nullcontext(), stream or nullcontext(), quarantine:
+                if archive:
+                    # Every member is read again, members failing the scan
+                    # are quarantined with their content if they fail again
+                    processed = process_archive(
+                        manifest,
+                        output_folder,
+                        plan,
+                        args,
+                        quarantine,
+                        metrics,
+                        stream,
+                    )
+                else:
+                    for path, error in manifest.errors:
+                        quarantine.add(path, error)
+                    stages.count("errors", len(manifest.errors))
+                    processed = process_entries(
+                        manifest,
+                        entries,
+                        output_folder,
+                        plan,
+                        args,
+                        index,
+                        quarantine,
+                        metrics,
+                        stream,
+                    )
+            failures = quarantine.failures
+    if args.report and metrics is not None:
+        metrics.write_report(
+            report_path_for(output_name),
+            input=folder,
+            output=output_folder,
+            config=args.config,
+            workers=args.workers,
+            skipped=len(skipped),
+        )
+
+    summary = {
+        "input": folder,
+        "output": output_folder,
+        "config": args.config,
+        "dry_run": args.dry_run,
+        "workers": args.workers,
+        "files": len(manifest),
+        "bytes": manifest.total_size,
+        "processed": processed,
+        "skipped": len(skipped),
+        "failed": len(failures),
+        "not_dicom": len(manifest.not_dicom),
+        "errors": quarantine.manifest_path if failures and not args.dry_run else None,
+        "tags": dict(count_tag_actions(entries, plan)),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if args.summary_json:
+        write_summary(summary, args.summary_json)
+    else:
+        verb = "Would process" if args.dry_run else "Processed"
+        count = len(entries) if args.dry_run else processed
+        tags = ", ".join(f"{n} {a}" for a, n in summary["tags"].items())
+        print(
+            f"{verb} {count} files, skipped {len(skipped)} unchanged files "
+            f"in {summary['seconds']} s ({tags or 'no changes'})"
+        )
+        for path in manifest.not_dicom:
+            print(f"Not a DICOM file, left out: {path}", file=sys.stderr)
+        for path, error in failures:
+            print(f"Failed: {path}: {error}", file=sys.stderr)
+        if summary["errors"]:
+            print(
+                f"{len(failures)} files failed, see {summary['errors']}",
+                file=sys.stderr,
+            )
+    # Some files could not be processed
+    return 2 if failures else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+Compare the header-only DICOM discovery with the previous full-parse approach.
+
+Usage:
+    python -m benchmarks.bench_discovery --files 5000 --junk-ratio 0.1
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import List
+
+import pydicom
+
+from benchmarks.synthetic import build_synthetic_tree
+from utilities.helper_function import iter_dcm_files
+
+
+def legacy_load_dcm_files(folder: str) -> List[str]:
+    """Previous implementation: os.walk plus a full dcmread per file."""
+    dcm_files = []
+    for root, _, files in os.walk(folder):
+        for file in files:
+            try:
+                pydicom.dcmread(os.path.join(root, file))
+            except pydicom.errors.InvalidDicomError:
+                continue
+            dcm_files.append(os.path.join(root, file))
+    return dcm_files
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--junk-ratio", type=float, default=0.1)
+    parser.add_argument("--preambleless-ratio", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = build_synthetic_tree(
+            tmp,
+            args.files,
+            junk_ratio=args.junk_ratio,
+            preambleless_ratio=args.preambleless_ratio,
+        )
+        candidates = {
+            "legacy (os.walk + dcmread)": lambda: legacy_load_dcm_files(str(root)),
+            "header-only (scandir + probe)": lambda: list(iter_dcm_files(str(root))),
+        }
+        for name, run in candidates.items():
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                found = run()
+                best = min(best, time.perf_counter() - start)
+            print(
+                f"{name:32s} {len(found):7d} files  {best:8.3f} s  "
+                f"{len(found) / best:10.0f} files/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
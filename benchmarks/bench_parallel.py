@@ -0,0 +1,82 @@
+"""
+Measure how the process-pool anonymization scales with the number of workers.
+
+The DICOM_TEST samples are replicated into a synthetic tree and anonymized with
+an "Auto Select"-like rule plan once per worker count. The outputs of all runs
+are compared with the serial run.
+
+Usage:
+    python -m benchmarks.bench_parallel --files 4000 --workers 1 2 4 8
+"""
+import argparse
+import filecmp
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+from benchmarks.synthetic import build_synthetic_tree
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dummy_values import dummy_values
+from utilities.parallel_engine import process_files_parallel
+from utilities.scan_manifest import ScanManifest
+
+
+def auto_select_plan(manifest: ScanManifest) -> AnonymizationPlan:
+    """Same selection as the "Auto Select" button, without the tag table."""
+    rows = []
+    for _, tag_name, value in sorted(manifest.tags_set, key=lambda x: x[1]):
+        lower_name = tag_name.lower()
+        if any(key in lower_name for key in ("patient", "date", "id", "name")):
+            rows.append((tag_name, Action.CHANGE_DUMMY, value))
+        else:
+            rows.append((tag_name, Action.UNCHANGED, value))
+    return AnonymizationPlan.compile(rows, dummy_values())
+
+
+def same_tree(left: Path, right: Path, files: List[str], folder: str) -> bool:
+    """Check if two output trees contain byte-identical files."""
+    relative = [Path(file).relative_to(folder) for file in files]
+    _, mismatch, errors = filecmp.cmpfiles(
+        left, right, [str(path) for path in relative], shallow=False
+    )
+    return not mismatch and not errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = str(build_synthetic_tree(str(Path(tmp) / "input"), args.files))
+        manifest = ScanManifest.build(folder)
+        files = manifest.paths()
+        plan = auto_select_plan(manifest)
+        output = Path(folder + "_anonymized")
+        reference = Path(tmp) / "reference"
+
+        baseline = None
+        for workers in args.workers:
+            shutil.rmtree(output, ignore_errors=True)
+            start = time.perf_counter()
+            process_files_parallel(files, folder, str(output), plan, "", workers)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+
+            if not reference.exists():
+                shutil.copytree(output, reference)
+                identical = "reference"
+            else:
+                identical = same_tree(output, reference, files, folder)
+            print(
+                f"workers={workers:3d}  {elapsed:8.2f} s  "
+                f"{len(files) / elapsed:8.1f} files/s  "
+                f"speedup {baseline / elapsed:5.2f}x  identical={identical}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compare the binary encrypted payload with the legacy JSON and hex payload.
+
+The tags an "Auto Select" would change are encrypted instead for every
+DICOM_TEST sample, once with the previous JSON serialization and hex encoding
+and once with the binary payload. A key is derived once beforehand, so only
+serialization, encryption and encoding are timed.
+
+Usage:
+    python -m benchmarks.bench_payload --repeat 5
+"""
+import argparse
+import copy
+import json
+import time
+from typing import List
+
+import pydicom
+from pydicom.dataelem import DataElement
+
+from benchmarks.synthetic import sample_files
+from utilities.anonymization_core import decrypt_elements, encrypt_elements
+from utilities.encryption_manager import EncryptionKey, encrypt
+from utilities.json_wrapper import try_serialize
+
+SENSITIVE_KEYS = ("patient", "date", "id", "name")
+PASSWORD = "benchmark"
+
+
+def sensitive_elements(ds: pydicom.Dataset) -> List[DataElement]:
+    """Remove and return the elements an "Auto Select" would change."""
+    elements = []
+    for tag in list(ds.keys()):
+        keyword = pydicom.datadict.keyword_for_tag(tag).lower()
+        if tag.group > 0x0002 and any(key in keyword for key in SENSITIVE_KEYS):
+            elements.append(ds[tag])
+            del ds[tag]
+    return elements
+
+
+def legacy_encrypt(elements: List[DataElement], key: EncryptionKey) -> bytes:
+    """Previous implementation: JSON with a per-leaf fallback, then hex."""
+    encryption_flags = {
+        str(elem.tag): {
+            "tag": elem.tag,
+            "value": elem.value,
+            "name": elem.name,
+            "VR": elem.VR,
+        }
+        for elem in elements
+    }
+    try:
+        serialized_json = json.dumps(encryption_flags)
+    except TypeError:
+        serialized_json = json.dumps(try_serialize(encryption_flags))
+    return encrypt(serialized_json, PASSWORD, key).encode()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    key = EncryptionKey.derive(PASSWORD)
+    samples = []
+    for path in sample_files():
+        ds = pydicom.dcmread(str(path), stop_before_pixels=True)
+        samples.append((ds, sensitive_elements(ds)))
+    n_elements = sum(len(elements) for _, elements in samples)
+    print(f"{len(samples)} files, {n_elements} encrypted elements")
+
+    encoders = {
+        "legacy": lambda ds, elements: legacy_encrypt(elements, key),
+        "binary": lambda ds, elements: encrypt_elements(elements, ds, PASSWORD, key),
+    }
+    for name, encode in encoders.items():
+        payloads = []
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            payloads = [encode(ds, copy.deepcopy(elements)) for ds, elements in samples]
+        encode_time = (time.perf_counter() - start) / args.repeat / len(samples)
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for payload in payloads:
+                # Values are only decoded when accessed
+                [elem.value for elem in decrypt_elements(payload, PASSWORD)]
+        decode_time = (time.perf_counter() - start) / args.repeat / len(samples)
+
+        size = sum(len(payload) for payload in payloads) / len(payloads)
+        print(
+            f"{name:8s} {size:8.0f} bytes/file  "
+            f"encode {encode_time * 1e6:8.1f} us/file  "
+            f"decode {decode_time * 1e6:8.1f} us/file"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Time every stage of an anonymization run on a synthetic tree.
+
+The DICOM_TEST samples are replicated into a tree of ``--files`` files, of one
+modality and with identifiers nested in sequences if requested. The stages of
+a run are then timed separately:
+
+    discover   walking the tree for DICOM files
+    inventory  building the scan manifest, including a second discovery
+    kdf        deriving the encryption key, once per run
+    read       reading the header of every file
+    transform  applying the rules of an "Auto Select"-like plan
+    encrypt    encrypting the tags set to "Encrypt"
+    write      writing the output file
+
+Results are written as JSON and can be compared with the results of an
+earlier run. ``--profile cprofile`` writes a cProfile report per stage,
+``--profile tracemalloc`` the memory peak and the top allocation sites per
+stage to ``--report-dir``.
+
+Usage:
+    python -m benchmarks.bench_pipeline --files 2000 --nesting 3 --json out.json
+    python -m benchmarks.bench_pipeline --files 2000 --compare out.json
+    python -m benchmarks.bench_pipeline --files 500 --profile cprofile
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+import pydicom
+
+from benchmarks.synthetic import build_synthetic_tree
+from utilities.anonymization_core import (
+    ENCRYPTED_DATA_TAG,
+    encrypt_elements,
+    get_output_path,
+    read_source,
+    write_output,
+)
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dummy_values import dummy_values
+from utilities.encryption_manager import EncryptionKey
+from utilities.helper_function import iter_dcm_files
+from utilities.scan_manifest import ScanManifest
+
+PASSWORD = "benchmark"
+STAGES = ("discover", "inventory", "kdf", "read", "transform", "encrypt", "write")
+# Allocation sites listed per stage in tracemalloc reports
+TOP_ALLOCATIONS = 15
+
+
+class StageProfiler:
+    """Accumulate the time, and optionally a profile, of every stage."""
+
+    def __init__(self, profile: Optional[str] = None, sample_every: int = 1):
+        self.profile = profile
+        self.sample_every = sample_every
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.calls: Counter = Counter()
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.peaks: Dict[str, int] = defaultdict(int)
+        self.allocations: Dict[str, Counter] = defaultdict(Counter)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        sampled = self.calls[name] % self.sample_every == 0
+        self.calls[name] += 1
+        if self.profile == "cprofile":
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        elif self.profile == "tracemalloc":
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            before = tracemalloc.take_snapshot() if sampled else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            if self.profile == "cprofile":
+                profiler.disable()
+            elif self.profile == "tracemalloc":
+                _, peak = tracemalloc.get_traced_memory()
+                self.peaks[name] = max(self.peaks[name], peak - current)
+                if before is not None:
+                    after = tracemalloc.take_snapshot()
+                    for diff in after.compare_to(before, "lineno"):
+                        if diff.size_diff > 0:
+                            self.allocations[name][
+                                str(diff.traceback)
+                            ] += diff.size_diff
+
+    def results(self, n_files: int) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "seconds": round(self.seconds[name], 6),
+                "calls": self.calls[name],
+                "us_per_file": round(self.seconds[name] / n_files * 1e6, 2),
+            }
+            for name in STAGES
+            if name in self.calls
+        }
+
+    def write_reports(self, report_dir: Path) -> None:
+        """Write the hotspots of every stage to the report folder."""
+        report_dir.mkdir(parents=True, exist_ok=True)
+        for name, profiler in self.profiles.items():
+            profiler.dump_stats(str(report_dir / f"{name}.prof"))
+            text = io.StringIO()
+            stats = pstats.Stats(profiler, stream=text)
+            stats.sort_stats("cumulative").print_stats(25)
+            (report_dir / f"{name}.txt").write_text(text.getvalue())
+        for name, allocations in self.allocations.items():
+            lines = [f"peak increase {self.peaks[name] / 1024:.1f} KiB"]
+            samples = -(-self.calls[name] // self.sample_every)
+            for site, size in allocations.most_common(TOP_ALLOCATIONS):
+                lines.append(f"{size / samples / 1024:10.1f} KiB/call  {site}")
+            (report_dir / f"{name}.txt").write_text("\n".join(lines) + "\n")
+
+
+def benchmark_plan(manifest: ScanManifest, encrypt: bool) -> AnonymizationPlan:
+    """Dummy values for identifying tags, names encrypted if requested."""
+    rows = []
+    for _, tag_name, value in sorted(manifest.tags_set, key=lambda x: x[1]):
+        lower_name = tag_name.lower()
+        if encrypt and "name" in lower_name:
+            rows.append((tag_name, Action.ENCRYPT, value))
+        elif any(key in lower_name for key in ("patient", "date", "id", "name")):
+            rows.append((tag_name, Action.CHANGE_DUMMY, value))
+    return AnonymizationPlan.compile(rows, dummy_values())
+
+
+def run(args: argparse.Namespace, profiler: StageProfiler) -> Dict[str, Any]:
+    """Build the tree and time every stage of a run over it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = str(
+            build_synthetic_tree(
+                str(Path(tmp) / "input"),
+                args.files,
+                modality=args.modality,
+                nesting=args.nesting,
+            )
+        )
+        output_folder = folder + "_anonymized"
+        start = time.perf_counter()
+
+        with profiler.stage("discover"):
+            files = list(iter_dcm_files(folder))
+        with profiler.stage("inventory"):
+            manifest = ScanManifest.build(folder)
+        plan = benchmark_plan(manifest, args.encrypt)
+        key = None
+        if plan.encrypts:
+            with profiler.stage("kdf"):
+                key = EncryptionKey.derive(PASSWORD)
+
+        bytes_read = bytes_written = 0
+        for dcm_file in files:
+            with profiler.stage("read"):
+                ds, pixel_info = read_source(dcm_file, True, plan.rules)
+            with profiler.stage("transform"):
+                encrypted_elements = plan.apply(ds)
+            if encrypted_elements:
+                with profiler.stage("encrypt"):
+                    payload = encrypt_elements(encrypted_elements, ds, PASSWORD, key)
+                    ds.add_new(ENCRYPTED_DATA_TAG, "OB", payload)
+            output_filepath = get_output_path(dcm_file, folder, output_folder)
+            with profiler.stage("write"):
+                write_output(ds, pixel_info, dcm_file, output_filepath)
+            bytes_read += os.path.getsize(dcm_file)
+            bytes_written += os.path.getsize(output_filepath)
+        elapsed = time.perf_counter() - start
+
+    return {
+        "config": {
+            "files": len(files),
+            "modality": args.modality,
+            "nesting": args.nesting,
+            "encrypt": args.encrypt,
+            "rules": len(plan),
+            "profile": args.profile,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "pydicom": pydicom.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "stages": profiler.results(len(files)),
+        "seconds": round(elapsed, 6),
+        "files_per_second": round(len(files) / elapsed, 2),
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> int:
+    """Print the change of every stage, return the number of regressions."""
+    regressions = 0
+    print(f"{'stage':10s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for name, stage in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if old is None or not old["us_per_file"]:
+            continue
+        change = stage["us_per_file"] / old["us_per_file"] - 1
+        regressed = change > tolerance
+        regressions += regressed
+        print(
+            f"{name:10s} {old['us_per_file']:9.1f} us {stage['us_per_file']:9.1f} us "
+            f"{change:+8.1%}{'  REGRESSION' if regressed else ''}"
+        )
+    return regressions
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    config = results["config"]
+    print(
+        f"{config['files']} files, modality {config['modality'] or 'any'}, "
+        f"nesting {config['nesting']}, {config['rules']} rules: "
+        f"{results['files_per_second']} files/s"
+    )
+    for name, stage in results["stages"].items():
+        print(
+            f"{name:10s} {stage['seconds']:9.3f} s {stage['us_per_file']:10.1f} us/file"
+        )
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--modality", help="Only replicate samples of a modality.")
+    parser.add_argument("--nesting", type=int, default=0)
+    parser.add_argument(
+        "--no-encrypt",
+        dest="encrypt",
+        action="store_false",
+        help="Set no tag to Encrypt, skipping the kdf and encrypt stages.",
+    )
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="JSON results of an earlier run.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Slowdown of a stage reported as a regression. Defaults to 0.1.",
+    )
+    parser.add_argument("--profile", choices=("cprofile", "tracemalloc"))
+    parser.add_argument(
+        "--sample-every",
+        type=int,
+        default=50,
+        help="Take a tracemalloc snapshot every n calls of a stage.",
+    )
+    parser.add_argument("--report-dir", default="benchmark_profiles")
+    args = parser.parse_args(argv)
+
+    profiler = StageProfiler(args.profile, args.sample_every)
+    if args.profile == "tracemalloc":
+        tracemalloc.start()
+    results = run(args, profiler)
+    if args.profile == "tracemalloc":
+        tracemalloc.stop()
+    if args.profile:
+        profiler.write_reports(Path(args.report_dir))
+        print(f"Profiles written to {args.report_dir}")
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        return 1 if compare(results, baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+Measure throughput and peak memory of anonymizing a large multi-frame file.
+
+A file with a configurable amount of pixel data is synthesized from a DICOM_TEST
+sample and anonymized once by reading the whole file and once with the pixel
+data copied from the source. Every run happens in a fresh process so that its
+peak resident memory can be reported.
+
+Usage:
+    python -m benchmarks.bench_pixel_passthrough --size-mb 1024
+"""
+import argparse
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import pydicom
+
+from benchmarks.synthetic import sample_files
+
+CHUNK = 8 * 1024 * 1024
+
+
+def build_large_file(path: str, size_mb: int) -> None:
+    """Write a multi-frame file by streaming the pixel data to disk."""
+    ds = pydicom.dcmread(str(sample_files()[0]))
+    frame_size = ds.Rows * ds.Columns * ds.BitsAllocated // 8
+    frames = max(1, size_mb * 1024 * 1024 // frame_size)
+    ds.NumberOfFrames = frames
+    del ds.PixelData
+    with open(path, "wb") as fp:
+        pydicom.dcmwrite(fp, ds, write_like_original=False)
+        length = frames * frame_size
+        # Explicit VR little endian header of (7FE0,0010) OW
+        fp.write(struct.pack("<HH2sHL", 0x7FE0, 0x0010, b"OW", 0, length))
+        chunk = os.urandom(CHUNK)
+        while length > 0:
+            fp.write(chunk[: min(CHUNK, length)])
+            length -= CHUNK
+
+
+def run_mode(mode: str, source: str, output: str) -> None:
+    """Anonymize the file in this process and print the measurements as JSON."""
+    from utilities.anonymization_core import anonymize_file
+    from utilities.anonymization_plan import AnonymizationPlan
+    from utilities.dummy_values import dummy_values
+
+    plan = AnonymizationPlan.compile(
+        [("PatientName", "Change with Dummy Value", ""), ("PatientID", "Delete", "")],
+        dummy_values(),
+    )
+    start = time.perf_counter()
+    anonymize_file(source, output, plan, "", stream_pixel_data=mode == "passthrough")
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "peak_mb": peak_kb / 1024}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument(
+        "--mode", choices=["full", "passthrough"], help=argparse.SUPPRESS
+    )
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.source, args.output)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "large.dcm")
+        build_large_file(source, args.size_mb)
+        size_mb = os.path.getsize(source) / 1024 / 1024
+        print(f"input file: {size_mb:.0f} MB")
+        for mode in ("full", "passthrough"):
+            output = os.path.join(tmp, f"{mode}.dcm")
+            result = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_pixel_passthrough"]
+                + ["--mode", mode, "--source", source, "--output", output],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            stats = json.loads(result.stdout)
+            print(
+                f"{mode:12s} {stats['seconds']:7.2f} s  "
+                f"{size_mb / stats['seconds']:8.1f} MB/s  "
+                f"peak RSS {stats['peak_mb']:8.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
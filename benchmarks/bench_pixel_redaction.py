@@ -0,0 +1,203 @@
+"""
+Measure the throughput of blanking burned-in text in multi-frame pixel data.
+
+A multi-frame RGB ultrasound file is synthesized from a DICOM_TEST sample,
+with a banner of text-like pixels at the top of every frame, and anonymized
+with a redaction rule matching its manufacturer, model and size:
+
+    passthrough  no redaction, the pixel data is copied from the source
+    stream       native pixel data redacted in chunks while it is copied
+    memory       native pixel data read completely and redacted in memory
+    rle          RLE Lossless pixel data decoded, redacted and encoded again
+
+Every run happens in a fresh process so that its peak resident memory can be
+reported, and the banner of the output of every redacting run is checked to be
+blank.
+
+Usage:
+    python -m benchmarks.bench_pixel_redaction --frames 2000 --rle-frames 50
+"""
+import argparse
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless
+
+from benchmarks.synthetic import sample_files
+
+MANUFACTURER = "ACME"
+MODEL = "US 1"
+ROWS, COLUMNS = 480, 640
+# Banner holding the burned-in patient name
+BANNER = (0, 0, COLUMNS, 40)
+MODES = ("passthrough", "stream", "memory", "rle")
+
+
+def build_ultrasound_file(path: str, frames: int, rle: bool = False) -> None:
+    """Write a multi-frame RGB file with a bright banner in every frame."""
+    ds = pydicom.dcmread(str(sample_files()[0]))
+    ds.Modality = "US"
+    ds.Manufacturer = MANUFACTURER
+    ds.ManufacturerModelName = MODEL
+    ds.Rows, ds.Columns = ROWS, COLUMNS
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = "RGB"
+    ds.PlanarConfiguration = 0
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.NumberOfFrames = frames
+    for keyword in ("WindowCenter", "WindowWidth", "SmallestImagePixelValue"):
+        if keyword in ds:
+            delattr(ds, keyword)
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 200, (ROWS, COLUMNS, 3), dtype=np.uint8)
+    x, y, width, height = BANNER
+    frame[y : y + height, x : x + width] = 255
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_implicit_VR, ds.is_little_endian = False, True
+    if rle:
+        ds.compress(RLELossless, np.stack([frame] * frames))
+        ds.save_as(path, write_like_original=False)
+        return
+    # Written a frame at a time, so this process stays small and does not
+    # inflate the peak memory of the processes it starts
+    del ds.PixelData
+    ds.save_as(path, write_like_original=False)
+    with open(path, "ab") as fp:
+        fp.write(
+            struct.pack("<HH2sHL", 0x7FE0, 0x0010, b"OB", 0, frame.nbytes * frames)
+        )
+        for _ in range(frames):
+            fp.write(frame.tobytes())
+
+
+def write_rules(path: str) -> None:
+    rule = {
+        "manufacturer": MANUFACTURER,
+        "model": MODEL,
+        "rows": ROWS,
+        "columns": COLUMNS,
+        "boxes": [list(BANNER)],
+    }
+    with open(path, "w") as fp:
+        json.dump([rule], fp)
+
+
+def run_mode(mode: str, source: str, output: str, rules: str) -> None:
+    """Anonymize the file in this process and print the measurements as JSON."""
+    from utilities.anonymization_core import anonymize_file
+    from utilities.anonymization_plan import AnonymizationPlan
+    from utilities.dummy_values import dummy_values
+    from utilities.pixel_redaction import RedactionRules
+
+    plan = AnonymizationPlan.compile(
+        [("PatientName", "Change with Dummy Value", ""), ("PatientID", "Delete", "")],
+        dummy_values(),
+        redaction=None if mode == "passthrough" else RedactionRules.read(rules),
+    )
+    start = time.perf_counter()
+    anonymize_file(source, output, plan, "", stream_pixel_data=mode != "memory")
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "peak_mb": peak_kb / 1024}))
+
+
+def banner_blanked(path: str) -> bool:
+    """Check that the banner is blank and the rest kept in the first and last frame."""
+    ds = pydicom.dcmread(path)
+    array = ds.pixel_array
+    x, y, width, height = BANNER
+    for frame in (array[0], array[-1]):
+        if frame[y : y + height, x : x + width].any():
+            return False
+        if not (frame[y + height :] < 255).all() or not frame[y + height :].any():
+            return False
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument(
+        "--rle-frames",
+        type=int,
+        default=20,
+        help="Frames of the RLE file, encoding it is slow.",
+    )
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    parser.add_argument("--rules", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.source, args.output, args.rules)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        rules = os.path.join(tmp, "rules.json")
+        write_rules(rules)
+        native = os.path.join(tmp, "native.dcm")
+        build_ultrasound_file(native, args.frames)
+        if "rle" in args.modes:
+            rle = os.path.join(tmp, "rle.dcm")
+            build_ultrasound_file(rle, args.rle_frames, rle=True)
+        frame_mb = ROWS * COLUMNS * 3 / 1024 / 1024
+        print(f"native file: {args.frames} frames, {args.frames * frame_mb:.0f} MB")
+        for mode in args.modes:
+            source = rle if mode == "rle" else native
+            frames = args.rle_frames if mode == "rle" else args.frames
+            output = os.path.join(tmp, f"{mode}.dcm")
+            result = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_pixel_redaction"]
+                + ["--mode", mode, "--source", source, "--output", output]
+                + ["--rules", rules],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            stats = json.loads(result.stdout)
+            results.append(
+                {
+                    "mode": mode,
+                    "frames": frames,
+                    "seconds": round(stats["seconds"], 3),
+                    "frames_per_second": round(frames / stats["seconds"], 1),
+                    "mb_per_second": round(frames * frame_mb / stats["seconds"], 1),
+                    "peak_mb": round(stats["peak_mb"], 1),
+                }
+            )
+            print(
+                f"{mode:12s} {stats['seconds']:7.2f} s  "
+                f"{frames / stats['seconds']:9.1f} frames/s  "
+                f"{frames * frame_mb / stats['seconds']:8.1f} MB/s  "
+                f"peak RSS {stats['peak_mb']:7.1f} MB"
+            )
+        # Checked after all runs, reading the outputs here would inflate the
+        # peak memory of the runs started afterwards
+        for result in results:
+            if result["mode"] != "passthrough":
+                output = os.path.join(tmp, f"{result['mode']}.dcm")
+                result["blanked"] = banner_blanked(output)
+                print(f"{result['mode']:12s} blanked={result['blanked']}")
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
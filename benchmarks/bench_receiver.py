@@ -0,0 +1,178 @@
+"""
+Measure the throughput of the C-STORE receiver under concurrent senders.
+
+A receiver is started on localhost with an "Auto Select"-like rule plan and
+the DICOM_TEST samples are sent to it by stand-in senders, each over its own
+association and in its own process, once per number of senders. Every instance
+gets a new SOP Instance UID, so every instance is written to its own file. With
+--forward the receiver also forwards every instance to a local sink node over
+pooled associations.
+
+Usage:
+    python -m benchmarks.bench_receiver --instances 2000 --senders 1 2 4
+    python -m benchmarks.bench_receiver --senders 4 --workers 2 --forward
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import pydicom
+from pydicom.uid import generate_uid
+from pynetdicom import AE, AllStoragePresentationContexts, evt
+
+from benchmarks.synthetic import SAMPLE_FOLDER, samples_of_modality
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dicom_receiver import AssociationPool, DicomReceiver, disable_nagle
+from utilities.dummy_values import dummy_values
+from utilities.scan_manifest import ScanManifest
+
+HOST = "127.0.0.1"
+SINK_AE_TITLE = "SINK"
+
+
+def auto_select_plan(manifest: ScanManifest) -> AnonymizationPlan:
+    """Same selection as the "Auto Select" button, without the tag table."""
+    rows = []
+    for _, tag_name, value in sorted(manifest.tags_set, key=lambda x: x[1]):
+        lower_name = tag_name.lower()
+        if any(key in lower_name for key in ("patient", "date", "id", "name")):
+            rows.append((tag_name, Action.CHANGE_DUMMY, value))
+    return AnonymizationPlan.compile(rows, dummy_values())
+
+
+# Samples loaded once per sender process by load_samples
+_datasets: List[pydicom.Dataset] = []
+
+
+def load_samples(samples: List[Path]) -> None:
+    _datasets.extend(pydicom.dcmread(str(path)) for path in samples)
+
+
+def send(count: int, port: int) -> int:
+    """Send ``count`` instances over one association, return the stored ones."""
+    datasets = _datasets
+    ae = AE()
+    contexts = {(ds.SOPClassUID, ds.file_meta.TransferSyntaxUID) for ds in datasets}
+    for sop_class, transfer_syntax in sorted(contexts):
+        ae.add_requested_context(sop_class, transfer_syntax)
+    assoc = ae.associate(HOST, port, evt_handlers=[(evt.EVT_CONN_OPEN, disable_nagle)])
+    if not assoc.is_established:
+        return 0
+    stored = 0
+    for i in range(count):
+        ds = datasets[i % len(datasets)]
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        status = assoc.send_c_store(ds)
+        stored += status.get("Status") == 0x0000
+    assoc.release()
+    return stored
+
+
+def start_sink(received: List[int]) -> Any:
+    """Start a node accepting every instance, counting them in ``received``."""
+
+    lock = threading.Lock()
+
+    def store(event):
+        with lock:
+            received[0] += 1
+        return 0x0000
+
+    ae = AE(ae_title=SINK_AE_TITLE)
+    ae.supported_contexts = AllStoragePresentationContexts
+    return ae.start_server(
+        (HOST, 0), block=False, evt_handlers=[(evt.EVT_C_STORE, store)]
+    )
+
+
+def run(
+    samples: List[Path],
+    plan: AnonymizationPlan,
+    instances: int,
+    senders: int,
+    workers: int,
+    forward: bool,
+) -> Dict[str, Any]:
+    """Send the instances with the given number of senders and time it."""
+    received = [0]
+    sink = start_sink(received) if forward else None
+    forward_pool = None
+    if sink is not None:
+        forward_pool = AssociationPool(SINK_AE_TITLE, HOST, sink.server_address[1])
+    with tempfile.TemporaryDirectory() as output_folder:
+        receiver = DicomReceiver(plan, "", output_folder, forward_pool, workers)
+        receiver.start(HOST, 0)
+        counts = [
+            instances // senders + (i < instances % senders) for i in range(senders)
+        ]
+        with ProcessPoolExecutor(
+            senders, initializer=load_samples, initargs=(samples,)
+        ) as senders_pool:
+            # Start the processes before timing the run
+            list(senders_pool.map(time.sleep, [0.1] * senders))
+            start = time.perf_counter()
+            futures = [senders_pool.submit(send, n, receiver.port) for n in counts]
+            stored = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+        receiver.stop()
+        written = len(os.listdir(output_folder))
+    if forward_pool is not None:
+        forward_pool.close()
+        sink.shutdown()
+    return {
+        "senders": senders,
+        "workers": workers,
+        "forward": forward,
+        "instances": instances,
+        "seconds": round(elapsed, 3),
+        "instances_per_second": round(instances / elapsed, 1),
+        "failed": instances - sum(stored),
+        "written": written,
+        "forwarded": received[0] if forward else None,
+    }
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--instances", type=int, default=1000)
+    parser.add_argument("--senders", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--modality", help="Only send samples of a modality.")
+    parser.add_argument(
+        "--forward",
+        action="store_true",
+        help="Also forward every instance to a local sink node.",
+    )
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    samples = samples_of_modality(args.modality)
+    plan = auto_select_plan(ScanManifest.build(str(SAMPLE_FOLDER)))
+
+    results = []
+    for senders in args.senders:
+        result = run(samples, plan, args.instances, senders, args.workers, args.forward)
+        results.append(result)
+        print(
+            f"senders={senders:3d}  workers={args.workers:3d}  "
+            f"{result['seconds']:8.2f} s  "
+            f"{result['instances_per_second']:8.1f} instances/s  "
+            f"failed={result['failed']}  written={result['written']}"
+            + (f"  forwarded={result['forwarded']}" if args.forward else "")
+        )
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Measure applying the tag table to deeply nested structured reports.
+
+Synthetic SR datasets nest content items ``--depth`` levels deep with
+``--fanout`` items per level, each item with a name, a date and a reference.
+Three ways of applying the same rules are compared: the previous top-level
+lookup, which misses every nested identifier, a separate recursive search per
+rule, and the single walk of AnonymizationPlan.apply. Finally a dataset
+nested DEEP_NESTING levels deep is walked, beyond the recursion limit.
+
+Usage:
+    python -m benchmarks.bench_sequence_walk --depth 8 --fanout 2 --repeat 20
+"""
+import argparse
+import copy
+import time
+
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dataset_walker import dataset_tags
+
+RULES = [
+    ("PersonName", Action.CHANGE_VALUE, "Anonymous"),
+    ("ObservationDateTime", Action.DELETE, ""),
+    ("ReferencedSOPInstanceUID", Action.CHANGE_VALUE, "1.2.3"),
+    ("PatientName", Action.CHANGE_VALUE, "Anonymous"),
+    ("PatientID", Action.CHANGE_VALUE, "0"),
+]
+
+# Nesting of the dataset walked to check for the recursion limit
+DEEP_NESTING = 2000
+
+
+def content_item(depth: int, fanout: int, counter: list) -> Dataset:
+    counter[0] += 1
+    item = Dataset()
+    item.RelationshipType = "CONTAINS"
+    item.ValueType = "CONTAINER" if depth else "PNAME"
+    item.PersonName = f"Observer^{counter[0]}"
+    item.ObservationDateTime = "20240101120000"
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+    reference.ReferencedSOPInstanceUID = f"1.2.826.0.1.3680043.8.498.{counter[0]}"
+    item.ReferencedSOPSequence = Sequence([reference])
+    if depth:
+        item.ContentSequence = Sequence(
+            [content_item(depth - 1, fanout, counter) for _ in range(fanout)]
+        )
+    return item
+
+
+def structured_report(depth: int, fanout: int) -> Dataset:
+    ds = Dataset()
+    ds.PatientName = "Doe^John"
+    ds.PatientID = "12345"
+    ds.ContentSequence = Sequence([content_item(depth, fanout, [0])])
+    return ds
+
+
+def top_level_apply(ds: Dataset, rules: dict) -> None:
+    """Previous approach: only the top-level elements are looked at."""
+    for tag in [tag for tag in ds.keys() if tag in rules]:
+        rule = rules[tag]
+        if rule.action is Action.DELETE:
+            del ds[tag]
+        else:
+            ds[tag].value = rule.value
+
+
+def per_rule_apply(ds: Dataset, rules: dict) -> None:
+    """A separate recursive search of the whole dataset for every rule."""
+
+    def find(dataset: Dataset, tag: int):
+        for elem in list(dataset):
+            if elem.tag == tag:
+                yield dataset
+            if elem.VR == "SQ":
+                for item in elem.value:
+                    yield from find(item, tag)
+
+    for tag, rule in rules.items():
+        for parent in list(find(ds, tag)):
+            if rule.action is Action.DELETE:
+                del parent[tag]
+            else:
+                parent[tag].value = rule.value
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    sample = structured_report(args.depth, args.fanout)
+    plan = AnonymizationPlan.compile(RULES, None)
+    n_elements = sum(1 for _ in sample.iterall())
+    print(
+        f"depth {args.depth}, fanout {args.fanout}: {n_elements} elements, "
+        f"{len(dataset_tags(sample))} distinct tags, {len(plan)} rules"
+    )
+
+    appliers = {
+        "top level": lambda ds: top_level_apply(ds, plan.rules),
+        "per rule": lambda ds: per_rule_apply(ds, plan.rules),
+        "single walk": plan.apply,
+    }
+    for name, apply in appliers.items():
+        datasets = [copy.deepcopy(sample) for _ in range(args.repeat)]
+        start = time.perf_counter()
+        for ds in datasets:
+            apply(ds)
+        per_file = (time.perf_counter() - start) / args.repeat
+        missed = sum(
+            1
+            for elem in datasets[0].iterall()
+            if elem.keyword == "PersonName" and elem.value != "Anonymous"
+        )
+        print(
+            f"{name:12s} {per_file * 1e3:8.2f} ms/file, "
+            f"{missed} nested names left unchanged"
+        )
+
+    deep = Dataset()
+    item = deep
+    for _ in range(DEEP_NESTING):
+        child = Dataset()
+        child.PersonName = "Observer^Deep"
+        item.ContentSequence = Sequence([child])
+        item = child
+    for name, walk in (
+        ("single walk", dataset_tags),
+        ("recursive", lambda ds: list(ds.iterall())),
+    ):
+        try:
+            walk(deep)
+            print(f"{name:12s} depth {DEEP_NESTING}: ok")
+        except RecursionError:
+            print(f"{name:12s} depth {DEEP_NESTING}: RecursionError")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Measure a sharded run, with local processes standing in for hosts.
+
+The DICOM_TEST samples are replicated into a tree of ``--files`` files spread
+over ``--studies`` studies of different sizes. The tree is then anonymized by
+the command line interface once in a single run, and once per number of
+shards: the studies are planned into shards, every shard is processed by its
+own process at the same time, and the shard outputs are merged. Every merged
+output is compared byte for byte with the output of the single run.
+
+Usage:
+    python -m benchmarks.bench_sharding --files 2000 --studies 40 --shards 1 2 4
+"""
+import argparse
+import configparser
+import filecmp
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.synthetic import REPO_ROOT, build_synthetic_tree
+from utilities.anonymization_plan import ACTION_COLUMNS, Action
+from utilities.run_index import INDEX_FILENAME
+
+PASSWORD = "benchmark"
+
+# Tags pseudonymized by the benchmark config, the same study must get the same
+# pseudonyms on every shard
+PSEUDONYMIZED_TAGS = (
+    "PatientID",
+    "PatientName",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+)
+
+
+def write_config(path: str) -> None:
+    columns = {action: column for column, action in ACTION_COLUMNS.items()}
+    config = configparser.ConfigParser(interpolation=None)
+    for tag in PSEUDONYMIZED_TAGS:
+        config[tag] = {"Action": str(columns[Action.PSEUDONYMIZE]), "Value": ""}
+    with open(path, "w") as fp:
+        config.write(fp)
+
+
+def cli(*args: str) -> List[str]:
+    return [sys.executable, str(REPO_ROOT / "DicomAnonymizerCLI.py"), *args]
+
+
+def run_cli(*args: str) -> Dict[str, Any]:
+    """Run the command line interface and return its JSON summary."""
+    result = subprocess.run(
+        cli(*args, "--summary-json", "-"), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout)
+
+
+def same_tree(left: str, right: str) -> bool:
+    """Check if two output folders hold the same files, apart from the index."""
+    for root, _, files in os.walk(left):
+        relative = os.path.relpath(root, left)
+        names = [name for name in files if name != INDEX_FILENAME]
+        _, mismatch, errors = filecmp.cmpfiles(
+            root, os.path.join(right, relative), names, shallow=False
+        )
+        if mismatch or errors:
+            return False
+    return sum(len(files) for _, _, files in os.walk(left)) == sum(
+        len(files) for _, _, files in os.walk(right)
+    )
+
+
+def run_sharded(
+    folder: str, output: str, config: str, shards: int, workers: int
+) -> Dict[str, Any]:
+    """Plan, process and merge the shards of a folder and time every step."""
+    manifest = folder + f"_{shards}_shards.json"
+    start = time.perf_counter()
+    plan = run_cli(folder, "--plan-shards", str(shards), "--shard-manifest", manifest)
+    planned = time.perf_counter()
+    processes = [
+        subprocess.Popen(
+            cli(
+                "--shard",
+                str(index),
+                "--shard-manifest",
+                manifest,
+                "-o",
+                output,
+                "-c",
+                config,
+                "-w",
+                str(workers),
+                "--password",
+                PASSWORD,
+                "--report",
+            ),
+            stdout=subprocess.DEVNULL,
+        )
+        for index in range(shards)
+    ]
+    if any(process.wait() != 0 for process in processes):
+        raise RuntimeError("A shard failed")
+    processed = time.perf_counter()
+    run_cli("--merge-shards", "--shard-manifest", manifest, "-o", output)
+    merged = time.perf_counter()
+    sizes = [shard["bytes"] for shard in plan["shards"]]
+    return {
+        "shards": shards,
+        "plan_seconds": round(planned - start, 3),
+        "process_seconds": round(processed - planned, 3),
+        "merge_seconds": round(merged - processed, 3),
+        "seconds": round(merged - start, 3),
+        # Largest shard relative to an even split, 1.0 is perfectly balanced
+        "imbalance": round(max(sizes) / (sum(sizes) / len(sizes)), 3),
+    }
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--studies", type=int, default=20)
+    parser.add_argument("--files-per-folder", type=int, default=25)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Worker processes of every run."
+    )
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, "input")
+        build_synthetic_tree(
+            folder, args.files, args.files_per_folder, studies=args.studies
+        )
+        config = os.path.join(tmp, "config.ini")
+        write_config(config)
+
+        reference = os.path.join(tmp, "single")
+        start = time.perf_counter()
+        run_cli(
+            folder,
+            "-o",
+            reference,
+            "-c",
+            config,
+            "-w",
+            str(args.workers),
+            "--password",
+            PASSWORD,
+        )
+        single = time.perf_counter() - start
+        print(f"single run          {single:8.2f} s")
+
+        for shards in args.shards:
+            output = os.path.join(tmp, f"sharded_{shards}")
+            result = run_sharded(folder, output, config, shards, args.workers)
+            result["identical"] = same_tree(reference, output)
+            result["speedup"] = round(single / result["seconds"], 2)
+            results.append(result)
+            print(
+                f"shards={shards:3d}  {result['seconds']:8.2f} s  "
+                f"(plan {result['plan_seconds']:.2f} s, "
+                f"process {result['process_seconds']:.2f} s, "
+                f"merge {result['merge_seconds']:.2f} s)  "
+                f"speedup {result['speedup']:.2f}x  "
+                f"imbalance {result['imbalance']:.3f}  "
+                f"identical={result['identical']}"
+            )
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({"single_seconds": round(single, 3), "runs": results}, fp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Measure how long the GUI takes to show its window, and the command line to start.
+
+Every measurement starts a fresh interpreter, as a user launching the
+application does:
+
+    gui  time until the first paint of the main window, split into the import
+         of DicomAnonymizer, the creation of the window and the first paint
+    cli  time until ``DicomAnonymizerCLI.py --help`` exits
+
+The modules loaded when the window is painted are checked as well: pydicom,
+numpy and cryptography are only needed once files are read or encrypted. Use
+``--top`` to list the slowest imports of the GUI as reported by
+``python -X importtime``.
+
+Usage:
+    python -m benchmarks.bench_startup --repeat 10 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.synthetic import REPO_ROOT
+
+# Modules which should not be loaded before the window is shown
+HEAVY_MODULES = ("pydicom", "numpy", "cryptography", "pynetdicom")
+
+# Run by every GUI measurement, prints the time of each step as JSON
+GUI_PROBE = """
+import json, sys, time
+import DicomAnonymizer
+from PyQt6.QtCore import QEvent, QObject, QTimer
+from PyQt6.QtWidgets import QApplication
+imported = time.time()
+app = QApplication([])
+window = DicomAnonymizer.DICOMAnonymizer()
+created = time.time()
+times = {}
+
+class FirstPaint(QObject):
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint and "painted" not in times:
+            times["painted"] = time.time()
+            QTimer.singleShot(0, app.quit)
+        return False
+
+first_paint = FirstPaint()
+window.installEventFilter(first_paint)
+window.show()
+QTimer.singleShot(10000, app.quit)
+app.exec()
+print(json.dumps({
+    "imported": imported,
+    "created": created,
+    "painted": times.get("painted"),
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (
+    HEAVY_MODULES,
+)
+
+
+def environment() -> Dict[str, str]:
+    env = dict(os.environ)
+    # Without a display the window is painted offscreen
+    if sys.platform.startswith("linux") and not env.get("DISPLAY"):
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return env
+
+
+def measure_gui() -> Dict[str, float]:
+    """Start the GUI once and return the seconds until every step."""
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, "-c", GUI_PROBE],
+        cwd=REPO_ROOT,
+        env=environment(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = json.loads(result.stdout.strip().splitlines()[-1])
+    if times["painted"] is None:
+        raise RuntimeError("The window was not painted")
+    return {
+        "import": times["imported"] - start,
+        "window": times["created"] - start,
+        "paint": times["painted"] - start,
+        "loaded": times["loaded"],
+    }
+
+
+def measure_cli() -> float:
+    """Run the command line with --help once and return its seconds."""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, str(REPO_ROOT / "DicomAnonymizerCLI.py"), "--help"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def slowest_imports(count: int) -> List[str]:
+    """List the imports of the GUI module with the most cumulative time."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import DicomAnonymizer"],
+        cwd=REPO_ROOT,
+        env=environment(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    rows.sort(reverse=True)
+    return [f"{us / 1000:8.1f} ms  {name}" for us, name in rows[:count]]
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--top", type=int, default=0, help="List the slowest imports of the GUI."
+    )
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    # The first start warms the file system cache and is not counted
+    measure_gui()
+    runs = [measure_gui() for _ in range(args.repeat)]
+    cli = [measure_cli() for _ in range(args.repeat)]
+
+    results = {
+        step: round(statistics.median(run[step] for run in runs), 3)
+        for step in ("import", "window", "paint")
+    }
+    results["cli"] = round(statistics.median(cli), 3)
+    results["loaded_at_paint"] = runs[-1]["loaded"]
+    print(
+        f"gui   import {results['import']:6.3f} s  window {results['window']:6.3f} s  "
+        f"first paint {results['paint']:6.3f} s  (median of {args.repeat})"
+    )
+    print(f"cli   --help {results['cli']:6.3f} s")
+    loaded = ", ".join(results["loaded_at_paint"]) or "none"
+    print(f"heavy modules loaded at first paint: {loaded}")
+    if args.top:
+        print("slowest imports of the GUI (cumulative):")
+        for line in slowest_imports(args.top):
+            print(f"  {line}")
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Measure load and filter latency of the tag table for many distinct tags.
+
+Compares the previous QTableWidget, which created a line edit, five radio
+buttons and a button group per row, with the TagTableModel shown through a
+QTableView. Filtering is timed per keystroke of a search text, including the
+repaint of the view.
+
+Usage:
+    python -m benchmarks.bench_tag_table --tags 1000 10000 20000
+"""
+import argparse
+import os
+import time
+from typing import List, Tuple
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtWidgets import (  # noqa: E402
+    QApplication,
+    QButtonGroup,
+    QHeaderView,
+    QLineEdit,
+    QRadioButton,
+    QTableView,
+    QTableWidget,
+    QTableWidgetItem,
+)
+
+from utilities.anonymization_plan import ACTION_COLUMNS  # noqa: E402
+from utilities.tag_table_model import (  # noqa: E402
+    HEADER_LABELS,
+    ActionDelegate,
+    TagFilterProxyModel,
+    TagTableModel,
+)
+
+SEARCH_TEXT = "tag0001"
+
+
+def synthetic_tags(count: int) -> List[Tuple[str, str, str]]:
+    """Distinct tags in the form shown by the tag table."""
+    return [
+        (f"(0009, {0x1000 + i:04x})", f"Tag{i:06d}", f"value {i}") for i in range(count)
+    ]
+
+
+def legacy_load(table: QTableWidget, tags) -> None:
+    """Previous implementation: one widget per editable cell."""
+    table.setRowCount(0)
+    for tag_flag, tag_name, value in tags:
+        row = table.rowCount()
+        table.insertRow(row)
+        table.setItem(row, 0, QTableWidgetItem(tag_flag))
+        table.setItem(row, 1, QTableWidgetItem(tag_name))
+        table.setCellWidget(row, 2, QLineEdit(value))
+        group = QButtonGroup(table)
+        for column in ACTION_COLUMNS:
+            radio = QRadioButton("")
+            group.addButton(radio)
+            table.setCellWidget(row, column, radio)
+        table.cellWidget(row, 3).setChecked(True)
+
+
+def legacy_filter(table: QTableWidget, search_name: str) -> None:
+    """Previous implementation: read the widgets of every row."""
+    for row in range(table.rowCount()):
+        table.item(row, 0).text().lower()
+        tag_name = table.item(row, 1).text().lower()
+        table.cellWidget(row, 2).text().lower()
+        table.setRowHidden(row, search_name not in tag_name)
+
+
+def time_keystrokes(app: QApplication, apply_filter) -> float:
+    """Average seconds per keystroke of SEARCH_TEXT, then clear the filter."""
+    start = time.perf_counter()
+    for end in range(1, len(SEARCH_TEXT) + 1):
+        apply_filter(SEARCH_TEXT[:end])
+        app.processEvents()
+    elapsed = (time.perf_counter() - start) / len(SEARCH_TEXT)
+    apply_filter("")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tags", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=10000,
+        help="Skip the legacy table above this many tags.",
+    )
+    args = parser.parse_args()
+
+    app = QApplication([])
+    print(f"{'tags':>7s} {'table':8s} {'load':>10s} {'filter/key':>12s}")
+    for count in args.tags:
+        tags = synthetic_tags(count)
+
+        model = TagTableModel()
+        proxy = TagFilterProxyModel()
+        proxy.setSourceModel(model)
+        view = QTableView()
+        view.setModel(proxy)
+        view.setWordWrap(False)
+        view.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        delegate = ActionDelegate(view)
+        for column in ACTION_COLUMNS:
+            view.setItemDelegateForColumn(column, delegate)
+        view.show()
+        start = time.perf_counter()
+        model.set_tags(tags)
+        app.processEvents()
+        load = time.perf_counter() - start
+        key = time_keystrokes(app, lambda text: proxy.set_filters("", text, ""))
+        print(f"{count:7d} {'model':8s} {load * 1e3:8.1f} ms {key * 1e3:10.2f} ms")
+        view.close()
+
+        if count > args.legacy_max:
+            continue
+        table = QTableWidget(0, len(HEADER_LABELS))
+        table.setHorizontalHeaderLabels(HEADER_LABELS)
+        table.show()
+        start = time.perf_counter()
+        legacy_load(table, tags)
+        app.processEvents()
+        load = time.perf_counter() - start
+        key = time_keystrokes(app, lambda text: legacy_filter(table, text))
+        print(f"{count:7d} {'widgets':8s} {load * 1e3:8.1f} ms {key * 1e3:10.2f} ms")
+        table.close()
+        table.deleteLater()
+        app.processEvents()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Measure the cost and memory of remapping UIDs.
+
+Remapping is timed per file on the DICOM_TEST samples, read before the timing
+starts, against a plan without remapping. The memory of the mapping itself is
+measured for many distinct UIDs, comparing a dict from every original UID to
+its replacement, as a prebuilt index would need, with the bounded pseudonym
+cache which derives replacements from the UIDs themselves.
+
+Usage:
+    python -m benchmarks.bench_uid_remap --files 500 --uids 1000000
+"""
+import argparse
+import copy
+import time
+import tracemalloc
+
+import pydicom
+
+from benchmarks.synthetic import sample_files
+from utilities.anonymization_plan import AnonymizationPlan
+from utilities.pseudonymizer import Pseudonymizer
+
+SECRET = b"benchmark" * 4
+
+
+def synthetic_uid(i: int) -> str:
+    return f"1.2.826.0.1.3680043.8.498.{i}.{i * 7919 % 1000003}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--uids", type=int, default=1000000)
+    args = parser.parse_args()
+
+    samples = [pydicom.dcmread(str(path)) for path in sample_files()]
+    plans = {
+        "no remap": AnonymizationPlan.compile([], None),
+        "remap": AnonymizationPlan.compile([], None, Pseudonymizer(SECRET), True),
+    }
+    for name, plan in plans.items():
+        datasets = [copy.deepcopy(samples[i % len(samples)]) for i in range(args.files)]
+        start = time.perf_counter()
+        for ds in datasets:
+            plan.apply(ds)
+        per_file = (time.perf_counter() - start) / args.files
+        print(f"{name:10s} {per_file * 1e6:10.1f} us/file")
+
+    uids = [synthetic_uid(i) for i in range(args.uids)]
+    pseudonymizer = Pseudonymizer(SECRET)
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = {uid: pseudonymizer.pseudonymize(uid, "UI") for uid in uids}
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"full index {len(index)} UIDs in {elapsed:6.2f} s, "
+        f"peak {peak / 1024 / 1024:8.1f} MB"
+    )
+    del index
+
+    pseudonymizer = Pseudonymizer(SECRET)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for uid in uids:
+        pseudonymizer.pseudonymize(uid, "UI")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"bounded    {len(uids)} UIDs in {elapsed:6.2f} s, "
+        f"peak {peak / 1024 / 1024:8.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
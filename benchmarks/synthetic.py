@@ -0,0 +1,157 @@
+import os
+import random
+import shutil
+from pathlib import Path
+from typing import List, Optional
+
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SAMPLE_FOLDER = REPO_ROOT / "DICOM_TEST"
+
+
+def sample_files(folder: Path = SAMPLE_FOLDER) -> List[Path]:
+    """
+    List the sample DICOM files shipped with the repository.
+
+    Parameters:
+        folder (Path, optional): Folder with sample files. Defaults to DICOM_TEST.
+
+    Returns:
+        List[Path]: Sorted list of sample files.
+    """
+    return sorted(path for path in folder.rglob("*") if path.is_file())
+
+
+def samples_of_modality(modality: Optional[str] = None) -> List[Path]:
+    """
+    List the sample files of a modality.
+
+    Parameters:
+        modality (Optional[str], optional): Modality such as "MR" or "SR".
+            Defaults to all samples.
+
+    Returns:
+        List[Path]: Sorted list of sample files.
+
+    Raises:
+        ValueError: If no sample has the modality.
+    """
+    samples = sample_files()
+    if modality is None:
+        return samples
+    samples = [
+        path
+        for path in samples
+        if pydicom.dcmread(str(path), stop_before_pixels=True).get("Modality")
+        == modality
+    ]
+    if not samples:
+        raise ValueError(f"No sample file with modality {modality}")
+    return samples
+
+
+def nested_identifiers(depth: int, idx: int) -> Dataset:
+    """
+    Create a chain of sequence items holding identifiers, ``depth`` levels deep.
+
+    Parameters:
+        depth (int): Number of nested levels, at least 1.
+        idx (int): Number of the file, used in the values.
+
+    Returns:
+        Dataset: The outermost item.
+    """
+    outer = item = Dataset()
+    for level in range(depth):
+        item.PatientID = f"NESTED{idx:07d}"
+        item.PersonName = f"Referring^Physician{level}"
+        item.StudyDate = "20240101"
+        item.ReferencedSOPInstanceUID = f"1.2.826.0.1.3680043.8.498.{idx}.{level}"
+        if level + 1 < depth:
+            child = Dataset()
+            item.ContentSequence = Sequence([child])
+            item = child
+    return outer
+
+
+def build_synthetic_tree(
+    target: str,
+    n_files: int,
+    files_per_folder: int = 100,
+    junk_ratio: float = 0.0,
+    preambleless_ratio: float = 0.0,
+    seed: Optional[int] = 0,
+    modality: Optional[str] = None,
+    nesting: int = 0,
+    studies: int = 0,
+) -> Path:
+    """
+    Build a tree of DICOM files by replicating the DICOM_TEST samples.
+
+    Parameters:
+        target (str): Folder to create the tree in.
+        n_files (int): Number of DICOM files to create.
+        files_per_folder (int, optional): Files per leaf folder. Defaults to 100.
+        junk_ratio (float, optional): Number of non-DICOM files to add, as a
+            fraction of n_files. Defaults to 0.
+        preambleless_ratio (float, optional): Fraction of the DICOM files that
+            are written without the 128-byte preamble and "DICM" magic.
+            Defaults to 0.
+        seed (Optional[int], optional): Seed for the random generator. Defaults to 0.
+        modality (Optional[str], optional): Only replicate samples of this
+            modality. Defaults to all samples.
+        nesting (int, optional): Add a ReferencedPatientSequence with
+            identifiers nested this many levels deep to every file. The files
+            are then written by pydicom instead of being copied. Defaults to 0.
+        studies (int, optional): Spread the leaf folders randomly over this
+            many studies, each with its own StudyInstanceUID, so studies differ
+            in size. The files are then written by pydicom instead of being
+            copied. Defaults to 0, the UIDs of the samples.
+
+    Returns:
+        Path: Root of the created tree.
+    """
+    rng = random.Random(seed)
+    samples = samples_of_modality(modality)
+    root = Path(target)
+    study_uids = [
+        generate_uid(entropy_srcs=[str(seed), str(study)]) for study in range(studies)
+    ]
+    folder_study = {}
+    for idx in range(n_files):
+        folder_idx = idx // files_per_folder
+        folder = root / f"series_{folder_idx:05d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        source = samples[idx % len(samples)]
+        destination = folder / f"IM{idx:07d}"
+        if nesting or studies:
+            ds = pydicom.dcmread(str(source))
+            if nesting:
+                ds.ReferencedPatientSequence = Sequence(
+                    [nested_identifiers(nesting, idx)]
+                )
+            if studies:
+                if folder_idx not in folder_study:
+                    folder_study[folder_idx] = rng.choice(study_uids)
+                ds.StudyInstanceUID = folder_study[folder_idx]
+            ds.save_as(str(destination))
+            source = destination
+        if rng.random() < preambleless_ratio:
+            with open(source, "rb") as src:
+                src.seek(132)
+                data = src.read()
+            with open(destination, "wb") as dst:
+                dst.write(data)
+        elif source != destination:
+            shutil.copyfile(source, destination)
+
+    for idx in range(int(n_files * junk_ratio)):
+        folder = root / f"series_{idx // files_per_folder:05d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        with open(folder / f"notes_{idx:07d}.txt", "wb") as fp:
+            fp.write(os.urandom(rng.randint(16, 4096)))
+    return root
@@ -0,0 +1,81 @@
+"""Large archive members are spooled to disk instead of read into memory."""
+import os
+import tarfile
+import zipfile
+
+import pydicom
+import pytest
+
+from benchmarks.synthetic import sample_files
+from utilities import archive_io
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.archive_io import anonymize_archive
+from utilities.dummy_values import dummy_values
+from utilities.quarantine import Quarantine
+from utilities.scan_manifest import ScanManifest
+
+
+def write_archive(path, samples):
+    """Write the samples, a text file and a broken DICOM file to an archive."""
+    broken = samples[0].read_bytes()[:140]
+    members = [(f"dicom/{sample.name}", sample.read_bytes()) for sample in samples]
+    members += [("README.txt", b"not a DICOM file"), ("dicom/broken", broken)]
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path, "w") as archive:
+            for name, data in members:
+                archive.writestr(name, data)
+    else:
+        with tarfile.open(path, "w") as archive:
+            for name, data in members:
+                (path.parent / "member").write_bytes(data)
+                archive.add(path.parent / "member", name)
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".tar"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_spooled_members(tmp_path, monkeypatch, suffix, workers):
+    samples = sample_files()[:6]
+    # Every member is spooled, and at most two are in flight
+    monkeypatch.setattr(archive_io, "SPOOL_THRESHOLD", 100)
+    monkeypatch.setattr(archive_io, "IN_FLIGHT_BYTES", 200)
+    archive = tmp_path / f"input{suffix}"
+    write_archive(archive, samples)
+    output = tmp_path / f"output{suffix}"
+    plan = AnonymizationPlan.compile(
+        [("PatientName", Action.CHANGE_VALUE, "ANONYMOUS")], dummy_values()
+    )
+
+    manifest = ScanManifest.build_archive(str(archive))
+    assert len(manifest) + len(manifest.errors) == len(samples) + 1
+    assert manifest.not_dicom == [os.path.join(str(archive), "README.txt")]
+    quarantine = Quarantine(str(archive), str(tmp_path / "quarantine"))
+    with quarantine:
+        failures = anonymize_archive(
+            str(archive),
+            str(output),
+            plan,
+            "",
+            workers,
+            error_callback=quarantine.add,
+        )
+
+    assert [path for path, _ in failures] == [
+        os.path.join(str(archive), "dicom/broken")
+    ]
+    assert (tmp_path / "quarantine" / "dicom" / "broken").read_bytes() == (
+        samples[0].read_bytes()[:140]
+    )
+    extracted = tmp_path / "extracted"
+    if suffix == ".zip":
+        zipfile.ZipFile(output).extractall(extracted)
+    else:
+        tarfile.open(output).extractall(extracted)
+    for sample in samples:
+        ds = pydicom.dcmread(str(extracted / "dicom" / sample.name))
+        assert ds.PatientName == "ANONYMOUS"
+        assert ds.PixelData == pydicom.dcmread(str(sample)).PixelData
+    # The temporary files of the spooled members are removed
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        ["extracted", "quarantine", f"input{suffix}", f"output{suffix}"]
+        + (["member"] if suffix == ".tar" else [])
+    )
@@ -0,0 +1,50 @@
+"""Instance UIDs set to a dummy value keep every instance, series and study apart."""
+import pickle
+
+import pydicom
+import pytest
+
+from benchmarks.synthetic import sample_files
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dummy_values import DUMMY_UID, dummy_values
+from utilities.pseudonymizer import Pseudonymizer
+
+ROWS = [
+    (keyword, Action.CHANGE_DUMMY, "")
+    for keyword in ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID")
+]
+
+
+def series_samples():
+    """Two files of the same series."""
+    by_series = {}
+    for path in sample_files():
+        ds = pydicom.dcmread(str(path), stop_before_pixels=True)
+        by_series.setdefault(ds.SeriesInstanceUID, []).append(ds)
+        if len(by_series[ds.SeriesInstanceUID]) == 2:
+            return by_series[ds.SeriesInstanceUID]
+    raise AssertionError("No series with two files")
+
+
+@pytest.mark.parametrize("password", [False, True])
+def test_dummy_instance_uids(password):
+    pseudonymizer = Pseudonymizer(b"secret") if password else None
+    plan = AnonymizationPlan.compile(ROWS, dummy_values(), pseudonymizer)
+    first, second = series_samples()
+    original = first.SOPInstanceUID, first.SeriesInstanceUID, first.StudyInstanceUID
+
+    # A worker process gets a pickled copy of the plan
+    plan.apply(first)
+    pickle.loads(pickle.dumps(plan)).apply(second)
+
+    assert first.SOPInstanceUID != second.SOPInstanceUID
+    assert first.SeriesInstanceUID == second.SeriesInstanceUID
+    assert first.StudyInstanceUID == second.StudyInstanceUID
+    changed = first.SOPInstanceUID, first.SeriesInstanceUID, first.StudyInstanceUID
+    assert not set(changed) & set(original)
+    assert DUMMY_UID not in changed
+    # Only the same password gives the same UIDs in another run
+    other = AnonymizationPlan.compile(ROWS, dummy_values(), pseudonymizer)
+    ds = series_samples()[0]
+    other.apply(ds)
+    assert (ds.SOPInstanceUID == first.SOPInstanceUID) is password
@@ -0,0 +1,33 @@
+"""The file meta information must not keep the original SOP Instance UID."""
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dummy_values import dummy_values
+from utilities.pseudonymizer import Pseudonymizer
+
+
+@pytest.mark.parametrize("remap_uids", [False, True])
+@pytest.mark.parametrize(
+    "action",
+    [Action.CHANGE_DUMMY, Action.DELETE, Action.ENCRYPT, Action.PSEUDONYMIZE],
+)
+def test_media_storage_uid_follows_sop_instance_uid(action, remap_uids):
+    ds = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    original = ds.SOPInstanceUID
+    pseudonymizer = None
+    if action is Action.PSEUDONYMIZE or remap_uids:
+        pseudonymizer = Pseudonymizer(b"secret")
+    plan = AnonymizationPlan.compile(
+        [("SOPInstanceUID", action, "")], dummy_values(), pseudonymizer, remap_uids
+    )
+
+    plan.apply(ds)
+
+    media_storage_uid = ds.file_meta.MediaStorageSOPInstanceUID
+    assert media_storage_uid and media_storage_uid != original
+    if "SOPInstanceUID" in ds:
+        assert media_storage_uid == ds.SOPInstanceUID
+    elif pseudonymizer is not None:
+        assert media_storage_uid == pseudonymizer.pseudonymize(original, "UI")
@@ -0,0 +1,41 @@
+"""Redaction of the float pixel data elements, which are always read completely."""
+import numpy as np
+import pydicom
+import pytest
+
+from benchmarks.synthetic import sample_files
+from utilities.anonymization_core import anonymize_file
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dummy_values import dummy_values
+from utilities.pixel_redaction import RedactionRule, RedactionRules
+
+BOX = (2, 3, 10, 5)
+
+
+@pytest.mark.parametrize(
+    "keyword, VR, dtype",
+    [("FloatPixelData", "OF", np.float32), ("DoubleFloatPixelData", "OD", np.float64)],
+)
+def test_redact_float_pixel_data(tmp_path, keyword, VR, dtype):
+    ds = pydicom.dcmread(str(sample_files()[0]))
+    del ds.PixelData
+    ds.BitsAllocated = np.dtype(dtype).itemsize * 8
+    pixels = np.full((ds.Rows, ds.Columns), 1.5, dtype)
+    setattr(ds, keyword, pixels.tobytes())
+    ds[keyword].VR = VR
+    source, output = str(tmp_path / "source.dcm"), str(tmp_path / "output.dcm")
+    ds.save_as(source)
+
+    plan = AnonymizationPlan.compile(
+        [("PatientID", Action.DELETE, "")],
+        dummy_values(),
+        redaction=RedactionRules([RedactionRule(boxes=(BOX,), fill=-1)]),
+    )
+    anonymize_file(source, output, plan, "")
+
+    result = np.frombuffer(pydicom.dcmread(output)[keyword].value, dtype)
+    result = result.reshape(ds.Rows, ds.Columns)
+    x, y, width, height = BOX
+    expected = pixels.copy()
+    expected[y : y + height, x : x + width] = -1
+    assert (result == expected).all()
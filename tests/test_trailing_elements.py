@@ -0,0 +1,77 @@
+"""Elements stored after the pixel data, which header-only reads do not see."""
+import pydicom
+import pytest
+from pydicom.uid import RLELossless
+
+from benchmarks.synthetic import sample_files
+from utilities.anonymization_core import anonymize_file, read_source
+from utilities.anonymization_plan import Action, AnonymizationPlan
+from utilities.dummy_values import dummy_values
+from utilities.helper_function import get_tags
+from utilities.scan_manifest import ScanManifest
+
+SECRET = b"SECRET\x00\x00"
+TRAILING_PADDING = 0xFFFCFFFC
+
+
+def write_with_trailing_elements(path, rle=False):
+    ds = pydicom.dcmread(str(sample_files()[0]))
+    if rle:
+        ds.compress(RLELossless)
+    ds.add_new(TRAILING_PADDING, "OB", SECRET)
+    ds.save_as(str(path))
+    return str(path)
+
+
+def compile_plan(*rows):
+    return AnonymizationPlan.compile(list(rows), dummy_values())
+
+
+@pytest.mark.parametrize("rle", [False, True])
+def test_delete_rule_on_trailing_element(tmp_path, rle):
+    source = write_with_trailing_elements(tmp_path / "source.dcm", rle)
+    output = str(tmp_path / "output.dcm")
+    plan = compile_plan(("DataSetTrailingPadding", Action.DELETE, ""))
+
+    _, pixel_info = read_source(source, True, plan.rules)
+    assert pixel_info is None
+
+    anonymize_file(source, output, plan, "")
+    with open(output, "rb") as fp:
+        assert SECRET not in fp.read()
+    ds = pydicom.dcmread(output)
+    assert TRAILING_PADDING not in ds
+    assert ds.PixelData == pydicom.dcmread(source).PixelData
+
+
+def test_untouched_trailing_elements_are_streamed(tmp_path):
+    source = write_with_trailing_elements(tmp_path / "source.dcm")
+    output = str(tmp_path / "output.dcm")
+    plan = compile_plan(("PatientID", Action.DELETE, ""))
+
+    _, pixel_info = read_source(source, True, plan.rules)
+    assert pixel_info is not None
+
+    anonymize_file(source, output, plan, "")
+    ds = pydicom.dcmread(output)
+    assert "PatientID" not in ds
+    assert ds[TRAILING_PADDING].value == SECRET
+
+
+def test_remapped_uids_read_trailing_elements(tmp_path):
+    source = write_with_trailing_elements(tmp_path / "source.dcm")
+    _, pixel_info = read_source(source, True, {}, remap_uids=True)
+    assert pixel_info is None
+
+
+def test_scan_lists_trailing_elements(tmp_path):
+    write_with_trailing_elements(tmp_path / "plain.dcm")
+    write_with_trailing_elements(tmp_path / "rle.dcm", rle=True)
+    manifest = ScanManifest.build(str(tmp_path), 10)
+
+    assert len(manifest) == 2
+    for entry in manifest:
+        assert TRAILING_PADDING in entry.tags
+    assert ("(fffc, fffc)", "DataSetTrailingPadding") in {
+        tag[:2] for tag in get_tags(str(tmp_path))
+    }
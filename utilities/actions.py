@@ -0,0 +1,26 @@
+from enum import Enum
+
+
+# Actions of the tag table. This module imports neither pydicom nor Qt, so the
+# GUI can show its window before pydicom is loaded.
+class Action(str, Enum):
+    """Action selected for a tag in the tag table."""
+
+    UNCHANGED = "Unchanged"
+    CHANGE_DUMMY = "Change with Dummy Value"
+    CHANGE_VALUE = "Change with Value"
+    DELETE = "Delete"
+    ENCRYPT = "Encrypt"
+    PSEUDONYMIZE = "Pseudonymize"
+
+
+# Column of the tag table holding the radio button of each action. The column
+# number is what config.ini stores for a tag.
+ACTION_COLUMNS = {
+    3: Action.UNCHANGED,
+    4: Action.CHANGE_VALUE,
+    5: Action.CHANGE_DUMMY,
+    6: Action.DELETE,
+    7: Action.ENCRYPT,
+    8: Action.PSEUDONYMIZE,
+}
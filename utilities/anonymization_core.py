@@ -0,0 +1,281 @@
+import os
+from typing import Container, List, Optional, Tuple, Union
+
+import pydicom
+from pydicom.dataelem import DataElement, RawDataElement
+
+from utilities.anonymization_plan import AnonymizationPlan
+from utilities.dataset_walker import dataset_tags
+from utilities.encryption_manager import (
+    LEGACY_PAYLOAD_VERSION,
+    EncryptionKey,
+    decrypt,
+    decrypt_payload,
+    encrypt_payload,
+    payload_version,
+)
+from utilities.helper_function import (
+    PIXEL_DATA_TAGS,
+    PixelDataInfo,
+    atomic_output,
+    read_dicom_header,
+    read_trailing_elements,
+)
+from utilities.payload_codec import (
+    decode_elements,
+    decode_legacy_elements,
+    encode_elements,
+)
+from utilities.pixel_passthrough import can_pass_through, write_with_pixel_passthrough
+from utilities.pixel_redaction import (
+    PixelRedaction,
+    RedactionRules,
+    can_stream,
+)
+from utilities.run_metrics import NO_METRICS, RunMetrics
+
+# Private tag holding the encrypted values of all tags set to "Encrypt"
+ENCRYPTED_DATA_TAG = (0x0019, 0x0101)
+
+
+def get_output_path(dcm_file: str, folder: str, output_folder: str) -> str:
+    """
+    Get the path a processed file is written to.
+
+    The file keeps its position relative to the input folder.
+
+    Parameters:
+        dcm_file (str): Path of the source file.
+        folder (str): Input folder.
+        output_folder (str): Output folder.
+
+    Returns:
+        str: Path of the output file.
+    """
+    return os.path.join(output_folder, os.path.relpath(dcm_file, folder))
+
+
+def encrypt_elements(
+    elements: List[Union[DataElement, RawDataElement]],
+    ds: pydicom.Dataset,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+) -> bytes:
+    """
+    Encode and encrypt the elements of a file set to "Encrypt".
+
+    Parameters:
+        elements (List[Union[DataElement, RawDataElement]]): Elements removed
+            from the dataset.
+        ds (pydicom.Dataset): Dataset the elements were removed from.
+        password (str): Password used for encryption.
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key for this file only.
+
+    Returns:
+        bytes: Value of the ENCRYPTED_DATA_TAG element.
+    """
+    return encrypt_payload(encode_elements(elements, ds), password, key)
+
+
+def decrypt_elements(
+    value: bytes, password: str, key: Optional[EncryptionKey] = None
+) -> List[DataElement]:
+    """
+    Decrypt the elements stored in the ENCRYPTED_DATA_TAG element.
+
+    Both the binary payloads and the hex encoded JSON payloads of earlier
+    versions are supported.
+
+    Parameters:
+        value (bytes): Value of the ENCRYPTED_DATA_TAG element.
+        password (str): Password used for encryption.
+        key (Optional[EncryptionKey], optional): Key derived beforehand, used
+            if the payload has its salt. Defaults to a cached or new key.
+
+    Returns:
+        List[DataElement]: The elements to restore.
+    """
+    if payload_version(value) == LEGACY_PAYLOAD_VERSION:
+        return decode_legacy_elements(decrypt(value.decode(), password, key))
+    return decode_elements(decrypt_payload(value, password, key))
+
+
+def read_source(
+    dcm_file: str,
+    stream_pixel_data: bool = True,
+    changed_tags: Container[int] = (),
+    redaction: Optional[RedactionRules] = None,
+    remap_uids: bool = False,
+) -> Tuple[pydicom.Dataset, Optional[PixelDataInfo]]:
+    """
+    Read a source file for writing a modified copy of it.
+
+    Parameters:
+        dcm_file (str): Path of the source file.
+        stream_pixel_data (bool, optional): Only read the header, so that the
+            pixel data can be copied from the source file in chunks. Falls back
+            to reading the whole file if the pixel data is one of the changed
+            tags or can not be copied, or if elements stored after the pixel
+            data are changed. Defaults to True.
+        changed_tags (Container[int], optional): Tags which will be changed.
+            Defaults to none.
+        redaction (Optional[RedactionRules], optional): Rules for the pixel
+            data. A file whose pixel data is redacted is read completely unless
+            its pixel data can be redacted while it is copied. Defaults to None.
+        remap_uids (bool, optional): True if the UIDs of the file are remapped.
+            Defaults to False.
+
+    Returns:
+        Tuple[pydicom.Dataset, Optional[PixelDataInfo]]: The dataset and the
+            location of the pixel data to copy, None if the dataset was read
+            completely.
+    """
+    if stream_pixel_data:
+        ds, pixel_info = read_dicom_header(dcm_file)
+        if pixel_info is None or (
+            pixel_info.tag not in changed_tags
+            and can_pass_through(ds, pixel_info)
+            and (
+                redaction is None
+                or can_stream(ds, pixel_info)
+                or redaction.match(ds) is None
+            )
+            and not _changes_trailing_elements(
+                dcm_file, ds, pixel_info, changed_tags, remap_uids
+            )
+        ):
+            return ds, pixel_info
+    return pydicom.dcmread(dcm_file, force=True), None
+
+
+def _changes_trailing_elements(
+    dcm_file: str,
+    ds: pydicom.Dataset,
+    pixel_info: PixelDataInfo,
+    changed_tags: Container[int],
+    remap_uids: bool,
+) -> bool:
+    """Check if the elements after the pixel data, copied unread, would change."""
+    try:
+        trailing = read_trailing_elements(dcm_file, ds, pixel_info)
+    except ValueError:
+        # Whatever follows the pixel data is left to the complete read
+        return True
+    if not len(trailing):
+        return False
+    return remap_uids or any(tag in changed_tags for tag in dataset_tags(trailing))
+
+
+def write_output(
+    ds: pydicom.Dataset,
+    pixel_info: Optional[PixelDataInfo],
+    dcm_file: str,
+    output_filepath: str,
+    redaction: Optional[PixelRedaction] = None,
+) -> None:
+    """
+    Write a dataset read by read_source.
+
+    The output file only appears once it is completely written.
+
+    Parameters:
+        ds (pydicom.Dataset): The modified dataset.
+        pixel_info (Optional[PixelDataInfo]): Location of the pixel data to copy
+            as returned by read_source.
+        dcm_file (str): Path of the source file.
+        output_filepath (str): Path of the output file.
+        redaction (Optional[PixelRedaction], optional): Redaction of the
+            pixel data to copy, as returned by anonymize_dataset.
+            Defaults to None.
+    """
+    with atomic_output(output_filepath) as partial_filepath:
+        if pixel_info is not None and redaction is not None:
+            redaction.write(ds, pixel_info, dcm_file, partial_filepath)
+        elif pixel_info is not None:
+            write_with_pixel_passthrough(ds, pixel_info, dcm_file, partial_filepath)
+        else:
+            ds.save_as(partial_filepath)
+
+
+def anonymize_dataset(
+    ds: pydicom.Dataset,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> Optional[PixelRedaction]:
+    """
+    Apply a plan to a dataset and store its encrypted elements in it.
+
+    The pixel data is redacted first, as the redaction rules match the
+    original header. Pixel data which was not read is redacted while writing.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset to anonymize.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key for this dataset only.
+        metrics (Optional[RunMetrics], optional): Metrics the time of the
+            redact, transform and encrypt stages is added to. Defaults to None.
+
+    Returns:
+        Optional[PixelRedaction]: Redaction of pixel data which was not read,
+            to be passed to write_output.
+    """
+    stages = NO_METRICS if metrics is None else metrics
+    redaction = None
+    if plan.redaction is not None:
+        redaction = plan.redaction.match(ds)
+        if redaction is not None and any(tag in ds for tag in PIXEL_DATA_TAGS):
+            with stages.stage("redact"):
+                redaction.apply(ds)
+            redaction = None
+    with stages.stage("transform"):
+        encrypted_elements = plan.apply(ds, metrics)
+    if encrypted_elements:
+        with stages.stage("encrypt"):
+            encrypted_data = encrypt_elements(encrypted_elements, ds, password, key)
+            ds.add_new(ENCRYPTED_DATA_TAG, "OB", encrypted_data)
+    return redaction
+
+
+def anonymize_file(
+    dcm_file: str,
+    output_filepath: str,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+    stream_pixel_data: bool = True,
+    metrics: Optional[RunMetrics] = None,
+) -> None:
+    """
+    Read, anonymize and write a single DICOM file.
+
+    The output file only appears once it is completely written.
+
+    Parameters:
+        dcm_file (str): Path of the source file.
+        output_filepath (str): Path of the output file.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key for this file only.
+        stream_pixel_data (bool, optional): Only read the header and copy the
+            pixel data from the source file in chunks. Falls back to reading the
+            whole file if the pixel data itself has a rule or can not be copied.
+            Defaults to True.
+        metrics (Optional[RunMetrics], optional): Metrics the time per stage
+            and the counters of the file are added to. Defaults to None.
+    """
+    stages = NO_METRICS if metrics is None else metrics
+    with stages.stage("read"):
+        ds, pixel_info = read_source(
+            dcm_file, stream_pixel_data, plan.rules, plan.redaction, plan.remap_uids
+        )
+    redaction = anonymize_dataset(ds, plan, password, key, metrics)
+    with stages.stage("write"):
+        write_output(ds, pixel_info, dcm_file, output_filepath, redaction)
+    if metrics is not None:
+        metrics.count_file(dcm_file, output_filepath)
@@ -0,0 +1,281 @@
+import hashlib
+import hmac
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+import pydicom
+from pydicom.datadict import dictionary_VR
+from pydicom.dataelem import DataElement, RawDataElement
+from pydicom.uid import generate_uid
+
+from utilities.actions import ACTION_COLUMNS, Action
+from utilities.dataset_walker import (
+    SequencePath,
+    element_VR,
+    iter_elements,
+    tag_for_keyword,
+)
+from utilities.dummy_values import DummyValues
+from utilities.pixel_redaction import RedactionRules
+from utilities.pseudonymizer import Pseudonymizer, is_instance_uid_tag
+from utilities.run_metrics import RunMetrics
+
+SOP_INSTANCE_UID = 0x00080018
+MEDIA_STORAGE_SOP_INSTANCE_UID = 0x00020003
+
+
+def is_dummy_uid_tag(tag: int) -> bool:
+    """
+    Check if a tag set to "Change with Dummy Value" gets a new UID per value.
+
+    A single dummy UID shared by all files would give every instance, series
+    and study the same UID, so instance UIDs are remapped instead.
+    """
+    try:
+        return dictionary_VR(tag) == "UI" and is_instance_uid_tag(tag)
+    except KeyError:
+        return False
+
+
+@dataclass(frozen=True)
+class TagRule:
+    """A single compiled row of the tag table."""
+
+    tag: int
+    keyword: str
+    action: Action
+    value: Any = None
+
+
+class AnonymizationPlan:
+    """
+    The tag table compiled into a lookup of rules by tag.
+
+    Keywords are resolved to tags, actions to an Action and replacement or dummy
+    values are fetched once when the plan is compiled. Applying the plan to a
+    dataset then walks it once, including its sequences, and looks up the rule
+    of every element by its tag. Plans contain no Qt objects and can be pickled
+    to worker processes.
+
+    Instance UIDs set to "Change with Dummy Value" are remapped with the keyed
+    hash of dummy_uids, so every instance, series and study keeps a UID of its
+    own and references between files stay intact. Its secret is derived from
+    the pseudonymizer, or random per plan without a pseudonymizer.
+    """
+
+    def __init__(
+        self,
+        rules: Dict[int, TagRule],
+        pseudonymizer: Optional[Pseudonymizer] = None,
+        remap_uids: bool = False,
+        redaction: Optional[RedactionRules] = None,
+        dummy_uids: Optional[Pseudonymizer] = None,
+    ):
+        self.rules = rules
+        self.pseudonymizer = pseudonymizer
+        self.remap_uids = remap_uids
+        self.redaction = redaction
+        self.dummy_uids = dummy_uids or Pseudonymizer(os.urandom(32))
+        self._dummy_uid_tags = frozenset(
+            tag
+            for tag, rule in rules.items()
+            if rule.action is Action.CHANGE_DUMMY and is_dummy_uid_tag(tag)
+        )
+        self._fingerprints: Dict[FrozenSet[int], str] = {}
+
+    @classmethod
+    def compile(
+        cls,
+        rows: Iterable[Tuple[str, Union[Action, str], str]],
+        dummy_values: DummyValues,
+        pseudonymizer: Optional[Pseudonymizer] = None,
+        remap_uids: bool = False,
+        redaction: Optional[RedactionRules] = None,
+    ) -> "AnonymizationPlan":
+        """
+        Compile the rows of the tag table into a plan.
+
+        Parameters:
+            rows (Iterable[Tuple[str, Union[Action, str], str]]): One
+                (tag name, action, value) entry per row.
+            dummy_values (DummyValues): Source of the dummy values, see
+                dummy_values.
+            pseudonymizer (Optional[Pseudonymizer], optional): Pseudonymizer of
+                the tags set to "Pseudonymize" and of the remapped UIDs.
+                Defaults to None.
+            remap_uids (bool, optional): Replace every instance UID without a
+                rule of its own, including UIDs in sequences. Defaults to False.
+            redaction (Optional[RedactionRules], optional): Rules for blanking
+                burned-in text in the pixel data. Defaults to None.
+
+        Returns:
+            AnonymizationPlan: The compiled plan.
+
+        Raises:
+            ValueError: If a tag is set to "Pseudonymize" or UIDs are remapped
+                without a pseudonymizer.
+        """
+        if remap_uids and pseudonymizer is None:
+            raise ValueError("Remapping UIDs requires a password")
+        if pseudonymizer is not None:
+            # The same password gives the same dummy UIDs in every run
+            secret = hmac.new(pseudonymizer.secret, b"dummy uids", hashlib.sha256)
+            dummy_uids = Pseudonymizer(secret.digest())
+        else:
+            dummy_uids = Pseudonymizer(os.urandom(32))
+        rules = {}
+        for tag_name, action, value in rows:
+            action = Action(action)
+            if action is Action.UNCHANGED:
+                continue
+            tag = tag_for_keyword(tag_name)
+            if tag is None:
+                continue
+            if action is Action.CHANGE_DUMMY and is_dummy_uid_tag(tag):
+                # Changing the secret changes the fingerprint of the rule
+                value = dummy_uids.key_id
+            elif action is Action.CHANGE_DUMMY:
+                value = dummy_values.get(tag, tag_name)
+            elif action is Action.PSEUDONYMIZE:
+                if pseudonymizer is None:
+                    raise ValueError("Pseudonymizing tags requires a password")
+                # Changing the password changes the fingerprint of the rule
+                value = pseudonymizer.key_id
+            elif action is not Action.CHANGE_VALUE:
+                value = None
+            rules[tag] = TagRule(tag=tag, keyword=tag_name, action=action, value=value)
+        return cls(rules, pseudonymizer, remap_uids, redaction, dummy_uids)
+
+    def apply(
+        self, ds: pydicom.Dataset, metrics: Optional[RunMetrics] = None
+    ) -> List[Union[DataElement, RawDataElement]]:
+        """
+        Apply the plan to a dataset, including the elements of sequences.
+
+        The dataset is walked once and the matching elements are changed after
+        the walk. An element in a sequence can only be restored together with
+        its sequence, so a nested element set to "Encrypt" encrypts the whole
+        top-level sequence containing it.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset to modify.
+            metrics (Optional[RunMetrics], optional): Metrics the number of
+                changed, deleted and encrypted tags is added to.
+                Defaults to None.
+
+        Returns:
+            List[Union[DataElement, RawDataElement]]: Elements which have to be
+            encrypted, removed from the dataset without decoding their values.
+        """
+        rules = self.rules
+        remap_uids = self.remap_uids
+        # Elements to change once the walk is done, remapped UIDs have no rule
+        matches: List[Tuple[SequencePath, pydicom.Dataset, int, Optional[TagRule]]]
+        matches = []
+        encrypted_tags = set()
+        for path, parent, tag in iter_elements(ds):
+            rule = rules.get(tag)
+            if rule is not None:
+                if rule.action is Action.ENCRYPT:
+                    encrypted_tags.add(path[0] if path else tag)
+                else:
+                    matches.append((path, parent, tag, rule))
+            elif (
+                remap_uids
+                and is_instance_uid_tag(tag)
+                and element_VR(parent, tag) == "UI"
+            ):
+                matches.append((path, parent, tag, None))
+
+        encrypted_elements = []
+        for tag in sorted(encrypted_tags):
+            encrypted_elements.append(ds.get_item(tag))
+            del ds[tag]
+        applied = deleted = 0
+        for path, parent, tag, rule in matches:
+            if (path[0] if path else tag) in encrypted_tags or tag not in parent:
+                continue
+            applied += 1
+            if rule is None:
+                self.pseudonymizer.remap_uid_element(parent[tag])
+            elif rule.action is Action.DELETE:
+                del parent[tag]
+                deleted += 1
+            elif rule.action is Action.PSEUDONYMIZE:
+                self.pseudonymizer.pseudonymize_element(parent[tag])
+            elif tag in self._dummy_uid_tags:
+                self.dummy_uids.remap_uid_element(parent[tag])
+            else:
+                parent[tag].value = rule.value
+
+        if SOP_INSTANCE_UID in rules or remap_uids:
+            self._update_media_storage_uid(ds)
+        if self.pseudonymizer is not None:
+            # Record the new pseudonyms of the file in one transaction
+            self.pseudonymizer.flush()
+        if metrics is not None:
+            metrics.count("tags_changed", applied - deleted)
+            metrics.count("tags_deleted", deleted)
+            metrics.count("tags_encrypted", len(encrypted_elements))
+        return encrypted_elements
+
+    def _update_media_storage_uid(self, ds: pydicom.Dataset) -> None:
+        """
+        Keep the file meta information pointing to the changed SOP Instance UID.
+
+        The UID of the file meta information gets the new SOP Instance UID of
+        the dataset. If the SOP Instance UID was deleted or encrypted, it is
+        pseudonymized, or replaced by a new UID without a pseudonymizer, so the
+        original UID is not left in clear text.
+        """
+        file_meta = getattr(ds, "file_meta", None)
+        if file_meta is None or MEDIA_STORAGE_SOP_INSTANCE_UID not in file_meta:
+            return
+        elem = file_meta[MEDIA_STORAGE_SOP_INSTANCE_UID]
+        sop_instance_uid = ds.get(SOP_INSTANCE_UID)
+        if sop_instance_uid is not None and sop_instance_uid.value:
+            elem.value = sop_instance_uid.value
+        elif self.pseudonymizer is not None:
+            self.pseudonymizer.pseudonymize_element(elem)
+        else:
+            elem.value = generate_uid(prefix=None)
+
+    def fingerprint(self, tags: FrozenSet[int]) -> str:
+        """
+        Hash the rules which apply to a set of tags.
+
+        Files whose tags are not touched by a changed rule keep their fingerprint.
+        Results are cached per tag set, which files of a study usually share.
+
+        Parameters:
+            tags (FrozenSet[int]): Tags present in a file.
+
+        Returns:
+            str: Hex digest of the rules for these tags.
+        """
+        fingerprint = self._fingerprints.get(tags)
+        if fingerprint is None:
+            digest = hashlib.sha256()
+            if self.remap_uids:
+                digest.update(f"remap_uids|{self.pseudonymizer.key_id}\n".encode())
+            if self.redaction is not None:
+                digest.update(f"redaction|{self.redaction.fingerprint}\n".encode())
+            for tag in sorted(tags & self.rules.keys()):
+                rule = self.rules[tag]
+                digest.update(f"{tag}|{rule.action.value}|{rule.value}\n".encode())
+            fingerprint = self._fingerprints[tags] = digest.hexdigest()
+        return fingerprint
+
+    @property
+    def encrypts(self) -> bool:
+        """True if any tag is set to "Encrypt"."""
+        return any(rule.action is Action.ENCRYPT for rule in self.rules.values())
+
+    @property
+    def pseudonymizes(self) -> bool:
+        """True if any tag is set to "Pseudonymize"."""
+        return any(rule.action is Action.PSEUDONYMIZE for rule in self.rules.values())
+
+    def __len__(self) -> int:
+        return len(self.rules)
@@ -0,0 +1,583 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import pydicom
+
+from utilities.anonymization_core import anonymize_dataset, anonymize_file
+from utilities.anonymization_plan import AnonymizationPlan
+from utilities.encryption_manager import EncryptionKey
+from utilities.helper_function import (
+    HEADER_PROBE_SIZE,
+    PARTIAL_SUFFIX,
+    describe_error,
+    is_dicom_header,
+)
+from utilities.pixel_passthrough import COPY_CHUNK_SIZE
+from utilities.run_metrics import NO_METRICS, RunMetrics
+
+# Suffixes of the supported archives and the tarfile compression they use,
+# None for ZIP archives
+ARCHIVE_FORMATS = {
+    ".zip": None,
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tbz2": "bz2",
+    ".tar.xz": "xz",
+    ".txz": "xz",
+}
+
+# Compression level of gzip compressed TAR archives, the zlib default also used
+# for ZIP archives
+GZIP_LEVEL = 6
+
+# Members larger than this are spooled to a temporary file and anonymized from
+# disk, copying their pixel data in chunks. Smaller members are held in memory.
+SPOOL_THRESHOLD = 64 * 1024 * 1024
+
+# Bytes of the members in flight in a parallel run. Spooled members count with
+# SPOOL_THRESHOLD, which also bounds the number of their temporary files.
+IN_FLIGHT_BYTES = 256 * 1024 * 1024
+
+# Per-process state set by _init_worker
+_worker_state = {}
+
+
+@dataclass(frozen=True)
+class SpooledMember:
+    """Content of an archive member too large to be held in memory."""
+
+    path: str
+    size: int
+
+    def discard(self) -> None:
+        """Remove the temporary file."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# Content of an archive member, held in memory or spooled to a temporary file
+MemberData = Union[bytes, SpooledMember]
+
+
+def member_size(data: MemberData) -> int:
+    """Get the size of the content of a member."""
+    return data.size if isinstance(data, SpooledMember) else len(data)
+
+
+def archive_suffix(path: str) -> Optional[str]:
+    """Get the archive suffix of a path, None if it is not an archive."""
+    lower_path = path.lower()
+    matches = [suffix for suffix in ARCHIVE_FORMATS if lower_path.endswith(suffix)]
+    return max(matches, key=len) if matches else None
+
+
+def is_archive(path: str) -> bool:
+    """
+    Check if a path is a ZIP or TAR archive which can be anonymized.
+
+    Parameters:
+        path (str): Path to check.
+
+    Returns:
+        bool: True for an existing file with a supported archive suffix.
+    """
+    return archive_suffix(path) is not None and os.path.isfile(path)
+
+
+def archive_stem(path: str) -> str:
+    """Get the path of an archive without its suffix."""
+    suffix = archive_suffix(path)
+    return path[: -len(suffix)] if suffix else path
+
+
+def archive_output_path(path: str) -> str:
+    """
+    Get the default output archive of an input archive.
+
+    Parameters:
+        path (str): Path of the input archive.
+
+    Returns:
+        str: ``<name>_anonymized`` with the suffix of the input archive.
+    """
+    return archive_stem(path) + "_anonymized" + archive_suffix(path)
+
+
+def iter_archive_members(path: str) -> Iterator[Tuple[str, float, int, IO[bytes]]]:
+    """
+    Open the regular file members of an archive one after another.
+
+    TAR archives are read as a stream, so no member is extracted to disk and
+    compressed archives are decompressed once.
+
+    Parameters:
+        path (str): Path of the archive.
+
+    Yields:
+        Tuple[str, float, int, IO[bytes]]: Name, modification time, size and
+            content of the next member. The content can only be read until the
+            next member is requested.
+    """
+    if ARCHIVE_FORMATS[archive_suffix(path)] is None:
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                with archive.open(info) as fp:
+                    yield info.filename, mtime, info.file_size, fp
+    else:
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile():
+                    fp = archive.extractfile(member)
+                    yield member.name, float(member.mtime), member.size, fp
+
+
+def iter_dicom_members(
+    path: str,
+    spool_folder: Optional[str] = None,
+    skipped_callback: Optional[Callable[[str], None]] = None,
+) -> Iterator[Tuple[str, float, MemberData]]:
+    """
+    Read the DICOM members of an archive one after another.
+
+    Members which are not DICOM files are skipped after reading their first
+    bytes, like files of a folder which are not DICOM files. Members larger
+    than SPOOL_THRESHOLD are copied to a temporary file in chunks instead of
+    being read into memory, the caller discards the file once it is done.
+
+    Parameters:
+        path (str): Path of the archive.
+        spool_folder (Optional[str], optional): Folder of the temporary files.
+            Defaults to the temporary folder of the system.
+        skipped_callback (Optional[Callable[[str], None]], optional): Called
+            with the name of every member which is not a DICOM file. Defaults
+            to None.
+
+    Yields:
+        Tuple[str, float, MemberData]: Name, modification time and content of
+            the next DICOM member.
+    """
+    for name, mtime, size, fp in iter_archive_members(path):
+        header = fp.read(HEADER_PROBE_SIZE)
+        if not is_dicom_header(header):
+            if skipped_callback is not None:
+                skipped_callback(name)
+        elif size <= SPOOL_THRESHOLD:
+            yield name, mtime, header + fp.read()
+        else:
+            fd, spool_path = tempfile.mkstemp(suffix=".dcm", dir=spool_folder)
+            with os.fdopen(fd, "wb") as spool:
+                spool.write(header)
+                shutil.copyfileobj(fp, spool, COPY_CHUNK_SIZE)
+                size = spool.tell()
+            yield name, mtime, SpooledMember(spool_path, size)
+
+
+class ArchiveWriter:
+    """
+    Write members to a new ZIP or TAR archive.
+
+    The format follows the suffix of the path. The archive is written under a
+    temporary name and only appears once it is complete, an aborted or failed
+    run leaves no archive behind.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        compression = ARCHIVE_FORMATS[archive_suffix(path)]
+        if compression is None:
+            self._archive = zipfile.ZipFile(
+                self.partial_path, "w", zipfile.ZIP_DEFLATED
+            )
+        else:
+            kwargs = {}
+            if compression == "gz":
+                # tarfile defaults to the slowest level, which costs several
+                # times the anonymization itself for little gain on DICOM data
+                kwargs["compresslevel"] = GZIP_LEVEL
+            self._archive = tarfile.open(
+                self.partial_path, f"w:{compression}", **kwargs
+            )
+        self._closed = False
+
+    def add(self, name: str, data: MemberData, mtime: float) -> None:
+        """
+        Add a member.
+
+        Parameters:
+            name (str): Name of the member.
+            data (MemberData): Content of the member, a spooled member is
+                copied in chunks.
+            mtime (float): Modification time of the member.
+        """
+        spooled = isinstance(data, SpooledMember)
+        if isinstance(self._archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            if not spooled:
+                self._archive.writestr(info, data)
+                return
+            with open(data.path, "rb") as source, self._archive.open(
+                info, "w", force_zip64=True
+            ) as output:
+                shutil.copyfileobj(source, output, COPY_CHUNK_SIZE)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = member_size(data)
+            info.mtime = int(mtime)
+            if not spooled:
+                self._archive.addfile(info, io.BytesIO(data))
+                return
+            with open(data.path, "rb") as source:
+                self._archive.addfile(info, source)
+
+    def close(self) -> None:
+        """Complete the archive and move it to its path."""
+        if not self._closed:
+            self._closed = True
+            self._archive.close()
+            os.replace(self.partial_path, self.path)
+
+    def abort(self) -> None:
+        """Discard the archive."""
+        if not self._closed:
+            self._closed = True
+            self._archive.close()
+            os.remove(self.partial_path)
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def anonymize_member(
+    data: bytes,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> bytes:
+    """
+    Anonymize a DICOM file held in memory.
+
+    Parameters:
+        data (bytes): Content of the DICOM file.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key for this file only.
+        metrics (Optional[RunMetrics], optional): Metrics the time per stage
+            and the counters of the file are added to. Defaults to None.
+
+    Returns:
+        bytes: Content of the anonymized file.
+    """
+    stages = NO_METRICS if metrics is None else metrics
+    with stages.stage("read"):
+        ds = pydicom.dcmread(io.BytesIO(data), force=True)
+    anonymize_dataset(ds, plan, password, key, metrics)
+    with stages.stage("write"):
+        output = io.BytesIO()
+        ds.save_as(output)
+        anonymized = output.getvalue()
+    if metrics is not None:
+        metrics.count("files")
+        metrics.count("bytes_read", len(data))
+        metrics.count("bytes_written", len(anonymized))
+    return anonymized
+
+
+def anonymize_spooled_member(
+    member: SpooledMember,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> SpooledMember:
+    """
+    Anonymize a member spooled to a temporary file, like a file of a folder.
+
+    Only the header is read, the pixel data is copied from the temporary file
+    in chunks unless a rule needs the whole file.
+
+    Parameters:
+        member (SpooledMember): The spooled member.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key for this file only.
+        metrics (Optional[RunMetrics], optional): Metrics the time per stage
+            and the counters of the file are added to. Defaults to None.
+
+    Returns:
+        SpooledMember: The anonymized member, in a temporary file next to the
+            spooled member.
+    """
+    output_path = os.path.splitext(member.path)[0] + "_anonymized.dcm"
+    anonymize_file(member.path, output_path, plan, password, key, metrics=metrics)
+    return SpooledMember(output_path, os.path.getsize(output_path))
+
+
+def _anonymize_member_data(
+    data: MemberData,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> MemberData:
+    """Anonymize a member held in memory or spooled to a temporary file."""
+    if isinstance(data, SpooledMember):
+        return anonymize_spooled_member(data, plan, password, key, metrics)
+    return anonymize_member(data, plan, password, key, metrics)
+
+
+def _init_worker(
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey],
+    collect_metrics: bool,
+) -> None:
+    """Receive the run settings once per worker process."""
+    _worker_state["args"] = (plan, password, key)
+    _worker_state["collect_metrics"] = collect_metrics
+    if plan.pseudonymizer is not None:
+        plan.pseudonymizer.close_at_exit()
+
+
+def start_member_pool(
+    workers: int,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+    collect_metrics: bool = False,
+) -> ProcessPoolExecutor:
+    """
+    Start worker processes anonymizing DICOM files held in memory.
+
+    Files are submitted with anonymize_member_in_worker, the settings of the
+    run are sent to every worker once.
+
+    Parameters:
+        workers (int): Number of worker processes.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        key (Optional[EncryptionKey], optional): Key shared by all files.
+            Defaults to deriving a key per file.
+        collect_metrics (bool, optional): Whether the workers return the
+            metrics of every file. Defaults to False.
+
+    Returns:
+        ProcessPoolExecutor: The worker processes.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(plan, password, key, collect_metrics),
+    )
+
+
+def anonymize_member_in_worker(
+    data: MemberData,
+) -> Tuple[Optional[MemberData], Optional[str], Optional[Dict[str, Dict[str, Any]]]]:
+    """
+    Anonymize a DICOM file inside a worker of start_member_pool.
+
+    Parameters:
+        data (MemberData): Content of the DICOM file, in memory or spooled to
+            a temporary file.
+
+    Returns:
+        Tuple[Optional[MemberData], Optional[str], Optional[Dict]]: Content of
+            the anonymized file or None, the error if the file failed, and the
+            metrics of the file if they are collected.
+    """
+    metrics = RunMetrics() if _worker_state["collect_metrics"] else None
+    try:
+        anonymized, error = (
+            _anonymize_member_data(data, *_worker_state["args"], metrics),
+            None,
+        )
+    except Exception as e:
+        anonymized, error = None, describe_error(e)
+        if metrics is not None:
+            metrics.count("errors")
+    return anonymized, error, None if metrics is None else metrics.as_dict()
+
+
+def anonymize_archive(
+    archive_path: str,
+    output_path: str,
+    plan: AnonymizationPlan,
+    password: str,
+    workers: int = 1,
+    key: Optional[EncryptionKey] = None,
+    progress_callback: Optional[Callable[[List[str]], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    error_callback: Optional[
+        Callable[[str, str, Optional[bytes], Optional[str]], None]
+    ] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Anonymize the DICOM members of an archive into a new archive.
+
+    Members are read from the input archive and written to the output archive
+    one after another, in their original order, without extracting them to
+    disk. Members larger than SPOOL_THRESHOLD are spooled to a temporary folder
+    next to the output archive and anonymized like files of a folder, copying
+    their pixel data in chunks. Smaller members are held in memory, at most
+    IN_FLIGHT_BYTES of them at once. A member which can not be anonymized does
+    not stop the run, it is left out of the output archive. Members which are
+    not DICOM files are left out as well. A cancelled run writes no output
+    archive.
+
+    Parameters:
+        archive_path (str): Path of the ZIP or TAR archive to anonymize.
+        output_path (str): Path of the output archive, its suffix selects the
+            format.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        workers (int, optional): Number of worker processes, 1 anonymizes the
+            members in the calling process. Defaults to 1.
+        key (Optional[EncryptionKey], optional): Key shared by all members.
+            Defaults to deriving a key per member.
+        progress_callback (Optional[Callable[[List[str]], None]], optional):
+            Called with the paths of the members finished since the last call,
+            the archive path joined with the member name, including failed
+            members. Defaults to None.
+        should_cancel (Optional[Callable[[], bool]], optional): Polled between
+            members, stops the run once it returns True. Defaults to None.
+        error_callback (Optional[Callable], optional): Called with the path
+            and the error of every member which failed, followed by its
+            content, or None and the path of the temporary file holding the
+            content of a spooled member. Defaults to None.
+        metrics (Optional[RunMetrics], optional): Metrics the time per stage
+            and the counters of the members are added to. Defaults to None.
+
+    Returns:
+        List[Tuple[str, str]]: Path and error message of every failed member.
+    """
+    failures = []
+    stages = NO_METRICS if metrics is None else metrics
+
+    def finish(
+        name: str,
+        mtime: float,
+        data: MemberData,
+        anonymized: Optional[MemberData],
+        error: Optional[str],
+    ) -> None:
+        path = os.path.join(archive_path, name)
+        if error is None:
+            with stages.stage("write"):
+                writer.add(name, anonymized, mtime)
+        else:
+            failures.append((path, error))
+            if error_callback is not None:
+                if isinstance(data, SpooledMember):
+                    error_callback(path, error, None, data.path)
+                else:
+                    error_callback(path, error, data, None)
+        for member in (data, anonymized):
+            if isinstance(member, SpooledMember):
+                member.discard()
+        if progress_callback is not None:
+            progress_callback([path])
+
+    def cancelled() -> bool:
+        return should_cancel is not None and should_cancel()
+
+    output_folder = os.path.dirname(os.path.abspath(output_path))
+    with ArchiveWriter(output_path) as writer, tempfile.TemporaryDirectory(
+        prefix=os.path.basename(output_path) + ".spool-", dir=output_folder
+    ) as spool_folder:
+        members = iter_dicom_members(archive_path, spool_folder)
+        if workers <= 1:
+            for name, mtime, data in members:
+                if cancelled():
+                    break
+                try:
+                    anonymized, error = (
+                        _anonymize_member_data(data, plan, password, key, metrics),
+                        None,
+                    )
+                except Exception as e:
+                    anonymized, error = None, describe_error(e)
+                    stages.count("errors")
+                finish(name, mtime, data, anonymized, error)
+        else:
+            with start_member_pool(
+                workers, plan, password, key, metrics is not None
+            ) as pool:
+                # Members are submitted in order and written in order, with
+                # at most IN_FLIGHT_BYTES of members in flight
+                in_flight: Deque[Tuple[str, float, MemberData, Future]] = deque()
+                in_flight_bytes = 0
+                for name, mtime, data in members:
+                    if cancelled():
+                        break
+                    weight = _in_flight_weight(data)
+                    while in_flight and in_flight_bytes + weight > IN_FLIGHT_BYTES:
+                        member = in_flight.popleft()
+                        in_flight_bytes -= _in_flight_weight(member[2])
+                        _finish_in_flight(member, finish, metrics)
+                    future = pool.submit(anonymize_member_in_worker, data)
+                    in_flight.append((name, mtime, data, future))
+                    in_flight_bytes += weight
+                while in_flight and not cancelled():
+                    _finish_in_flight(in_flight.popleft(), finish, metrics)
+                for _, _, _, future in in_flight:
+                    future.cancel()
+        if cancelled():
+            writer.abort()
+    return failures
+
+
+def _in_flight_weight(data: MemberData) -> int:
+    """Bytes a member in flight counts with, see IN_FLIGHT_BYTES."""
+    return SPOOL_THRESHOLD if isinstance(data, SpooledMember) else len(data)
+
+
+def _finish_in_flight(
+    member: Tuple[str, float, MemberData, Future],
+    finish: Callable[..., None],
+    metrics: Optional[RunMetrics],
+) -> None:
+    """Wait for a member sent to a worker and write it."""
+    name, mtime, data, future = member
+    anonymized, error, member_metrics = future.result()
+    if member_metrics is not None:
+        metrics.merge(member_metrics)
+    finish(name, mtime, data, anonymized, error)
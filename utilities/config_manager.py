@@ -1,69 +1,101 @@
 import configparser
-from PyQt6.QtWidgets import QTableWidget
+from typing import TYPE_CHECKING, List, Tuple
 
+from utilities.actions import ACTION_COLUMNS, Action
 
-def save_config(tagsTable: QTableWidget, file_path: str = "config.ini") -> None:
+if TYPE_CHECKING:
+    from utilities.tag_table_model import TagTableModel
+
+
+def save_config(tagsModel: "TagTableModel", file_path: str = "config.ini") -> None:
     """
     Save the current configuration of DICOM tags to a file.
 
     Parameters:
-        tagsTable (QTableWidget): Table containing the tag configurations.
+        tagsModel (TagTableModel): Model of the tag table.
         file_path (str, optional): Path to save the config file. Defaults to "config.ini".
     """
-    config = configparser.ConfigParser()
+    config = configparser.ConfigParser(interpolation=None)
 
     # Iterate over each row in the table to extract tag configurations
-    for row in range(tagsTable.rowCount()):
-        tag = tagsTable.item(row, 1).text()  # Getting the tag name
-        for col in range(3, 8):
-            radio_button = tagsTable.cellWidget(row, col)
-            if radio_button.isChecked():
-                action = str(col)
-                break
-        config[tag] = {"Action": action}
+    for row in range(tagsModel.rowCount()):
+        tag = tagsModel.tag_name(row)
+        action = str(tagsModel.action_column(row))
+        config[tag] = {"Action": action, "Value": tagsModel.value(row)}
 
     # Save the configurations to the specified file
     with open(file_path, "w") as configfile:
         config.write(configfile)
 
 
-def load_config(tagsTable: QTableWidget, file_path: str = "config.ini") -> None:
+def load_config(tagsModel: "TagTableModel", file_path: str = "config.ini") -> None:
     """
     Load configurations of DICOM tags from a file and apply them to the table.
 
     Parameters:
-        tagsTable (QTableWidget): Table to update with loaded configurations.
+        tagsModel (TagTableModel): Model of the tag table to update.
         file_path (str, optional): Path to load the config file from. Defaults to "config.ini".
     """
-    config = configparser.ConfigParser()
+    config = configparser.ConfigParser(interpolation=None)
     config.read(file_path)
 
     # Apply the loaded configurations to the table
-    for row in range(tagsTable.rowCount()):
-        tag = tagsTable.item(row, 1).text()
-        if tag in config:
-            action = config[tag]["Action"]
-            radio_button = tagsTable.cellWidget(row, int(action))
-            radio_button.setChecked(True)
+    with tagsModel.batch_update():
+        for tag in config.sections():
+            row = tagsModel.find_row(tag)
+            if row is None:
+                continue
+            tagsModel.set_action_column(row, int(config[tag]["Action"]))
+            if "Value" in config[tag]:
+                tagsModel.set_value(row, config[tag]["Value"])
+
+
+def read_config(file_path: str = "config.ini") -> List[Tuple[str, Action, str]]:
+    """
+    Read the configuration of DICOM tags without a tag table.
+
+    Parameters:
+        file_path (str, optional): Path to load the config file from. Defaults to "config.ini".
+
+    Returns:
+        List[Tuple[str, Action, str]]: One (tag name, action, value) entry per tag,
+        as expected by AnonymizationPlan.compile.
+
+    Raises:
+        FileNotFoundError: If the config file does not exist.
+        ValueError: If a tag has an unknown action.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(file_path):
+        raise FileNotFoundError(file_path)
+
+    rows = []
+    for tag in config.sections():
+        column = int(config[tag]["Action"])
+        if column not in ACTION_COLUMNS:
+            raise ValueError(f"Unknown action {column} for tag {tag}")
+        rows.append((tag, ACTION_COLUMNS[column], config[tag].get("Value", "")))
+    return rows
 
 
-def auto_select(tagsTable: QTableWidget) -> None:
+def auto_select(tagsModel: "TagTableModel") -> None:
     """
     Automatically select configurations for known sensitive DICOM tags.
 
     Parameters:
-        tagsTable (QTableWidget): Table to update with auto-selected configurations.
+        tagsModel (TagTableModel): Model of the tag table to update.
     """
 
     # Auto-select configurations for tags with sensitive information
-    for row in range(tagsTable.rowCount()):
-        tag_name = tagsTable.item(row, 1).text().lower()
-        if (
-            "patient" in tag_name
-            or "date" in tag_name
-            or "id" in tag_name
-            or "name" in tag_name
-        ):
-            tagsTable.cellWidget(row, 5).setChecked(True)
-        else:
-            tagsTable.cellWidget(row, 3).setChecked(True)
+    with tagsModel.batch_update():
+        for row in range(tagsModel.rowCount()):
+            tag_name = tagsModel.tag_name(row).lower()
+            if (
+                "patient" in tag_name
+                or "date" in tag_name
+                or "id" in tag_name
+                or "name" in tag_name
+            ):
+                tagsModel.set_action_column(row, 5)
+            else:
+                tagsModel.set_action_column(row, 3)
@@ -0,0 +1,94 @@
+from functools import lru_cache
+from typing import Iterator, Optional, Set, Tuple
+
+import pydicom
+from pydicom.dataelem import RawDataElement
+
+# Tags of the sequences enclosing an element, starting at the top level. Empty
+# for top-level elements.
+SequencePath = Tuple[int, ...]
+
+
+@lru_cache(maxsize=None)
+def dictionary_VR(tag: int) -> Optional[str]:
+    """VR of a tag in the DICOM dictionary, None for unknown tags."""
+    try:
+        return pydicom.datadict.dictionary_VR(tag)
+    except KeyError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def keyword_for_tag(tag: int) -> str:
+    """Keyword of a tag in the DICOM dictionary, empty for unknown tags."""
+    return pydicom.datadict.keyword_for_tag(tag)
+
+
+@lru_cache(maxsize=None)
+def tag_for_keyword(keyword: str) -> Optional[int]:
+    """Tag of a keyword in the DICOM dictionary, None for unknown keywords."""
+    return pydicom.datadict.tag_for_keyword(keyword)
+
+
+def element_VR(ds: pydicom.Dataset, tag: int) -> Optional[str]:
+    """
+    Get the VR of an element without decoding its value.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset holding the element.
+        tag (int): Tag of the element.
+
+    Returns:
+        Optional[str]: The VR, taken from the dictionary for implicit VR files.
+    """
+    return ds.get_item(tag).VR or dictionary_VR(tag)
+
+
+def iter_elements(
+    ds: pydicom.Dataset,
+) -> Iterator[Tuple[SequencePath, pydicom.Dataset, int]]:
+    """
+    Visit every element of a dataset, including the elements of sequences.
+
+    The sequences are walked with a stack instead of recursion, so deeply
+    nested datasets neither hit the recursion limit nor pay for a generator per
+    level. Elements of a dataset are visited in the order they were read, each
+    sequence after the dataset containing it. A sequence is only entered once
+    the caller is done with it, so deleting or replacing it skips its items.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset to walk.
+
+    Yields:
+        Tuple[SequencePath, pydicom.Dataset, int]: Sequences enclosing the
+            element, the dataset holding it and its tag.
+    """
+    stack = [((), ds)]
+    while stack:
+        path, current = stack.pop()
+        # The element dict of the dataset, read without decoding the values
+        elements = current._dict
+        nested = []
+        for tag in list(elements):
+            yield path, current, tag
+            elem = elements.get(tag)
+            if elem is not None and (elem.VR or dictionary_VR(tag)) == "SQ":
+                if isinstance(elem, RawDataElement):
+                    elem = current[tag]
+                nested.append((path + (tag,), elem.value))
+        # Reversed, so the first sequence is walked first
+        for item_path, items in reversed(nested):
+            stack.extend((item_path, item) for item in reversed(items))
+
+
+def dataset_tags(ds: pydicom.Dataset) -> Set[int]:
+    """
+    Get the tags of a dataset, including the tags of sequences.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset to walk.
+
+    Returns:
+        Set[int]: Every tag found in the dataset.
+    """
+    return {tag for _, _, tag in iter_elements(ds)}
@@ -0,0 +1,427 @@
+import hashlib
+import hmac
+import io
+import os
+import queue
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import pydicom
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import (
+    AE,
+    AllStoragePresentationContexts,
+    StoragePresentationContexts,
+    evt,
+)
+from pynetdicom.association import Association
+from pynetdicom.events import Event
+from pynetdicom.sop_class import Verification
+
+from utilities.anonymization_plan import AnonymizationPlan
+from utilities.archive_io import (
+    anonymize_member,
+    anonymize_member_in_worker,
+    start_member_pool,
+)
+from utilities.encryption_manager import EncryptionKey
+from utilities.helper_function import (
+    DICOM_MAGIC,
+    DICOM_PREAMBLE_LENGTH,
+    atomic_output,
+    describe_error,
+)
+from utilities.quarantine import Quarantine
+from utilities.run_metrics import NO_METRICS, RunMetrics
+
+DEFAULT_PORT = 11112
+DEFAULT_AE_TITLE = "ANONYMIZER"
+
+# Statuses of C-STORE responses. Instances which can not be anonymized are
+# rejected for good, instances which can not be stored or forwarded may be
+# sent again.
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+# Statuses of a forwarding node under which the instance was stored anyway,
+# e.g. after coercing a value
+STORED_WITH_WARNING = {0xB000, 0xB006, 0xB007}
+
+# Associations kept open to the destination of forwarded instances
+DEFAULT_FORWARD_ASSOCIATIONS = 4
+
+
+def parse_node(node: str) -> Tuple[str, str, int]:
+    """
+    Parse a DICOM node given as ``AE_TITLE@HOST:PORT``.
+
+    Parameters:
+        node (str): The node.
+
+    Returns:
+        Tuple[str, str, int]: AE title, host and port.
+
+    Raises:
+        ValueError: If the node is not in this form.
+    """
+    ae_title, _, address = node.rpartition("@")
+    host, _, port = address.rpartition(":")
+    if not ae_title or not host or not port.isdigit():
+        raise ValueError(f"Expected AE_TITLE@HOST:PORT, got {node!r}")
+    return ae_title, host, int(port)
+
+
+def disable_nagle(event: Event) -> None:
+    """
+    Send small PDUs right away on a new connection, see EVT_CONN_OPEN.
+
+    Without it, the last PDU of an instance is held back until the delayed ACK
+    of the peer, which costs about 40 ms per instance on the requesting side.
+
+    Parameters:
+        event (Event): The EVT_CONN_OPEN event.
+    """
+    event.assoc.dul.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def encode_received(event: Event) -> bytes:
+    """
+    Encode the dataset of a C-STORE request as a DICOM file.
+
+    The dataset is taken as it was received, without decoding it.
+
+    Parameters:
+        event (Event): The C-STORE request.
+
+    Returns:
+        bytes: Content of the DICOM file.
+    """
+    fp = io.BytesIO()
+    fp.write(b"\x00" * DICOM_PREAMBLE_LENGTH + DICOM_MAGIC)
+    write_file_meta_info(fp, event.file_meta)
+    fp.write(event.request.DataSet.getvalue())
+    return fp.getvalue()
+
+
+def received_file_name(sop_instance_uid: str, secret: bytes) -> str:
+    """
+    Get the name of the output file of a received instance.
+
+    The name is a keyed hash of the SOP Instance UID, so it is unique per
+    instance and stays the same if the instance is sent again, while the UID
+    can not be found by hashing known UIDs without the secret.
+
+    Parameters:
+        sop_instance_uid (str): SOP Instance UID of the received instance.
+        secret (bytes): Secret of the hash.
+
+    Returns:
+        str: File name ending in ``.dcm``.
+    """
+    digest = hmac.new(secret, f"file name|{sop_instance_uid}".encode(), hashlib.sha256)
+    return digest.hexdigest()[:32] + ".dcm"
+
+
+class AssociationPool:
+    """
+    Send instances to a DICOM node over associations which are kept open.
+
+    Up to ``size`` associations are opened on demand and reused by the
+    following instances, so a steady stream of instances does not pay for an
+    association per instance. Associations closed by the node are replaced.
+    """
+
+    def __init__(
+        self,
+        ae_title: str,
+        host: str,
+        port: int,
+        size: int = DEFAULT_FORWARD_ASSOCIATIONS,
+        calling_ae_title: str = DEFAULT_AE_TITLE,
+    ):
+        self.ae_title = ae_title
+        self.host = host
+        self.port = port
+        self._ae = AE(ae_title=calling_ae_title)
+        self._ae.requested_contexts = StoragePresentationContexts
+        self._idle: "queue.LifoQueue[Association]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def send(self, ds: pydicom.Dataset) -> None:
+        """
+        Send an instance, waiting for a free association if all are busy.
+
+        Parameters:
+            ds (pydicom.Dataset): The instance.
+
+        Raises:
+            ConnectionError: If the node can not be reached or does not store
+                the instance.
+        """
+        with self._slots:
+            assoc = self._take()
+            try:
+                status = assoc.send_c_store(ds)
+            except Exception:
+                assoc.abort()
+                raise
+            if assoc.is_established:
+                self._idle.put(assoc)
+        if "Status" not in status:
+            raise ConnectionError(f"No response from {self.ae_title}")
+        if status.Status != STATUS_SUCCESS and status.Status not in STORED_WITH_WARNING:
+            raise ConnectionError(
+                f"{self.ae_title} rejected the instance with status "
+                f"0x{status.Status:04X}"
+            )
+
+    def _take(self) -> Association:
+        """Get an idle association, or open one if there is none."""
+        while True:
+            try:
+                assoc = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if assoc.is_established:
+                return assoc
+        assoc = self._ae.associate(
+            self.host,
+            self.port,
+            ae_title=self.ae_title,
+            evt_handlers=[(evt.EVT_CONN_OPEN, disable_nagle)],
+        )
+        if not assoc.is_established:
+            raise ConnectionError(
+                f"Could not associate with {self.ae_title} at "
+                f"{self.host}:{self.port}"
+            )
+        return assoc
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().release()
+            except queue.Empty:
+                break
+
+    def __enter__(self) -> "AssociationPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class DicomReceiver:
+    """
+    Accept instances over C-STORE and anonymize them on the fly.
+
+    Every received instance is anonymized with the plan, then written to the
+    output folder and/or forwarded to another node, before the C-STORE
+    response is sent, so a successful response means the anonymized instance
+    was stored. Every association is served by its own thread. With several
+    workers, instances are anonymized by worker processes and instances of
+    concurrent associations are anonymized in parallel.
+
+    Instances which fail are quarantined and rejected with a failure status.
+    Output files are named by a keyed hash of the SOP Instance UID, keyed with
+    the secret of the pseudonyms of the plan, or with a random secret of the
+    receiver if the plan has no pseudonymizer.
+    """
+
+    def __init__(
+        self,
+        plan: AnonymizationPlan,
+        password: str,
+        output_folder: Optional[str] = None,
+        forward: Optional[AssociationPool] = None,
+        workers: int = 1,
+        key: Optional[EncryptionKey] = None,
+        quarantine: Optional[Quarantine] = None,
+        metrics: Optional[RunMetrics] = None,
+        progress_callback: Optional[Callable[[List[str]], None]] = None,
+        ae_title: str = DEFAULT_AE_TITLE,
+    ):
+        """
+        Parameters:
+            plan (AnonymizationPlan): Compiled rules to apply.
+            password (str): Password used for tags set to "Encrypt".
+            output_folder (Optional[str], optional): Folder the anonymized
+                instances are written to. Defaults to None.
+            forward (Optional[AssociationPool], optional): Node the anonymized
+                instances are sent to. Defaults to None.
+            workers (int, optional): Number of worker processes, 1 anonymizes
+                the instances in the threads of the associations. Defaults to 1.
+            key (Optional[EncryptionKey], optional): Key shared by all
+                instances. Defaults to deriving a key per instance.
+            quarantine (Optional[Quarantine], optional): Quarantine of the
+                instances which fail. Defaults to None.
+            metrics (Optional[RunMetrics], optional): Metrics the time per stage
+                and the counters of the instances are added to. Defaults to
+                None.
+            progress_callback (Optional[Callable[[List[str]], None]], optional):
+                Called with the file name of every stored instance. Defaults
+                to None.
+            ae_title (str, optional): AE title of the receiver. Defaults to
+                DEFAULT_AE_TITLE.
+        """
+        if output_folder is None and forward is None:
+            raise ValueError("Received instances need an output folder or a node")
+        self.plan = plan
+        self.password = password
+        self.output_folder = output_folder
+        self.forward = forward
+        self.workers = workers
+        self.key = key
+        self.quarantine = quarantine
+        self.metrics = metrics
+        self.progress_callback = progress_callback
+        self.ae_title = ae_title
+        # Names of the output files are keyed with the secret of the
+        # pseudonyms, so they are the same in every run with the password
+        if plan.pseudonymizer is not None:
+            self._name_secret = plan.pseudonymizer.secret
+        else:
+            self._name_secret = os.urandom(32)
+        self.stored = 0
+        self.failures: List[Tuple[str, str]] = []
+        # Serializes the counters, the metrics and, without workers, the plan
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._server = None
+
+    def start(self, host: str = "", port: int = DEFAULT_PORT) -> None:
+        """
+        Start listening for associations in the background.
+
+        Parameters:
+            host (str, optional): Address to listen on. Defaults to all.
+            port (int, optional): Port to listen on. Defaults to DEFAULT_PORT.
+        """
+        if self.workers > 1:
+            self._pool = start_member_pool(
+                self.workers,
+                self.plan,
+                self.password,
+                self.key,
+                self.metrics is not None,
+            )
+        ae = AE(ae_title=self.ae_title)
+        ae.supported_contexts = AllStoragePresentationContexts
+        ae.add_supported_context(Verification)
+        # Allow an association per worker and sender without queueing senders
+        ae.maximum_associations = max(ae.maximum_associations, 2 * self.workers)
+        self._server = ae.start_server(
+            (host, port),
+            block=False,
+            evt_handlers=[(evt.EVT_C_STORE, self.handle_store)],
+        )
+
+    @property
+    def port(self) -> int:
+        """Port the receiver listens on, e.g. after starting it on port 0."""
+        return self._server.server_address[1]
+
+    def stop(self) -> None:
+        """Stop listening, waiting for the instances being processed."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self) -> "DicomReceiver":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def handle_store(self, event: Event) -> int:
+        """
+        Anonymize, store and forward a received instance.
+
+        Parameters:
+            event (Event): The C-STORE request.
+
+        Returns:
+            int: Status of the C-STORE response.
+        """
+        # Metrics of the instance are added to the metrics of the run at once
+        metrics = None if self.metrics is None else RunMetrics()
+        stages = NO_METRICS if metrics is None else metrics
+        data = encode_received(event)
+        name = received_file_name(
+            event.request.AffectedSOPInstanceUID, self._name_secret
+        )
+        # Failed instances are quarantined per sending AE title
+        path = os.path.join(event.assoc.requestor.ae_title, name)
+        anonymized, error = self._anonymize(data, metrics)
+        if error is not None:
+            self._finish(metrics, path, error, data)
+            return STATUS_CANNOT_UNDERSTAND
+        try:
+            if self.output_folder is not None:
+                output_filepath = os.path.join(self.output_folder, name)
+                with stages.stage("write"), atomic_output(output_filepath) as part:
+                    Path(part).write_bytes(anonymized)
+            if self.forward is not None:
+                with stages.stage("forward"):
+                    self.forward.send(pydicom.dcmread(io.BytesIO(anonymized)))
+        except Exception as e:
+            stages.count("errors")
+            self._finish(metrics, path, describe_error(e), data)
+            return STATUS_OUT_OF_RESOURCES
+        self._finish(metrics)
+        if self.progress_callback is not None:
+            self.progress_callback([name])
+        return STATUS_SUCCESS
+
+    def _anonymize(
+        self, data: bytes, metrics: Optional[RunMetrics]
+    ) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Anonymize an instance in a worker process or in the calling thread.
+
+        Returns:
+            Tuple[Optional[bytes], Optional[str]]: The anonymized instance, or
+                None and the error if it failed.
+        """
+        if self._pool is None:
+            try:
+                with self._lock:
+                    anonymized = anonymize_member(
+                        data, self.plan, self.password, self.key, metrics
+                    )
+            except Exception as e:
+                if metrics is not None:
+                    metrics.count("errors")
+                return None, describe_error(e)
+            return anonymized, None
+        anonymized, error, worker_metrics = self._pool.submit(
+            anonymize_member_in_worker, data
+        ).result()
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        return anonymized, error
+
+    def _finish(
+        self,
+        metrics: Optional[RunMetrics],
+        path: Optional[str] = None,
+        error: Optional[str] = None,
+        data: Optional[bytes] = None,
+    ) -> None:
+        """Count a stored instance, or quarantine it if an error is given."""
+        with self._lock:
+            if error is None:
+                self.stored += 1
+            else:
+                self.failures.append((path, error))
+                if self.quarantine is not None:
+                    self.quarantine.add(path, error, data)
+            if metrics is not None:
+                self.metrics.merge(metrics.as_dict())
@@ -0,0 +1,122 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from pydicom.datadict import DicomDictionary, get_entry
+
+# Replacement of the tags set to "Change with Dummy Value", by VR. Every value
+# is valid for its VR, so a replaced element can always be written.
+DUMMY_TEXT = "ANONYMIZED"
+# Only kept for class UIDs, instance UIDs get a new UID per value from the
+# plan, see anonymization_plan.is_dummy_uid_tag
+DUMMY_UID = "2.25.0"
+VR_DEFAULTS: Dict[str, Any] = {
+    **dict.fromkeys(("AE", "CS", "LO", "LT", "PN", "SH", "ST", "UC", "UT"), DUMMY_TEXT),
+    "AS": "000Y",
+    "DA": "19000101",
+    "DT": "19000101000000",
+    "TM": "000000",
+    "DS": "0",
+    "IS": "0",
+    "UI": DUMMY_UID,
+    "UR": "",
+    "AT": 0,
+    **dict.fromkeys(("FL", "FD"), 0.0),
+    **dict.fromkeys(("SL", "SS", "SV", "UL", "US", "UV"), 0),
+    **dict.fromkeys(("OB", "OD", "OF", "OL", "OV", "OW", "UN"), b""),
+    "SQ": [],
+}
+
+# Tags whose default of their VR is not a valid value. Latin-1 decodes every
+# byte, so the unchanged values of a file can still be read.
+KEYWORD_DEFAULTS: Dict[str, Any] = {
+    "PatientSex": "O",
+    "SpecificCharacterSet": "ISO_IR 100",
+}
+
+# Descriptions which name the modality of the files, see DummyValues
+MODALITY_TEMPLATES: Dict[str, str] = {
+    "Modality": "{modality}",
+    "StudyDescription": "{modality} STUDY",
+    "SeriesDescription": "{modality} SERIES",
+    "ProtocolName": "{modality} PROTOCOL",
+}
+
+
+def _default(VR: str, VM: str) -> Any:
+    """Default value of a VR, repeated for the minimum multiplicity."""
+    # Tags which may take several VRs, such as "US or SS", take the first one
+    value = VR_DEFAULTS.get(VR.split(" or ")[0])
+    count = int(re.match(r"\d*", VM).group() or 1)
+    if count > 1 and value is not None and VR != "SQ":
+        return [value] * count
+    return value
+
+
+@lru_cache(maxsize=1)
+def default_table() -> Dict[int, Any]:
+    """
+    Get the dummy value of every tag of the DICOM dictionary.
+
+    The table is built from the dictionary of pydicom once per process,
+    without reading any DICOM file.
+
+    Returns:
+        Dict[int, Any]: Value by tag, valid for the VR and the minimum
+            multiplicity of the tag.
+    """
+    return {tag: _default(entry[0], entry[1]) for tag, entry in DicomDictionary.items()}
+
+
+class DummyValues:
+    """
+    Source of the values of the tags set to "Change with Dummy Value".
+
+    Every tag gets the default of its VR, so the value is valid wherever the
+    tag occurs. With a modality, descriptions such as the series description
+    name that modality instead.
+    """
+
+    def __init__(self, modality: Optional[str] = None):
+        self.modality = modality
+        self._defaults = default_table()
+
+    def get(self, tag: int, keyword: str) -> Any:
+        """
+        Get the dummy value of a tag.
+
+        Parameters:
+            tag (int): The tag.
+            keyword (str): Keyword of the tag.
+
+        Returns:
+            Any: The dummy value, None for a tag without a value such as an
+                item delimiter.
+        """
+        if self.modality and keyword in MODALITY_TEMPLATES:
+            return MODALITY_TEMPLATES[keyword].format(modality=self.modality)
+        if keyword in KEYWORD_DEFAULTS:
+            return KEYWORD_DEFAULTS[keyword]
+        if tag in self._defaults:
+            return self._defaults[tag]
+        try:
+            # Repeating groups such as overlays are not in the table
+            VR, VM = get_entry(tag)[:2]
+        except KeyError:
+            return None
+        return _default(VR, VM)
+
+
+@lru_cache(maxsize=None)
+def dummy_values(modality: Optional[str] = None) -> DummyValues:
+    """
+    Get the dummy values of a modality, created once per process.
+
+    Parameters:
+        modality (Optional[str], optional): Modality such as "CT" or "MR".
+            Defaults to None, values which name no modality.
+
+    Returns:
+        DummyValues: The dummy values.
+    """
+    return DummyValues(modality)
@@ -1,11 +1,30 @@
 import base64
+import hashlib
 import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, Tuple
 
 import pydicom
-from cryptography.fernet import Fernet
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+if TYPE_CHECKING:
+    from cryptography.fernet import Fernet
+
+
+# Prefix of legacy payloads, the hex encoded salt and token follow
+PAYLOAD_PREFIX = "xx80xx80"
+LEGACY_PAYLOAD_VERSION = 1
+
+# Binary payloads start with the magic and a version byte, followed by the
+# salt and the raw Fernet token. Together with the odd length of the token the
+# header keeps the payload at an even length, as DICOM values must be.
+PAYLOAD_MAGIC = b"DAPX"
+PAYLOAD_VERSION = 2
+SALT_LENGTH = 16
+
+# Number of derived keys kept by decrypt. A batch encrypted with a shared key
+# only needs one entry, files encrypted per file need one entry each.
+KEY_CACHE_SIZE = 64
 
 
 def generate_key(password: str, salt: bytes) -> bytes:
@@ -19,6 +38,11 @@ def generate_key(password: str, salt: bytes) -> bytes:
     Returns:
         bytes: The derived key.
     """
+    # Imported on first use, runs without encrypted tags never load cryptography
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
@@ -30,39 +54,202 @@ def generate_key(password: str, salt: bytes) -> bytes:
     return key
 
 
-def encrypt(data: str, password: str) -> str:
+def _fernet(key: bytes) -> "Fernet":
+    """Create the cipher of a derived key."""
+    from cryptography.fernet import Fernet
+
+    return Fernet(key)
+
+
+# Keys derived by decrypt, least recently used first. The entries are keyed on
+# the salt and a salted digest of the password, so passwords are not kept.
+_derived_keys: "OrderedDict[Tuple[bytes, bytes], bytes]" = OrderedDict()
+
+
+def _cached_key(password: str, salt: bytes) -> bytes:
+    """Derive a key, reusing the result for known password and salt pairs."""
+    entry = (salt, hashlib.sha256(salt + password.encode()).digest())
+    key = _derived_keys.pop(entry, None)
+    if key is None:
+        key = generate_key(password, salt)
+    _derived_keys[entry] = key
+    while len(_derived_keys) > KEY_CACHE_SIZE:
+        _derived_keys.popitem(last=False)
+    return key
+
+
+@dataclass(frozen=True)
+class EncryptionKey:
+    """
+    A key derived once and shared by all files of a run or a study.
+
+    The salt is stored in every payload and doubles as the ID of the key, so
+    payloads sharing a key also share the salt and decrypt only derives the key
+    once for all of them.
+    """
+
+    salt: bytes
+    key: bytes
+
+    @classmethod
+    def derive(cls, password: str, salt: Optional[bytes] = None) -> "EncryptionKey":
+        """
+        Derive a new key from a password.
+
+        Args:
+            password (str): The password.
+            salt (Optional[bytes]): The salt. Defaults to a random salt.
+
+        Returns:
+            EncryptionKey: The derived key.
+        """
+        if salt is None:
+            salt = os.urandom(SALT_LENGTH)
+        return cls(salt=salt, key=generate_key(password, salt))
+
+    @property
+    def key_id(self) -> str:
+        """ID of the key as stored in the payload."""
+        return self.salt.hex()
+
+
+def encrypt(data: str, password: str, key: Optional[EncryptionKey] = None) -> str:
     """
     Encrypt the given data using a password.
 
     Args:
         data (str): The data to encrypt.
         password (str): The password to use for encryption.
+        key (Optional[EncryptionKey]): A key derived from the password beforehand
+            and shared by a batch of files. Defaults to a new key for this data only.
 
     Returns:
         str: The encrypted data.
     """
-    salt = os.urandom(16)
-    key = generate_key(password, salt)
-    cipher_suite = Fernet(key)
+    if key is None:
+        key = EncryptionKey.derive(password)
+    cipher_suite = _fernet(key.key)
     encrypted_data = cipher_suite.encrypt(data.encode())
-    return "xx80xx80" + (salt + encrypted_data).hex()
+    return PAYLOAD_PREFIX + (key.salt + encrypted_data).hex()
+
+
+def encrypt_payload(
+    data: bytes, password: str, key: Optional[EncryptionKey] = None
+) -> bytes:
+    """
+    Encrypt the given data into a binary payload.
+
+    Args:
+        data (bytes): The data to encrypt.
+        password (str): The password to use for encryption.
+        key (Optional[EncryptionKey]): A key derived from the password beforehand
+            and shared by a batch of files. Defaults to a new key for this data only.
+
+    Returns:
+        bytes: The payload, without the hex encoding of legacy payloads.
+    """
+    if key is None:
+        key = EncryptionKey.derive(password)
+    token = _fernet(key.key).encrypt(data)
+    return (
+        PAYLOAD_MAGIC
+        + bytes([PAYLOAD_VERSION])
+        + key.salt
+        + base64.urlsafe_b64decode(token)
+    )
+
+
+def payload_version(payload: bytes) -> int:
+    """
+    Get the format version of an encrypted payload.
+
+    Args:
+        payload (bytes): The stored payload.
+
+    Returns:
+        int: PAYLOAD_VERSION, or LEGACY_PAYLOAD_VERSION for hex encoded payloads.
+
+    Raises:
+        ValueError: If the payload has an unknown format.
+    """
+    if payload.startswith(PAYLOAD_PREFIX.encode()):
+        return LEGACY_PAYLOAD_VERSION
+    if payload.startswith(PAYLOAD_MAGIC) and len(payload) > len(PAYLOAD_MAGIC):
+        return payload[len(PAYLOAD_MAGIC)]
+    raise ValueError("Unknown encrypted payload format")
+
+
+def payload_salt(payload: bytes) -> bytes:
+    """
+    Get the salt of an encrypted payload, which identifies its key.
+
+    Args:
+        payload (bytes): The stored payload.
 
+    Returns:
+        bytes: The salt the key of the payload was derived with.
+    """
+    if payload_version(payload) == LEGACY_PAYLOAD_VERSION:
+        start = len(PAYLOAD_PREFIX)
+        return bytes.fromhex(payload[start : start + 2 * SALT_LENGTH].decode())
+    start = len(PAYLOAD_MAGIC) + 1
+    return payload[start : start + SALT_LENGTH]
+
+
+def _key_for_salt(password: str, salt: bytes, key: Optional[EncryptionKey]) -> bytes:
+    """Use the given key if it matches the salt, a cached or new key otherwise."""
+    if key is not None and key.salt == salt:
+        return key.key
+    return _cached_key(password, salt)
+
+
+def decrypt_payload(
+    payload: bytes, password: str, key: Optional[EncryptionKey] = None
+) -> bytes:
+    """
+    Decrypt a binary payload created by encrypt_payload.
+
+    Args:
+        payload (bytes): The stored payload.
+        password (str): The password used for encryption.
+        key (Optional[EncryptionKey]): A key derived beforehand, used if the
+            payload has its salt. Defaults to a cached or new key.
+
+    Returns:
+        bytes: The decrypted data.
 
-def decrypt(data: str, password: str) -> str:
+    Raises:
+        ValueError: If the payload has an unsupported version.
+        cryptography.fernet.InvalidToken: If the password is wrong.
+    """
+    version = payload_version(payload)
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported encrypted payload version {version}")
+    start = len(PAYLOAD_MAGIC) + 1
+    salt = payload[start : start + SALT_LENGTH]
+    token = base64.urlsafe_b64encode(payload[start + SALT_LENGTH :])
+    return _fernet(_key_for_salt(password, salt, key)).decrypt(token)
+
+
+def decrypt(data: str, password: str, key: Optional[EncryptionKey] = None) -> str:
     """
     Decrypt the given data using a password.
 
+    Keys are cached by salt, so payloads encrypted with a shared key only pay
+    for the key derivation once.
+
     Args:
         data (str): The encrypted data.
         password (str): The password used for encryption.
+        key (Optional[EncryptionKey]): A key derived beforehand, used if the
+            data has its salt. Defaults to a cached or new key.
 
     Returns:
         str: The decrypted data.
     """
-    decoded_data = bytes.fromhex(data[8:])
-    salt, encrypted_data = decoded_data[:16], decoded_data[16:]
-    key = generate_key(password, salt)
-    cipher_suite = Fernet(key)
+    decoded_data = bytes.fromhex(data[len(PAYLOAD_PREFIX) :])
+    salt, encrypted_data = decoded_data[:SALT_LENGTH], decoded_data[SALT_LENGTH:]
+    cipher_suite = _fernet(_key_for_salt(password, salt, key))
     decrypted_data = cipher_suite.decrypt(encrypted_data)
     return decrypted_data.decode()
 
@@ -1,9 +1,165 @@
-import pydicom
 import os
-from typing import List, Optional, Dict, Union, Tuple, Set
+import struct
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import pydicom
+from pydicom.charset import default_encoding
+from pydicom.uid import DeflatedExplicitVRLittleEndian
 
-from cryptography.fernet import Fernet
+from utilities.dataset_walker import dataset_tags
 from utilities.encryption_manager import detect_if_encrypted
+from utilities.tag_inventory import TagInventory
+
+if TYPE_CHECKING:
+    from utilities.scan_manifest import ScanManifest
+
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b"DICM"
+
+# Number of bytes read from the start of a file to decide whether it is a DICOM
+# file. Large enough to hold the preamble, the magic and a handful of elements
+# of the first group for files written without a preamble.
+HEADER_PROBE_SIZE = 512
+
+# VRs whose explicit VR element header uses 2 reserved bytes and a 4 byte length
+_LONG_LENGTH_VRS = {
+    b"OB",
+    b"OD",
+    b"OF",
+    b"OL",
+    b"OV",
+    b"OW",
+    b"SQ",
+    b"SV",
+    b"UC",
+    b"UN",
+    b"UR",
+    b"UT",
+    b"UV",
+}
+_VALID_VRS = _LONG_LENGTH_VRS | {
+    b"AE",
+    b"AS",
+    b"AT",
+    b"CS",
+    b"DA",
+    b"DS",
+    b"DT",
+    b"FD",
+    b"FL",
+    b"IS",
+    b"LO",
+    b"LT",
+    b"PN",
+    b"SH",
+    b"SL",
+    b"SS",
+    b"ST",
+    b"TM",
+    b"UI",
+    b"UL",
+    b"US",
+}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Suffix of output files which are still being written
+PARTIAL_SUFFIX = ".part"
+
+# Pixel Data, Double Float Pixel Data and Float Pixel Data
+PIXEL_DATA_TAGS = {0x7FE00010, 0x7FE00009, 0x7FE00008}
+
+
+@dataclass(frozen=True)
+class PixelDataInfo:
+    """Location of the top-level pixel data element inside a DICOM file."""
+
+    offset: int
+    tag: int
+    VR: Optional[str]
+    length: int
+
+
+def iter_dcm_files(folder: str) -> Iterator[str]:
+    """
+    Lazily yield the DICOM files below a given folder.
+
+    The tree is walked top-down with ``os.scandir`` and every regular file is
+    checked with the header-only ``is_file_a_dicom`` test, so no dataset is
+    parsed during discovery.
+
+    Parameters:
+        folder (str): Path to the folder containing DICOM files.
+
+    Yields:
+        str: Path to the next DICOM file.
+    """
+    pending = [folder]
+    while pending:
+        current = pending.pop()
+        sub_folders = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_folders.append(entry.path)
+                        elif (
+                            entry.is_file()
+                            and not entry.name.endswith(PARTIAL_SUFFIX)
+                            and is_file_a_dicom(entry.path)
+                        ):
+                            yield entry.path
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        # Keep the same top-down order as os.walk
+        pending.extend(reversed(sub_folders))
+
+
+@contextmanager
+def atomic_output(output_filepath: str) -> Iterator[str]:
+    """
+    Write an output file under a temporary name and rename it when complete.
+
+    The temporary file lives next to the output file, so the rename is atomic
+    and an interrupted run never leaves a truncated output file behind.
+
+    Parameters:
+        output_filepath (str): Path of the output file.
+
+    Yields:
+        str: Path the file has to be written to.
+    """
+    Path(output_filepath).parent.mkdir(parents=True, exist_ok=True)
+    partial_filepath = output_filepath + PARTIAL_SUFFIX
+    try:
+        yield partial_filepath
+        os.replace(partial_filepath, output_filepath)
+    except BaseException:
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        raise
+
+
+def describe_error(error: Exception) -> str:
+    """Describe an error of a single file, including its type."""
+    message = str(error)
+    return f"{type(error).__name__}: {message}" if message else type(error).__name__
 
 
 def load_dcm_files(folder: str) -> List[str]:
@@ -16,20 +172,18 @@ def load_dcm_files(folder: str) -> List[str]:
     Returns:
         List[str]: List of paths to DICOM files.
     """
-    dcm_files = []
-    # Iterate through all files in the folder and its subfolders
-    for root, _, files in os.walk(folder):
-        for file in files:
-            # If the file is a DICOM file, add its path to the list
-            if is_file_a_dicom(os.path.join(root, file)):
-                dcm_files.append(os.path.join(root, file))
-    return dcm_files
+    return list(iter_dcm_files(folder))
 
 
 def is_file_a_dicom(file: str) -> bool:
     """
     Check if a file is a DICOM file.
 
+    Only the first ``HEADER_PROBE_SIZE`` bytes are read. A file is accepted if
+    it carries the "DICM" magic after the 128-byte preamble, or if it starts
+    with a well-formed first group (0002 or 0008), which is how DICOM files
+    without a preamble are written.
+
     Parameters:
         file (str): Path to the file to identify.
 
@@ -37,10 +191,87 @@ def is_file_a_dicom(file: str) -> bool:
         bool: True if the file is DICOM, False otherwise.
     """
     try:
-        pydicom.dcmread(file)
-    except pydicom.errors.InvalidDicomError:
+        with open(file, "rb") as fp:
+            header = fp.read(HEADER_PROBE_SIZE)
+    except OSError:
         return False
-    return True
+    return is_dicom_header(header)
+
+
+def is_dicom_header(header: bytes) -> bool:
+    """
+    Check if the first bytes of a file or archive member are DICOM.
+
+    Parameters:
+        header (bytes): Up to the first ``HEADER_PROBE_SIZE`` bytes.
+
+    Returns:
+        bool: True if the bytes start a DICOM file, see is_file_a_dicom.
+    """
+    magic_end = DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC)
+    if header[DICOM_PREAMBLE_LENGTH:magic_end] == DICOM_MAGIC:
+        return True
+    return _starts_with_dicom_group(header)
+
+
+def _starts_with_dicom_group(header: bytes) -> bool:
+    """
+    Check if a byte buffer starts with the elements of a DICOM group.
+
+    The elements of the first group are parsed as little endian, either explicit
+    or implicit VR, until the group ends or the buffer is exhausted. Every
+    element must have a known VR (explicit VR only) and ascending element
+    numbers, and fixed-length values have to be plausible.
+
+    Parameters:
+        header (bytes): First bytes of the file.
+
+    Returns:
+        bool: True if at least one well-formed element was found.
+    """
+    if len(header) < 8:
+        return False
+    group = struct.unpack_from("<H", header)[0]
+    if group not in (0x0002, 0x0008):
+        return False
+    is_explicit_vr = header[4:6] in _VALID_VRS
+
+    offset = 0
+    elements = 0
+    previous_element = -1
+    while offset + 8 <= len(header):
+        element_group, element = struct.unpack_from("<HH", header, offset)
+        if element_group != group:
+            break
+        if element <= previous_element:
+            return False
+        previous_element = element
+
+        if is_explicit_vr:
+            vr = header[offset + 4 : offset + 6]
+            if vr not in _VALID_VRS:
+                return False
+            if vr in _LONG_LENGTH_VRS:
+                if offset + 12 > len(header):
+                    break
+                length = struct.unpack_from("<L", header, offset + 8)[0]
+                offset += 12
+            else:
+                length = struct.unpack_from("<H", header, offset + 6)[0]
+                offset += 8
+        else:
+            length = struct.unpack_from("<L", header, offset + 4)[0]
+            offset += 8
+            # A plain data element of the command/identifying groups is never
+            # this large; random binary data usually is
+            if length != _UNDEFINED_LENGTH and length > 0xFFFF:
+                return False
+
+        elements += 1
+        if length == _UNDEFINED_LENGTH:
+            break
+        offset += length
+    return elements > 0
 
 
 def check_config(config: Optional[Dict[str, List[str]]]) -> Dict[str, List[str]]:
@@ -61,70 +292,172 @@ def check_config(config: Optional[Dict[str, List[str]]]) -> Dict[str, List[str]]
     return config
 
 
-def get_tags(folder: str) -> Set[Tuple[str, str, str]]:
+def read_dicom_header(
+    file: Union[str, BinaryIO],
+) -> Tuple[pydicom.dataset.FileDataset, Optional[PixelDataInfo]]:
     """
-    Get unique tags from DICOM files in a given folder.
+    Read a DICOM file up to, but not including, its pixel data.
 
     Parameters:
-        folder (str): Path to the folder containing DICOM files.
+        file (Union[str, BinaryIO]): Path to the DICOM file, or a seekable
+            binary file object positioned at its start.
 
     Returns:
-        Set[Tuple[str, str, str]]: Set of unique tags in the form (tag_flag, tag_name, value).
+        Tuple[FileDataset, Optional[PixelDataInfo]]: The dataset without pixel
+        data and the location of the pixel data element, or None if the file
+        has no pixel data.
     """
-    tags_set = set()
+    found = {}
 
-    # Read a representative DICOM file to get the tag values
-    flags = []
-    for representative_file in load_dcm_files(folder):
-        ds = pydicom.dcmread(str(representative_file))
+    def stop_at_pixel_data(tag, vr, length):
+        if tag in PIXEL_DATA_TAGS:
+            found.update(tag=int(tag), VR=vr, length=length)
+            return True
+        return False
 
-        if detect_if_encrypted(ds):
-            raise ValueError
-        for elem in ds:
-            tag_flag = str(elem.tag)
-            if tag_flag in flags:
-                continue
-            flags.append(tag_flag)
-            tag_name = elem.keyword
-            if tag_name:
-                value = str(elem.value)[:20]
-                tags_set.add((tag_flag, tag_name, value))
-    return tags_set
+    if isinstance(file, str):
+        with open(file, "rb") as fp:
+            ds = pydicom.filereader.read_partial(
+                fp, stop_when=stop_at_pixel_data, force=True
+            )
+            offset = fp.tell()
+        ds.filename = file
+    else:
+        ds = pydicom.filereader.read_partial(
+            file, stop_when=stop_at_pixel_data, force=True
+        )
+        offset = file.tell()
+    pixel_info = PixelDataInfo(offset=offset, **found) if found else None
+    return ds, pixel_info
 
 
-def encrypt(
-    string: Union[str, pydicom.multival.MultiValue], fernet: Fernet
-) -> Union[bytes, List[bytes]]:
+def read_trailing_elements(
+    file: Union[str, BinaryIO],
+    ds: pydicom.Dataset,
+    pixel_info: PixelDataInfo,
+) -> pydicom.Dataset:
     """
-    Encrypt a string using a Fernet object.
+    Read the top-level elements stored after the pixel data of a file.
+
+    Elements such as Data Set Trailing Padding, Digital Signatures Sequence or
+    private groups above the pixel data follow it in the file and are not part
+    of the dataset returned by read_dicom_header. The pixel data is skipped
+    without reading it, fragment by fragment if it is encapsulated.
 
     Parameters:
-        string (Union[str, pydicom.multival.MultiValue]): String or MultiValue object to encrypt.
-        fernet (Fernet): Fernet object for encryption.
+        file (Union[str, BinaryIO]): Path to the DICOM file, or a seekable
+            binary file object.
+        ds (pydicom.Dataset): Dataset returned by read_dicom_header.
+        pixel_info (PixelDataInfo): Location of the pixel data returned with it.
 
     Returns:
-        Union[bytes, List[bytes]]: Encrypted data.
+        pydicom.Dataset: The elements after the pixel data, empty if there are
+            none.
+
+    Raises:
+        ValueError: If the pixel data or the elements after it can not be
+            parsed, or the dataset is deflated.
+    """
+    file_meta = getattr(ds, "file_meta", None) or {}
+    if file_meta.get("TransferSyntaxUID") == DeflatedExplicitVRLittleEndian:
+        raise ValueError("Can not locate the elements of a deflated dataset")
+    is_implicit_VR = getattr(ds, "is_implicit_VR", False)
+    is_little_endian = getattr(ds, "is_little_endian", True)
+    if isinstance(file, str):
+        with open(file, "rb") as fp:
+            return _read_trailing(fp, ds, pixel_info, is_implicit_VR, is_little_endian)
+    return _read_trailing(file, ds, pixel_info, is_implicit_VR, is_little_endian)
+
+
+def add_trailing_elements(
+    ds: pydicom.Dataset, file: Union[str, BinaryIO], pixel_info: PixelDataInfo
+) -> None:
+    """
+    Add the elements stored after the pixel data to a header read before it.
+
+    Scans use this, so tags after the pixel data can get rules like any other
+    tag. Elements which can not be parsed are left out, the anonymization
+    reads such files completely.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset returned by read_dicom_header.
+        file (Union[str, BinaryIO]): Path to the DICOM file, or a seekable
+            binary file object.
+        pixel_info (PixelDataInfo): Location of the pixel data returned with it.
     """
-    if isinstance(string, pydicom.multival.MultiValue):
-        # If the string is a pydicom MultiValue object, encrypt each value in the object
-        return [
-            fernet.encrypt((str(type(string)) + "%" + str(string)).encode())
-            for _ in string
-        ]
-    # Otherwise, encrypt the string
-    return fernet.encrypt((str(type(string)) + "%" + str(string)).encode())
+    try:
+        trailing = read_trailing_elements(file, ds, pixel_info)
+    except ValueError:
+        return
+    for tag in trailing.keys():
+        ds[tag] = trailing.get_item(tag)
+
+
+def _read_trailing(
+    fp: BinaryIO,
+    ds: pydicom.Dataset,
+    pixel_info: PixelDataInfo,
+    is_implicit_VR: bool,
+    is_little_endian: bool,
+) -> pydicom.Dataset:
+    endian = "<" if is_little_endian else ">"
+    fp.seek(pixel_info.offset + (8 if pixel_info.VR is None else 12))
+    if pixel_info.length != _UNDEFINED_LENGTH:
+        fp.seek(pixel_info.length, os.SEEK_CUR)
+    else:
+        # Encapsulated pixel data, items up to the sequence delimiter
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                raise ValueError("The encapsulated pixel data is not terminated")
+            group, element, length = struct.unpack(endian + "HHL", header)
+            if (group, element) == (0xFFFE, 0xE0DD):
+                break
+            if (group, element) != (0xFFFE, 0xE000) or length == _UNDEFINED_LENGTH:
+                raise ValueError("Invalid item in the encapsulated pixel data")
+            fp.seek(length, os.SEEK_CUR)
+    try:
+        return pydicom.filereader.read_dataset(
+            fp,
+            is_implicit_VR,
+            is_little_endian,
+            parent_encoding=ds.get("SpecificCharacterSet", default_encoding),
+        )
+    except Exception as e:
+        raise ValueError(f"Invalid elements after the pixel data: {e}") from e
 
 
-def decrypt(string: bytes, fernet: Fernet) -> str:
+def get_tags(
+    folder: str, manifest: Optional["ScanManifest"] = None
+) -> Set[Tuple[str, str, str]]:
     """
-    Decrypt a string using a Fernet object.
+    Get unique tags from DICOM files in a given folder.
 
     Parameters:
-        string (bytes): Encrypted data.
-        fernet (Fernet): Fernet object for decryption.
+        folder (str): Path to the folder containing DICOM files.
+        manifest (Optional[ScanManifest], optional): Scan of the folder. If given,
+            the tags collected during the scan are used instead of reading the
+            files again. Defaults to None.
 
     Returns:
-        str: Decrypted string.
+        Set[Tuple[str, str, str]]: Set of unique tags in the form (tag_flag, tag_name, value).
     """
-    # Decrypt the string and return the decoded result
-    return fernet.decrypt(string).decode()
+    if manifest is not None:
+        if manifest.encrypted:
+            raise ValueError
+        return set(manifest.tags_set)
+
+    inventory = TagInventory()
+    for representative_file in iter_dcm_files(folder):
+        ds, pixel_info = read_dicom_header(representative_file)
+        if pixel_info is not None:
+            add_trailing_elements(ds, representative_file, pixel_info)
+
+        if detect_if_encrypted(ds):
+            raise ValueError
+        inventory.add_dataset(ds)
+        tags = dataset_tags(ds)
+        if pixel_info is not None:
+            tags.add(pixel_info.tag)
+        inventory.add_file_tags(frozenset(tags))
+    return inventory.tags_set()
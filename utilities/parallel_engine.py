@@ -0,0 +1,319 @@
+import multiprocessing
+import queue
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utilities.anonymization_core import anonymize_file, get_output_path
+from utilities.anonymization_plan import AnonymizationPlan
+from utilities.encryption_manager import EncryptionKey
+from utilities.helper_function import describe_error
+from utilities.run_metrics import RunMetrics
+
+# Files handed to a worker per task. Small enough to balance the load between
+# workers, large enough to keep the task overhead low.
+DEFAULT_CHUNK_SIZE = 16
+
+# Per-process state set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(
+    process_file: Callable[..., None],
+    args: Tuple[Any, ...],
+    isolate_errors: bool,
+    collect_metrics: bool,
+    progress_queue: multiprocessing.Queue,
+    cancel_event: multiprocessing.Event,
+) -> None:
+    """Receive the run settings once per worker process."""
+    _worker_state["process_file"] = process_file
+    _worker_state["args"] = args
+    _worker_state["isolate_errors"] = isolate_errors
+    _worker_state["collect_metrics"] = collect_metrics
+    _worker_state["progress_queue"] = progress_queue
+    _worker_state["cancel_event"] = cancel_event
+    for arg in args:
+        if isinstance(arg, AnonymizationPlan) and arg.pseudonymizer is not None:
+            arg.pseudonymizer.close_at_exit()
+
+
+def _process_chunk(chunk: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Process a chunk of files inside a worker process."""
+    process_file = _worker_state["process_file"]
+    args = _worker_state["args"]
+    metrics = RunMetrics() if _worker_state["collect_metrics"] else None
+    # Only functions collecting metrics receive them
+    kwargs = {} if metrics is None else {"metrics": metrics}
+    for dcm_file in chunk:
+        if _worker_state["cancel_event"].is_set():
+            break
+        error = None
+        try:
+            process_file(dcm_file, *args, **kwargs)
+        except Exception as e:
+            if not _worker_state["isolate_errors"]:
+                raise
+            error = describe_error(e)
+            if metrics is not None:
+                metrics.count("errors")
+        _worker_state["progress_queue"].put((dcm_file, error))
+    return None if metrics is None else metrics.as_dict()
+
+
+def _drain(progress_queue: multiprocessing.Queue) -> List[Tuple[str, Optional[str]]]:
+    """Collect the files reported as finished since the last call."""
+    done = []
+    while True:
+        try:
+            done.append(progress_queue.get_nowait())
+        except queue.Empty:
+            return done
+
+
+def run_files_parallel(
+    files: List[str],
+    process_file: Callable[..., None],
+    args: Tuple[Any, ...],
+    workers: int,
+    progress_callback: Optional[Callable[[List[str]], None]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    error_callback: Optional[Callable[[str, str], None]] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> int:
+    """
+    Process files with a pool of worker processes.
+
+    Every worker calls ``process_file(path, *args)`` for the files of its
+    chunks, with a ``metrics`` keyword argument if metrics are collected. The
+    function and its arguments are sent once per worker, so ``process_file``
+    has to be a module level function. On cancellation the workers finish the
+    file they are working on and stop.
+
+    Parameters:
+        files (List[str]): Paths of the files to process.
+        process_file (Callable[..., None]): Function processing a single file.
+        args (Tuple[Any, ...]): Arguments passed after the path.
+        workers (int): Number of worker processes.
+        progress_callback (Optional[Callable[[List[str]], None]], optional):
+            Called in the calling process with the files finished since the
+            last call, including failed files. Defaults to None.
+        chunk_size (int, optional): Files per task. Defaults to DEFAULT_CHUNK_SIZE.
+        should_cancel (Optional[Callable[[], bool]], optional): Polled in the
+            calling process, stops the run once it returns True.
+            Defaults to None.
+        error_callback (Optional[Callable[[str, str], None]], optional): Called
+            with the path and the error of every file which failed, the other
+            files are still processed. Defaults to re-raising the first error
+            in the calling process.
+        metrics (Optional[RunMetrics], optional): Metrics the metrics collected
+            by the workers are merged into once they finish a chunk.
+            Defaults to not collecting metrics.
+
+    Returns:
+        int: Number of finished files, including failed files.
+    """
+    progress_queue = multiprocessing.Queue()
+    cancel_event = multiprocessing.Event()
+    chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+    done = 0
+
+    def report(finished: List[Tuple[str, Optional[str]]]) -> None:
+        if error_callback is not None:
+            for dcm_file, error in finished:
+                if error is not None:
+                    error_callback(dcm_file, error)
+        if progress_callback is not None and finished:
+            progress_callback([dcm_file for dcm_file, _ in finished])
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(
+            process_file,
+            args,
+            error_callback is not None,
+            metrics is not None,
+            progress_queue,
+            cancel_event,
+        ),
+    ) as pool:
+        pending = {pool.submit(_process_chunk, chunk) for chunk in chunks}
+        while pending:
+            finished, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                # Re-raise errors of the workers in the calling process
+                if not future.cancelled():
+                    chunk_metrics = future.result()
+                    if chunk_metrics is not None:
+                        metrics.merge(chunk_metrics)
+            if should_cancel is not None and should_cancel():
+                cancel_event.set()
+                for future in pending:
+                    future.cancel()
+            finished_files = _drain(progress_queue)
+            done += len(finished_files)
+            report(finished_files)
+    # Messages still in flight when the last task returned
+    finished_files = _drain(progress_queue)
+    done += len(finished_files)
+    report(finished_files)
+    return done
+
+
+def _anonymize_in_folder(
+    dcm_file: str,
+    folder: str,
+    output_folder: str,
+    plan: AnonymizationPlan,
+    password: str,
+    key: Optional[EncryptionKey],
+    metrics: Optional[RunMetrics] = None,
+) -> None:
+    """Anonymize a file into the mirrored output folder."""
+    output_filepath = get_output_path(dcm_file, folder, output_folder)
+    anonymize_file(dcm_file, output_filepath, plan, password, key, metrics=metrics)
+
+
+def process_files_parallel(
+    files: List[str],
+    folder: str,
+    output_folder: str,
+    plan: AnonymizationPlan,
+    password: str,
+    workers: int,
+    progress_callback: Optional[Callable[[List[str]], None]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    key: Optional[EncryptionKey] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    metrics: Optional[RunMetrics] = None,
+    error_callback: Optional[Callable[[str, str], None]] = None,
+) -> int:
+    """
+    Anonymize files with a pool of worker processes.
+
+    Every worker reads, anonymizes and writes its files on its own, the output
+    is the same as when the files are processed one after another. On
+    cancellation the workers finish the file they are writing and stop, files
+    which were not reported as processed have not been written.
+
+    Parameters:
+        files (List[str]): Paths of the files to anonymize.
+        folder (str): Input folder.
+        output_folder (str): Output folder, mirroring the input folder.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        workers (int): Number of worker processes.
+        progress_callback (Optional[Callable[[List[str]], None]], optional):
+            Called in the calling process with the files processed since the
+            last call. Defaults to None.
+        chunk_size (int, optional): Files per task. Defaults to DEFAULT_CHUNK_SIZE.
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key per file.
+        should_cancel (Optional[Callable[[], bool]], optional): Polled in the
+            calling process, stops the run once it returns True.
+            Defaults to None.
+        metrics (Optional[RunMetrics], optional): Metrics the time per stage
+            and the counters of the workers are added to. Defaults to None.
+        error_callback (Optional[Callable[[str, str], None]], optional): Called
+            with the path and the error of every file which failed, before the
+            file is passed to progress_callback. Defaults to stopping the run
+            at the first error.
+
+    Returns:
+        int: Number of processed files, including failed files.
+    """
+    return run_files_parallel(
+        files,
+        _anonymize_in_folder,
+        (folder, output_folder, plan, password, key),
+        workers,
+        progress_callback=progress_callback,
+        chunk_size=chunk_size,
+        should_cancel=should_cancel,
+        error_callback=error_callback,
+        metrics=metrics,
+    )
+
+
+def anonymize_files(
+    files: List[str],
+    folder: str,
+    output_folder: str,
+    plan: AnonymizationPlan,
+    password: str,
+    workers: int = 1,
+    key: Optional[EncryptionKey] = None,
+    progress_callback: Optional[Callable[[List[str]], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+    error_callback: Optional[Callable[[str, str], None]] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Anonymize files into a mirrored output folder.
+
+    A file which can not be anonymized, such as a corrupt file or a file whose
+    element rejects its new value, does not stop the run. It is reported in
+    the returned list and no output is written for it.
+
+    Parameters:
+        files (List[str]): Paths of the files to anonymize.
+        folder (str): Input folder.
+        output_folder (str): Output folder, mirroring the input folder.
+        plan (AnonymizationPlan): Compiled rules to apply.
+        password (str): Password used for tags set to "Encrypt".
+        workers (int, optional): Number of worker processes, 1 anonymizes the
+            files in the calling process. Defaults to 1.
+        key (Optional[EncryptionKey], optional): Key shared by all files of the
+            run. Defaults to deriving a key per file.
+        progress_callback (Optional[Callable[[List[str]], None]], optional):
+            Called with the files finished since the last call, including
+            failed files. Defaults to None.
+        should_cancel (Optional[Callable[[], bool]], optional): Polled between
+            files, stops the run once it returns True. Defaults to None.
+        error_callback (Optional[Callable[[str, str], None]], optional): Called
+            with the path and the error of every file which failed, before the
+            file is passed to progress_callback. Defaults to None.
+        metrics (Optional[RunMetrics], optional): Metrics the time per stage
+            and the counters of the files are added to. Defaults to None.
+
+    Returns:
+        List[Tuple[str, str]]: Path and error message of every failed file.
+    """
+    failures = []
+
+    def failed(dcm_file: str, error: str) -> None:
+        failures.append((dcm_file, error))
+        if error_callback is not None:
+            error_callback(dcm_file, error)
+
+    if workers > 1:
+        process_files_parallel(
+            files,
+            folder,
+            output_folder,
+            plan,
+            password,
+            workers,
+            progress_callback=progress_callback,
+            key=key,
+            should_cancel=should_cancel,
+            metrics=metrics,
+            error_callback=failed,
+        )
+        return failures
+
+    for dcm_file in files:
+        if should_cancel is not None and should_cancel():
+            break
+        try:
+            _anonymize_in_folder(
+                dcm_file, folder, output_folder, plan, password, key, metrics
+            )
+        except Exception as e:
+            if metrics is not None:
+                metrics.count("errors")
+            failed(dcm_file, describe_error(e))
+        if progress_callback is not None:
+            progress_callback([dcm_file])
+    return failures
@@ -0,0 +1,167 @@
+import ast
+import io
+import json
+import struct
+from typing import Any, List, Optional, Union
+
+import pydicom
+from pydicom.charset import convert_encodings
+from pydicom.dataelem import DataElement, RawDataElement
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import correct_ambiguous_vr_element, write_data_element
+from pydicom.valuerep import EXPLICIT_VR_LENGTH_32, STANDARD_VR
+
+from utilities.dataset_walker import dictionary_VR
+
+SPECIFIC_CHARACTER_SET = 0x00080005
+_DEFAULT_CHARACTER_SET = ["ISO_IR 6"]
+
+
+def encode_elements(
+    elements: List[Union[DataElement, RawDataElement]], ds: Dataset
+) -> bytes:
+    """
+    Encode data elements as an explicit VR little endian DICOM dataset.
+
+    Elements still in their raw form keep the value bytes of the source file
+    where possible, so their values are neither decoded nor encoded again.
+    Elements of big endian files, sequences and ambiguous VRs of implicit VR
+    files and elements already decoded are encoded by pydicom. Either way
+    every element keeps its VR and value, including multi-valued elements,
+    person names, binary values and sequences.
+
+    The encoded dataset is preceded by the character set of the source, which
+    the text values are encoded in.
+
+    Parameters:
+        elements (List[Union[DataElement, RawDataElement]]): Elements to encode.
+        ds (pydicom.Dataset): Dataset the elements were removed from.
+
+    Returns:
+        bytes: The encoded elements.
+    """
+    character_set = _character_set(elements, ds)
+    header = "\\".join(character_set).encode()
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = False
+    fp.write(struct.pack("<H", len(header)) + header)
+    for elem in sorted(elements, key=lambda elem: elem.tag):
+        raw_bytes = _encode_raw(elem) if isinstance(elem, RawDataElement) else None
+        if raw_bytes is not None:
+            fp.write(raw_bytes)
+        else:
+            write_data_element(fp, _decoded(elem, ds, character_set), character_set)
+    return fp.getvalue()
+
+
+def decode_elements(data: bytes) -> List[DataElement]:
+    """
+    Decode data elements encoded by encode_elements.
+
+    Parameters:
+        data (bytes): The encoded elements.
+
+    Returns:
+        List[DataElement]: The decoded elements in tag order.
+    """
+    (header_length,) = struct.unpack_from("<H", data)
+    character_set = data[2 : 2 + header_length].decode().split("\\")
+    payload = read_dataset(
+        io.BytesIO(data[2 + header_length :]),
+        is_implicit_VR=False,
+        is_little_endian=True,
+        parent_encoding=convert_encodings(character_set),
+    )
+    return list(payload)
+
+
+def _character_set(
+    elements: List[Union[DataElement, RawDataElement]], ds: Dataset
+) -> List[str]:
+    """Get the character set of the source, which may be one of the elements."""
+    for elem in elements:
+        if elem.tag == SPECIFIC_CHARACTER_SET:
+            charset_ds = Dataset()
+            charset_ds.add(elem)
+            value = charset_ds.SpecificCharacterSet
+            break
+    else:
+        value = ds.get("SpecificCharacterSet")
+    if not value:
+        return _DEFAULT_CHARACTER_SET
+    if isinstance(value, str):
+        return [value]
+    return [term or _DEFAULT_CHARACTER_SET[0] for term in value]
+
+
+def _encode_raw(elem: RawDataElement) -> Optional[bytes]:
+    """Frame the value bytes of a raw element, None if they can not be kept."""
+    if not elem.is_little_endian or elem.value is None:
+        return None
+    VR = elem.VR
+    if elem.is_implicit_VR:
+        VR = dictionary_VR(elem.tag) or "UN"
+        # Nested elements would have to be converted to explicit VR
+        if VR == "SQ":
+            return None
+    if VR not in STANDARD_VR:
+        return None
+    value = elem.value
+    length = len(value)
+    tag = struct.pack("<HH", elem.tag >> 16, elem.tag & 0xFFFF)
+    if VR in EXPLICIT_VR_LENGTH_32:
+        return tag + VR.encode() + struct.pack("<HL", 0, length) + value
+    if length > 0xFFFF:
+        return None
+    return tag + VR.encode() + struct.pack("<H", length) + value
+
+
+def _decoded(
+    elem: Union[DataElement, RawDataElement], ds: Dataset, character_set: List[str]
+) -> DataElement:
+    """Decode an element and resolve an ambiguous VR against its dataset."""
+    if isinstance(elem, RawDataElement):
+        elem = pydicom.dataelem.DataElement_from_raw(elem, character_set)
+    if " or " in elem.VR:
+        try:
+            correct_ambiguous_vr_element(elem, ds, True)
+        except AttributeError:
+            # The element deciding the VR is not in the dataset
+            elem.VR = elem.VR.split(" or ")[0]
+    return elem
+
+
+def decode_legacy_elements(data: str) -> List[DataElement]:
+    """
+    Decode data elements of a legacy JSON payload.
+
+    Values which were not JSON serializable were stored as their string
+    representation. Multi-valued elements are parsed back into lists, other
+    values are restored as strings. Sequences can not be restored from their
+    string representation and are skipped.
+
+    Parameters:
+        data (str): The JSON payload, indexed by tag.
+
+    Returns:
+        List[DataElement]: The decoded elements.
+    """
+    elements = []
+    for tag in json.loads(data).values():
+        if tag["VR"] != "SQ":
+            elements.append(_legacy_element(tag["tag"], tag["VR"], tag["value"]))
+    return elements
+
+
+def _legacy_element(tag: int, VR: str, value: Any) -> DataElement:
+    """Create an element from a legacy payload entry."""
+    try:
+        return DataElement(tag, VR, value)
+    except ValueError:
+        # e.g. "[-125, -95, 0]" of a multi-valued DS element
+        if not (isinstance(value, str) and value.startswith("[")):
+            raise
+        return DataElement(tag, VR, ast.literal_eval(value))
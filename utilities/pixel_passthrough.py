@@ -0,0 +1,57 @@
+import shutil
+from typing import Optional
+
+import pydicom
+
+from utilities.helper_function import PixelDataInfo
+
+# Transfer syntaxes whose dataset is compressed as a whole, the position of the
+# pixel data in the file is not known
+DEFLATED_TRANSFER_SYNTAXES = {"1.2.840.10008.1.2.1.99"}
+
+# Size of the chunks the pixel data is copied in
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def can_pass_through(ds: pydicom.Dataset, pixel_info: Optional[PixelDataInfo]) -> bool:
+    """
+    Check if the pixel data of a file can be copied without decoding it.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset read up to the pixel data.
+        pixel_info (Optional[PixelDataInfo]): Location of the pixel data.
+
+    Returns:
+        bool: True if the pixel data can be copied byte for byte.
+    """
+    if pixel_info is None:
+        return False
+    file_meta = getattr(ds, "file_meta", None) or {}
+    transfer_syntax = file_meta.get("TransferSyntaxUID", "")
+    return transfer_syntax not in DEFLATED_TRANSFER_SYNTAXES
+
+
+def write_with_pixel_passthrough(
+    ds: pydicom.Dataset,
+    pixel_info: PixelDataInfo,
+    source_filepath: str,
+    output_filepath: str,
+) -> None:
+    """
+    Write a dataset read up to its pixel data and copy the rest of the source.
+
+    The header is encoded with the transfer syntax of the source, the pixel data
+    element and everything after it are then copied from the source file in
+    chunks, so memory use does not depend on the size of the pixel data.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset read up to the pixel data, with all
+            changes applied.
+        pixel_info (PixelDataInfo): Location of the pixel data in the source file.
+        source_filepath (str): Path of the source file.
+        output_filepath (str): Path of the output file.
+    """
+    with open(output_filepath, "wb") as output, open(source_filepath, "rb") as source:
+        pydicom.dcmwrite(output, ds, write_like_original=True)
+        source.seek(pixel_info.offset)
+        shutil.copyfileobj(source, output, COPY_CHUNK_SIZE)
@@ -0,0 +1,374 @@
+import dataclasses
+import json
+import shutil
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+import numpy as np
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless
+
+from utilities.helper_function import PixelDataInfo
+from utilities.pixel_passthrough import COPY_CHUNK_SIZE, can_pass_through
+
+PIXEL_DATA = 0x7FE00010
+FLOAT_PIXEL_DATA = 0x7FE00008
+DOUBLE_FLOAT_PIXEL_DATA = 0x7FE00009
+
+# Type of the values of the float pixel data elements, which are never
+# compressed
+FLOAT_DTYPES = {FLOAT_PIXEL_DATA: "f4", DOUBLE_FLOAT_PIXEL_DATA: "f8"}
+
+# Bytes of pixel data redacted at once when it is streamed from the source file,
+# bounding the memory used for multi-frame images
+REDACTION_CHUNK_SIZE = 16 * 1024 * 1024
+
+# VRs whose explicit VR element header has a 4 byte length
+_LONG_HEADER_VRS = {"OB", "OD", "OF", "OL", "OV", "OW", "SQ", "UC", "UN", "UR", "UT"}
+
+# Box of a mask: x, y, width and height in pixels
+Box = Tuple[int, int, int, int]
+
+
+@dataclass(frozen=True)
+class RedactionRule:
+    """
+    Rectangles to blank in the images of a device.
+
+    A rule applies to a file if every criterion which is set matches its
+    header, text criteria ignore case and surrounding spaces.
+    """
+
+    boxes: Tuple[Box, ...]
+    manufacturer: Optional[str] = None
+    model: Optional[str] = None
+    rows: Optional[int] = None
+    columns: Optional[int] = None
+    fill: int = 0
+
+    def matches(self, ds: pydicom.Dataset) -> bool:
+        for keyword, expected in (
+            ("Manufacturer", self.manufacturer),
+            ("ManufacturerModelName", self.model),
+        ):
+            if expected is not None and (
+                str(ds.get(keyword, "")).strip().lower() != expected.strip().lower()
+            ):
+                return False
+        for keyword, expected in (("Rows", self.rows), ("Columns", self.columns)):
+            if expected is not None and ds.get(keyword) != expected:
+                return False
+        return True
+
+
+@dataclass(frozen=True)
+class PixelLayout:
+    """Layout of native pixel data, taken from the header of a file."""
+
+    frames: int
+    rows: int
+    columns: int
+    samples: int
+    planar: bool
+    dtype: str
+
+    @classmethod
+    def from_dataset(cls, ds: pydicom.Dataset) -> "PixelLayout":
+        """
+        Get the layout of the pixel data of a dataset.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset read at least up to its pixel data.
+
+        Returns:
+            PixelLayout: The layout.
+
+        Raises:
+            ValueError: If the pixel data is bit-packed.
+        """
+        bits = ds.get("BitsAllocated", 0)
+        if bits not in (8, 16, 32, 64):
+            raise ValueError(f"Can not redact pixel data of {bits} bits allocated")
+        samples = ds.get("SamplesPerPixel", 1) or 1
+        dtype = np.dtype(
+            f"{'i' if ds.get('PixelRepresentation') == 1 else 'u'}{bits // 8}"
+        )
+        if not getattr(ds, "is_little_endian", True):
+            dtype = dtype.newbyteorder(">")
+        return cls(
+            frames=int(ds.get("NumberOfFrames") or 1),
+            rows=ds.Rows,
+            columns=ds.Columns,
+            samples=samples,
+            planar=samples > 1 and ds.get("PlanarConfiguration") == 1,
+            dtype=dtype.str,
+        )
+
+    @property
+    def frame_size(self) -> int:
+        """Size of a frame in bytes."""
+        return self.rows * self.columns * self.samples * np.dtype(self.dtype).itemsize
+
+    def frame_view(self, buffer: Any, frames: int) -> np.ndarray:
+        """
+        View a buffer of whole frames as an array, without copying it.
+
+        Parameters:
+            buffer (Any): Writable buffer, such as a bytearray.
+            frames (int): Number of frames in the buffer.
+
+        Returns:
+            np.ndarray: Array of shape (frames, samples, rows, columns) for
+                planar data, (frames, rows, columns, samples) otherwise.
+        """
+        array = np.frombuffer(
+            buffer,
+            self.dtype,
+            count=frames * self.frame_size // np.dtype(self.dtype).itemsize,
+        )
+        if self.planar:
+            return array.reshape(frames, self.samples, self.rows, self.columns)
+        return array.reshape(frames, self.rows, self.columns, self.samples)
+
+
+def redact_frames(
+    frames: np.ndarray, boxes: Tuple[Box, ...], fill: int, planar: bool = False
+) -> None:
+    """
+    Blank rectangles in every frame of an array, in place.
+
+    Parameters:
+        frames (np.ndarray): Frames of shape (frames, rows, columns, samples),
+            or (frames, samples, rows, columns) if planar.
+        boxes (Tuple[Box, ...]): Rectangles as x, y, width and height. Parts
+            outside of the image are ignored.
+        fill (int): Value the rectangles are filled with.
+        planar (bool, optional): True for planar frames. Defaults to False.
+    """
+    for x, y, width, height in boxes:
+        if planar:
+            frames[:, :, y : y + height, x : x + width] = fill
+        else:
+            frames[:, y : y + height, x : x + width] = fill
+
+
+class PixelRedaction:
+    """The rule matching a file and the layout of its pixel data."""
+
+    def __init__(self, rule: RedactionRule, layout: PixelLayout):
+        self.rule = rule
+        self.layout = layout
+
+    def apply(self, ds: pydicom.Dataset) -> None:
+        """
+        Redact the pixel data of a dataset read completely.
+
+        Native pixel data, Float Pixel Data and Double Float Pixel Data are
+        changed in their encoded form. Compressed pixel data is decoded, and
+        encoded again as RLE Lossless if it was, or stored uncompressed
+        otherwise.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset with its pixel data, not yet changed
+                by the rules of the tags.
+        """
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        tag = next(tag for tag in (PIXEL_DATA, *FLOAT_DTYPES) if tag in ds)
+        if tag in FLOAT_DTYPES or not transfer_syntax.is_compressed:
+            layout = self.layout
+            if tag in FLOAT_DTYPES:
+                byteorder = np.dtype(layout.dtype).byteorder
+                dtype = np.dtype(FLOAT_DTYPES[tag]).newbyteorder(byteorder)
+                layout = dataclasses.replace(layout, dtype=dtype.str)
+            data = bytearray(ds[tag].value)
+            VR = ds[tag].VR
+            # Dropped before the redacted copy is made, two copies at most
+            del ds[tag]
+            frames = min(layout.frames, len(data) // layout.frame_size)
+            redact_frames(
+                layout.frame_view(data, frames),
+                self.rule.boxes,
+                self.rule.fill,
+                layout.planar,
+            )
+            ds.add_new(tag, VR, bytes(data))
+            return
+
+        array = ds.pixel_array
+        if not array.flags.writeable:
+            array = array.copy()
+        frames = array.reshape(
+            int(ds.get("NumberOfFrames") or 1),
+            ds.Rows,
+            ds.Columns,
+            ds.get("SamplesPerPixel", 1) or 1,
+        )
+        redact_frames(frames, self.rule.boxes, self.rule.fill)
+        if transfer_syntax == RLELossless:
+            ds.compress(RLELossless, array)
+            return
+        # Decoded frames are interleaved and not subsampled
+        if ds.get("SamplesPerPixel", 1) > 1:
+            ds.PlanarConfiguration = 0
+        if ds.get("PhotometricInterpretation") in ("YBR_FULL_422", "YBR_PARTIAL_422"):
+            ds.PhotometricInterpretation = "YBR_FULL"
+        del ds.PixelData
+        ds.add_new(PIXEL_DATA, "OB" if array.itemsize == 1 else "OW", array.tobytes())
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.is_implicit_VR = False
+        ds.is_little_endian = True
+
+    def write(
+        self,
+        ds: pydicom.Dataset,
+        pixel_info: PixelDataInfo,
+        source_filepath: str,
+        output_filepath: str,
+    ) -> None:
+        """
+        Write a dataset read up to its pixel data, redacting the pixel data.
+
+        Like write_with_pixel_passthrough, but the frames are redacted on their
+        way from the source to the output file, a chunk of frames at a time.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset read up to the pixel data, with all
+                changes applied.
+            pixel_info (PixelDataInfo): Location of the pixel data in the
+                source file, see can_stream.
+            source_filepath (str): Path of the source file.
+            output_filepath (str): Path of the output file.
+        """
+        layout = self.layout
+        frames_per_chunk = max(1, REDACTION_CHUNK_SIZE // layout.frame_size)
+        with open(output_filepath, "wb") as output, open(
+            source_filepath, "rb"
+        ) as source:
+            pydicom.dcmwrite(output, ds, write_like_original=True)
+            source.seek(pixel_info.offset)
+            header_length = 12 if pixel_info.VR in _LONG_HEADER_VRS else 8
+            output.write(source.read(header_length))
+            remaining = min(layout.frames, pixel_info.length // layout.frame_size)
+            buffer = bytearray(frames_per_chunk * layout.frame_size)
+            while remaining:
+                frames = min(frames_per_chunk, remaining)
+                chunk = memoryview(buffer)[: frames * layout.frame_size]
+                _read_exactly(source, chunk)
+                redact_frames(
+                    layout.frame_view(chunk, frames),
+                    self.rule.boxes,
+                    self.rule.fill,
+                    layout.planar,
+                )
+                output.write(chunk)
+                remaining -= frames
+            # Padding and the elements after the pixel data
+            shutil.copyfileobj(source, output, COPY_CHUNK_SIZE)
+
+
+def _read_exactly(source: BinaryIO, buffer: memoryview) -> None:
+    read = 0
+    while read < len(buffer):
+        n = source.readinto(buffer[read:])
+        if not n:
+            raise EOFError("The pixel data ends before its last frame")
+        read += n
+
+
+def can_stream(ds: pydicom.Dataset, pixel_info: Optional[PixelDataInfo]) -> bool:
+    """
+    Check if the pixel data of a file can be redacted while it is copied.
+
+    Parameters:
+        ds (pydicom.Dataset): Dataset read up to the pixel data.
+        pixel_info (Optional[PixelDataInfo]): Location of the pixel data.
+
+    Returns:
+        bool: True for native pixel data which can be copied, False if the
+            file has to be read completely.
+    """
+    return (
+        can_pass_through(ds, pixel_info)
+        and pixel_info.tag == PIXEL_DATA
+        and pixel_info.length != 0xFFFFFFFF
+    )
+
+
+class RedactionRules:
+    """
+    Rules for blanking burned-in text in the pixel data of some devices.
+
+    Ultrasound and secondary capture images often show patient details in the
+    image itself. The first rule matching the header of a file gives the
+    rectangles blanked in every frame of it. Rules contain no Qt objects and
+    can be pickled to worker processes.
+    """
+
+    def __init__(self, rules: List[RedactionRule]):
+        self.rules = rules
+
+    @classmethod
+    def read(cls, path: str) -> "RedactionRules":
+        """
+        Read the rules from a JSON file.
+
+        The file holds a list of rules such as
+        {"manufacturer": "ACME", "model": "US 1", "rows": 480, "columns": 640,
+        "boxes": [[0, 0, 640, 40]], "fill": 0}, with the boxes as x, y, width
+        and height. Every key except "boxes" is optional.
+
+        Parameters:
+            path (str): Path of the JSON file.
+
+        Returns:
+            RedactionRules: The rules.
+
+        Raises:
+            ValueError: If a rule has no boxes or a box is not valid.
+        """
+        with open(path) as fp:
+            data = json.load(fp)
+        return cls([_parse_rule(rule) for rule in data])
+
+    def match(self, ds: pydicom.Dataset) -> Optional[PixelRedaction]:
+        """
+        Get the redaction of a file.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset read at least up to its pixel data,
+                not yet changed by the rules of the tags.
+
+        Returns:
+            Optional[PixelRedaction]: Redaction of the pixel data, None if no
+                rule matches or the file has no pixel data.
+        """
+        if "Rows" not in ds:
+            return None
+        for rule in self.rules:
+            if rule.matches(ds):
+                return PixelRedaction(rule, PixelLayout.from_dataset(ds))
+        return None
+
+    @property
+    def fingerprint(self) -> str:
+        """Text which changes with any rule, for the fingerprint of a plan."""
+        return repr(self.rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+
+def _parse_rule(data: Dict[str, Any]) -> RedactionRule:
+    boxes = tuple(tuple(int(value) for value in box) for box in data.get("boxes", ()))
+    if not boxes or any(
+        len(box) != 4 or min(box) < 0 or box[2] == 0 or box[3] == 0 for box in boxes
+    ):
+        raise ValueError(f"Rule without valid boxes: {data}")
+    return RedactionRule(
+        boxes=boxes,
+        manufacturer=data.get("manufacturer"),
+        model=data.get("model"),
+        rows=data.get("rows"),
+        columns=data.get("columns"),
+        fill=int(data.get("fill", 0)),
+    )
@@ -0,0 +1,120 @@
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+if TYPE_CHECKING:
+    from utilities.scan_manifest import ManifestEntry
+
+# Minimum number of seconds between two progress signals, so that a fast run
+# does not flood the event loop of the GUI thread
+PROGRESS_INTERVAL = 0.1
+
+# A job receives a callback to report processed files and a callback telling
+# whether it should stop. It may return the path and error message of files
+# which failed without stopping the run.
+ReportCallback = Callable[[List["ManifestEntry"]], None]
+CancelledCallback = Callable[[], bool]
+Job = Callable[[ReportCallback, CancelledCallback], Optional[List[Tuple[str, str]]]]
+
+
+def format_duration(seconds: float) -> str:
+    """Format a number of seconds as h:mm:ss or m:ss."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class ThroughputMeter:
+    """Files and bytes processed since the start of a run."""
+
+    def __init__(self, total_files: int, total_bytes: int):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+    def add(self, entries: List["ManifestEntry"]) -> None:
+        self.files += len(entries)
+        self.bytes += sum(entry.size for entry in entries)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the current byte rate, None before the first file."""
+        if not self.bytes:
+            return None
+        return (self.total_bytes - self.bytes) * self.elapsed / self.bytes
+
+    def describe(self) -> str:
+        """
+        Describe the progress in a single line.
+
+        Returns:
+            str: Processed files, files/s, MB/s and the estimated time left.
+        """
+        elapsed = self.elapsed or 1e-9
+        eta = self.eta
+        return (
+            f"{self.files}/{self.total_files} files, "
+            f"{self.files / elapsed:.1f} files/s, "
+            f"{self.bytes / elapsed / 1024 / 1024:.1f} MB/s, "
+            f"ETA {format_duration(eta) if eta is not None else '--:--'}"
+        )
+
+
+class ProcessingWorker(QObject):
+    """
+    Run a job over a list of files outside of the GUI thread.
+
+    The worker is moved to a QThread and ``run`` is connected to its started
+    signal. Progress reported by the job is batched and emitted at most every
+    PROGRESS_INTERVAL seconds. ``cancel`` may be called from any thread, the
+    job stops after the file it is processing.
+    """
+
+    # Number of processed files and a description of the throughput
+    progress = pyqtSignal(int, str)
+    # Number of processed files, whether the run was cancelled and the path and
+    # error message of every failed file
+    finished = pyqtSignal(int, bool, list)
+    # Message of the error which stopped the run
+    failed = pyqtSignal(str)
+
+    def __init__(self, job: Job, entries: List["ManifestEntry"]):
+        super().__init__()
+        self.job = job
+        self.meter = ThroughputMeter(len(entries), sum(e.size for e in entries))
+        self._cancelled = threading.Event()
+        self._last_emit = 0.0
+
+    def run(self) -> None:
+        self.meter = ThroughputMeter(self.meter.total_files, self.meter.total_bytes)
+        failures = []
+        try:
+            failures = self.job(self.report, self.is_cancelled) or []
+        except Exception as e:
+            self.failed.emit(str(e))
+        self.progress.emit(self.meter.files, self.meter.describe())
+        self.finished.emit(self.meter.files, self.is_cancelled(), failures)
+
+    def report(self, entries: List["ManifestEntry"]) -> None:
+        """Add processed files, emitting progress if the last signal is old enough."""
+        self.meter.add(entries)
+        now = time.perf_counter()
+        if now - self._last_emit >= PROGRESS_INTERVAL:
+            self._last_emit = now
+            self.progress.emit(self.meter.files, self.meter.describe())
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
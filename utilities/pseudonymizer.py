@@ -0,0 +1,263 @@
+import hashlib
+import hmac
+import multiprocessing.util
+import os
+import sqlite3
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import pydicom
+from pydicom.dataelem import DataElement
+from pydicom.multival import MultiValue
+from pydicom.uid import UID_dictionary
+
+from utilities.encryption_manager import generate_key
+
+# Fixed salt of the pseudonymization secret, so that the same password gives
+# the same pseudonyms in every run
+PSEUDONYM_SALT = b"DICOM-Anonymizer pseudonyms"
+
+# The mapping file is stored next to the input folder, as it holds the
+# original values
+MAPPING_SUFFIX = "_pseudonyms.sqlite"
+
+# Distinct values whose pseudonym is kept in memory per process
+PSEUDONYM_CACHE_SIZE = 65536
+
+# UIDs derived from a 128 bit number, as defined by ISO/IEC 9834-8
+UID_ROOT = "2.25."
+
+# Hex digits of text pseudonyms, short enough for SH, CS and AE values
+PSEUDONYM_LENGTH = 16
+
+# Text VRs whose values are replaced by a pseudonym. Values of other VRs, such
+# as dates and numbers, can not hold a pseudonym and are emptied.
+TEXT_VRS = {"AE", "CS", "LO", "LT", "PN", "SH", "ST", "UC", "UT"}
+
+# UI elements identifying coding schemes and resources rather than instances,
+# in addition to class UIDs and transfer syntaxes
+KEPT_UID_KEYWORDS = {
+    "CodingSchemeUID",
+    "ContextGroupExtensionCreatorUID",
+    "ContextUID",
+    "MappingResourceUID",
+}
+
+
+@lru_cache(maxsize=None)
+def is_instance_uid_tag(tag: int) -> bool:
+    """Check if a UI element holds instance UIDs rather than class UIDs."""
+    keyword = pydicom.datadict.keyword_for_tag(tag)
+    return not (
+        keyword.endswith(("ClassUID", "TransferSyntaxUID"))
+        or keyword in KEPT_UID_KEYWORDS
+    )
+
+
+def mapping_path_for(folder: str) -> str:
+    """
+    Get the default path of the mapping file of an input folder.
+
+    Parameters:
+        folder (str): Input folder.
+
+    Returns:
+        str: Path of the mapping file next to the input folder.
+    """
+    return os.path.normpath(folder) + MAPPING_SUFFIX
+
+
+def connect_mapping(mapping_path: str) -> sqlite3.Connection:
+    """Open a mapping file, which several processes may write at once."""
+    connection = sqlite3.connect(mapping_path, timeout=60, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS pseudonyms ("
+        "key_id TEXT, kind TEXT, original TEXT, pseudonym TEXT, "
+        "PRIMARY KEY (key_id, kind, original))"
+    )
+    return connection
+
+
+def merge_mapping(mapping_path: str, other_path: str) -> None:
+    """
+    Add the pseudonyms recorded in another mapping file, such as of a shard.
+
+    Parameters:
+        mapping_path (str): Path of the mapping file to add the pseudonyms to.
+        other_path (str): Path of the other mapping file.
+    """
+    connection = connect_mapping(mapping_path)
+    try:
+        connection.execute("ATTACH DATABASE ? AS other", (other_path,))
+        with connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO pseudonyms SELECT * FROM other.pseudonyms"
+            )
+        connection.execute("DETACH DATABASE other")
+    finally:
+        connection.close()
+
+
+class Pseudonymizer:
+    """
+    Replace values by a keyed hash of them.
+
+    The same value always gets the same pseudonym for the same password, in
+    every worker process and every run, so files of a patient or a study stay
+    linked. UIDs are replaced by valid UIDs, text values by hex digits.
+
+    Pseudonyms are cached in memory and every new pair of value and pseudonym
+    is recorded in an SQLite mapping file, which allows to look up the original
+    values later. The mapping file contains the original values and has to be
+    kept as safe as the original files.
+    """
+
+    def __init__(
+        self,
+        secret: bytes,
+        mapping_path: Optional[str] = None,
+        cache_size: int = PSEUDONYM_CACHE_SIZE,
+    ):
+        self.secret = secret
+        self.mapping_path = mapping_path
+        self.cache_size = cache_size
+        self._pending: List[Tuple[str, str, str]] = []
+        self._connection: Optional[sqlite3.Connection] = None
+        self._cached_pseudonym = lru_cache(maxsize=cache_size)(self._pseudonym)
+
+    @classmethod
+    def derive(
+        cls, password: str, mapping_path: Optional[str] = None
+    ) -> "Pseudonymizer":
+        """
+        Derive the secret of the pseudonyms from a password.
+
+        Parameters:
+            password (str): The password.
+            mapping_path (Optional[str], optional): Path of the SQLite mapping
+                file. Defaults to not recording the pseudonyms.
+
+        Returns:
+            Pseudonymizer: The pseudonymizer.
+        """
+        return cls(generate_key(password, PSEUDONYM_SALT), mapping_path)
+
+    @property
+    def key_id(self) -> str:
+        """ID of the secret, which changes the pseudonyms of every value."""
+        return hmac.new(self.secret, b"key id", hashlib.sha256).hexdigest()[:16]
+
+    def pseudonymize(self, value: str, VR: str) -> str:
+        """
+        Get the pseudonym of a single value.
+
+        Parameters:
+            value (str): The original value.
+            VR (str): VR of the element holding the value.
+
+        Returns:
+            str: A UID for UI values, hex digits otherwise.
+        """
+        return self._cached_pseudonym(value, "UI" if VR == "UI" else "text")
+
+    def pseudonymize_element(self, elem: DataElement) -> None:
+        """
+        Replace the value of an element by its pseudonym.
+
+        Every value of a multi-valued element is replaced on its own, empty
+        values stay empty.
+
+        Parameters:
+            elem (DataElement): Element to change.
+        """
+        if elem.VR != "UI" and elem.VR not in TEXT_VRS:
+            elem.value = None
+        elif isinstance(elem.value, MultiValue):
+            elem.value = [
+                self.pseudonymize(str(value), elem.VR) if value else value
+                for value in elem.value
+            ]
+        elif elem.value:
+            elem.value = self.pseudonymize(str(elem.value), elem.VR)
+
+    def remap_uid_element(self, elem: DataElement) -> None:
+        """
+        Replace the UIDs of a UI element, unless they are defined by the standard.
+
+        A UID gets the same replacement wherever it occurs, so references
+        between files, such as ReferencedSOPInstanceUID, stay intact.
+
+        Parameters:
+            elem (DataElement): Element holding instance UIDs, see
+                is_instance_uid_tag.
+        """
+        if isinstance(elem.value, MultiValue):
+            elem.value = [self._remap_uid(uid) for uid in elem.value]
+        elif elem.value:
+            elem.value = self._remap_uid(elem.value)
+
+    def _remap_uid(self, uid: str) -> str:
+        """Replace a UID unless it is defined by the DICOM standard."""
+        if not uid or uid in UID_dictionary:
+            return uid
+        return self.pseudonymize(uid, "UI")
+
+    def _pseudonym(self, value: str, kind: str) -> str:
+        """Compute a pseudonym and queue it for the mapping file."""
+        digest = hmac.new(
+            self.secret, f"{kind}|{value}".encode(), hashlib.sha256
+        ).digest()
+        if kind == "UI":
+            pseudonym = UID_ROOT + str(int.from_bytes(digest[:16], "big"))
+        else:
+            pseudonym = digest.hex()[:PSEUDONYM_LENGTH].upper()
+        if self.mapping_path is not None:
+            self._pending.append((kind, value, pseudonym))
+        return pseudonym
+
+    def flush(self) -> None:
+        """Write the pseudonyms computed since the last call to the mapping file."""
+        if not self._pending:
+            return
+        if self._connection is None:
+            self._connection = connect_mapping(self.mapping_path)
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO pseudonyms VALUES (?, ?, ?, ?)",
+                [(self.key_id, *pending) for pending in self._pending],
+            )
+        self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close_at_exit(self) -> None:
+        """
+        Close the mapping file when the current worker process exits.
+
+        Worker processes end without running atexit handlers, an open
+        connection would leave the -wal and -shm files of the mapping behind.
+        """
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def __enter__(self) -> "Pseudonymizer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __getstate__(self) -> dict:
+        # Worker processes start with an empty cache and their own connection
+        return {
+            "secret": self.secret,
+            "mapping_path": self.mapping_path,
+            "cache_size": self.cache_size,
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(**state)
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO, Tuple
+
+# The quarantine folder is stored next to the input folder, as it holds copies
+# of the original files
+QUARANTINE_SUFFIX = "_quarantine"
+
+# Error manifest in the root of the quarantine folder, one JSON object per line
+ERRORS_FILENAME = "errors.jsonl"
+
+
+def quarantine_path_for(folder: str) -> str:
+    """
+    Get the default quarantine folder of an input folder.
+
+    Parameters:
+        folder (str): Input folder.
+
+    Returns:
+        str: Path of the quarantine folder next to the input folder.
+    """
+    return os.path.normpath(folder) + QUARANTINE_SUFFIX
+
+
+class Quarantine:
+    """
+    Set aside the files of a run which could not be processed.
+
+    Every failed file is copied to the quarantine folder, mirroring the input
+    folder, and its error is appended to the error manifest, so a long run goes
+    on past broken files and leaves a record of them. The folder is only
+    created once a file fails. Like the input folder, it holds original files
+    and has to be kept as safe as them.
+    """
+
+    def __init__(self, folder: str, quarantine_folder: Optional[str] = None):
+        self.folder = folder
+        self.quarantine_folder = quarantine_folder or quarantine_path_for(folder)
+        self.failures: List[Tuple[str, str]] = []
+        self._failed: Dict[str, str] = {}
+        self._manifest: Optional[TextIO] = None
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.quarantine_folder, ERRORS_FILENAME)
+
+    def add(
+        self,
+        dcm_file: str,
+        error: str,
+        data: Optional[bytes] = None,
+        content_path: Optional[str] = None,
+    ) -> None:
+        """
+        Quarantine a file which could not be processed.
+
+        Parameters:
+            dcm_file (str): Path of the source file. For a member of an
+                archive, the path of the archive joined with the member name.
+            error (str): Description of the error.
+            data (Optional[bytes], optional): Content of the file if it is not
+                on disk, such as an archive member. Defaults to copying the file.
+            content_path (Optional[str], optional): File holding the content if
+                it is not on disk at dcm_file, such as a spooled archive member.
+                Defaults to None.
+        """
+        source = os.path.relpath(dcm_file, self.folder)
+        self.failures.append((dcm_file, error))
+        self._failed[dcm_file] = error
+        if self._manifest is None:
+            Path(self.quarantine_folder).mkdir(parents=True, exist_ok=True)
+            self._manifest = open(self.manifest_path, "a")
+        # Member names of archives may point outside of the quarantine folder
+        relative = os.path.normpath(source)
+        if os.path.isabs(relative) or relative.startswith(os.pardir):
+            relative = os.path.basename(relative)
+        copied = True
+        try:
+            quarantined = Path(self.quarantine_folder) / relative
+            quarantined.parent.mkdir(parents=True, exist_ok=True)
+            if data is None:
+                shutil.copy2(content_path or dcm_file, quarantined)
+            else:
+                quarantined.write_bytes(data)
+        except OSError:
+            # The error is recorded even if the file can not be read at all
+            copied = False
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "source": source,
+            "error": error,
+            "copied": copied,
+        }
+        self._manifest.write(json.dumps(record) + "\n")
+        self._manifest.flush()
+
+    def failed(self, dcm_file: str) -> bool:
+        """True if the file was quarantined during this run."""
+        return dcm_file in self._failed
+
+    def close(self) -> None:
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+
+    def __enter__(self) -> "Quarantine":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
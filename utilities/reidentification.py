@@ -0,0 +1,156 @@
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import pydicom
+
+from utilities.anonymization_core import (
+    ENCRYPTED_DATA_TAG,
+    decrypt_elements,
+    get_output_path,
+    read_source,
+    write_output,
+)
+from utilities.encryption_manager import EncryptionKey, payload_salt
+from utilities.helper_function import describe_error, read_dicom_header
+from utilities.parallel_engine import run_files_parallel
+from utilities.scan_manifest import ManifestEntry
+
+
+def verify_password(
+    entries: Iterable[ManifestEntry], password: str
+) -> Optional[EncryptionKey]:
+    """
+    Check the password against the first encrypted file before a run.
+
+    Files of an anonymization run share a key, so the key derived here is
+    reused for all of them instead of deriving it again in every worker.
+
+    Parameters:
+        entries (Iterable[ManifestEntry]): Files to decrypt.
+        password (str): Password entered for the decryption.
+
+    Returns:
+        Optional[EncryptionKey]: Key of the first encrypted file, None if no
+            file is encrypted.
+
+    Raises:
+        ValueError: If the password does not decrypt the file.
+    """
+    for entry in entries:
+        if entry.encrypted:
+            break
+    else:
+        return None
+    from cryptography.fernet import InvalidToken
+
+    ds, _ = read_dicom_header(entry.path)
+    value = ds[ENCRYPTED_DATA_TAG].value
+    key = EncryptionKey.derive(password, payload_salt(value))
+    try:
+        decrypt_elements(value, password, key)
+    except InvalidToken:
+        raise ValueError("Wrong password") from None
+    return key
+
+
+def reidentify_file(
+    dcm_file: str,
+    output_filepath: str,
+    password: str,
+    key: Optional[EncryptionKey] = None,
+) -> None:
+    """
+    Restore the encrypted values of a single anonymized file.
+
+    Only the header is read, the pixel data is copied from the source file in
+    chunks. The output file only appears once it is completely written, files
+    without encrypted values are copied unchanged.
+
+    Parameters:
+        dcm_file (str): Path of the anonymized file.
+        output_filepath (str): Path of the output file.
+        password (str): Password used for the encryption.
+        key (Optional[EncryptionKey], optional): Key returned by
+            verify_password. Defaults to a cached or new key.
+    """
+    ds, pixel_info = read_source(dcm_file)
+    if ENCRYPTED_DATA_TAG in ds:
+        elements = decrypt_elements(ds[ENCRYPTED_DATA_TAG].value, password, key)
+        if pixel_info is not None and any(
+            elem.tag >= pixel_info.tag for elem in elements
+        ):
+            # Elements behind the pixel data are part of the copied bytes
+            ds, pixel_info = pydicom.dcmread(dcm_file, force=True), None
+        for elem in elements:
+            ds.add(elem)
+    write_output(ds, pixel_info, dcm_file, output_filepath)
+
+
+def _reidentify_in_folder(
+    dcm_file: str,
+    folder: str,
+    output_folder: str,
+    password: str,
+    key: Optional[EncryptionKey],
+) -> None:
+    """Restore a file into the mirrored output folder."""
+    output_filepath = get_output_path(dcm_file, folder, output_folder)
+    reidentify_file(dcm_file, output_filepath, password, key)
+
+
+def reidentify_files(
+    files: List[str],
+    folder: str,
+    output_folder: str,
+    password: str,
+    workers: int = 1,
+    key: Optional[EncryptionKey] = None,
+    progress_callback: Optional[Callable[[List[str]], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Restore the encrypted values of files into a mirrored output folder.
+
+    A file which can not be restored does not stop the run, it is reported in
+    the returned list and no output is written for it.
+
+    Parameters:
+        files (List[str]): Paths of the anonymized files.
+        folder (str): Input folder.
+        output_folder (str): Output folder, mirroring the input folder.
+        password (str): Password used for the encryption.
+        workers (int, optional): Number of worker processes, 1 restores the
+            files in the calling process. Defaults to 1.
+        key (Optional[EncryptionKey], optional): Key returned by
+            verify_password. Defaults to a cached or new key per salt.
+        progress_callback (Optional[Callable[[List[str]], None]], optional):
+            Called with the files finished since the last call, including
+            failed files. Defaults to None.
+        should_cancel (Optional[Callable[[], bool]], optional): Polled between
+            files, stops the run once it returns True. Defaults to None.
+
+    Returns:
+        List[Tuple[str, str]]: Path and error message of every failed file.
+    """
+    failures = []
+    if workers > 1:
+        run_files_parallel(
+            files,
+            _reidentify_in_folder,
+            (folder, output_folder, password, key),
+            workers,
+            progress_callback=progress_callback,
+            should_cancel=should_cancel,
+            error_callback=lambda path, error: failures.append((path, error)),
+        )
+        return failures
+
+    for dcm_file in files:
+        if should_cancel is not None and should_cancel():
+            break
+        try:
+            _reidentify_in_folder(dcm_file, folder, output_folder, password, key)
+        except Exception as e:
+            failures.append((dcm_file, describe_error(e)))
+        if progress_callback is not None:
+            progress_callback([dcm_file])
+    return failures
@@ -0,0 +1,273 @@
+import os
+import sqlite3
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Tuple
+
+from pydicom.tag import BaseTag
+
+from utilities.anonymization_core import get_output_path
+from utilities.anonymization_plan import AnonymizationPlan
+from utilities.scan_manifest import ManifestEntry, ScanManifest
+
+# Stored in the root of the output folder
+INDEX_FILENAME = ".anonymizer_index.sqlite"
+
+# Number of processed files buffered before they are written to the index
+FLUSH_EVERY = 200
+
+# Seconds after which buffered files are written anyway, bounding the work a
+# crashed run has to redo
+FLUSH_INTERVAL = 5.0
+
+# Columns added after the first version of the index, with their type
+_SCAN_COLUMNS = {"transfer_syntax": "TEXT", "encrypted": "INTEGER", "tags": "BLOB"}
+
+
+def _pack_tags(tags: FrozenSet[int]) -> bytes:
+    return array("I", sorted(tags)).tobytes()
+
+
+def _unpack_tags(packed: bytes) -> FrozenSet[int]:
+    tags = array("I")
+    tags.frombytes(packed)
+    # The same type as scanned tags, which rule fingerprints depend on
+    return frozenset(BaseTag(tag) for tag in tags)
+
+
+class RunIndex:
+    """
+    Persistent record of the files written to an output folder.
+
+    A file is recorded with the size and modification time of its source and
+    the fingerprint of the rules applied to it. A later run can skip every
+    file whose source and rules did not change since. Files are recorded as
+    soon as they are written, so the index is also the checkpoint a crashed or
+    cancelled run resumes from. The scan of every recorded source is kept as
+    well, so resuming does not read the headers of finished files again.
+    """
+
+    def __init__(self, output_folder: str):
+        Path(output_folder).mkdir(parents=True, exist_ok=True)
+        self.output_folder = output_folder
+        # The GUI opens the index and hands it to its processing thread
+        self._connection = sqlite3.connect(
+            os.path.join(output_folder, INDEX_FILENAME), check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed ("
+            "source TEXT PRIMARY KEY, size INTEGER, mtime REAL, rules_hash TEXT)"
+        )
+        columns = {
+            row[1] for row in self._connection.execute("PRAGMA table_info(processed)")
+        }
+        for column, column_type in _SCAN_COLUMNS.items():
+            if column not in columns:
+                self._connection.execute(
+                    f"ALTER TABLE processed ADD COLUMN {column} {column_type}"
+                )
+        self._records: Dict[str, Tuple[int, float, str]] = {
+            source: (size, mtime, rules_hash)
+            for source, size, mtime, rules_hash in self._connection.execute(
+                "SELECT source, size, mtime, rules_hash FROM processed"
+            )
+        }
+        self._pending: List[Tuple[str, int, float, str, str, bool, bytes]] = []
+        self._last_flush = time.monotonic()
+
+    def is_current(self, source: str, entry: ManifestEntry, rules_hash: str) -> bool:
+        """
+        Check if a file was already processed from the same source and rules.
+
+        Parameters:
+            source (str): Path of the file relative to the input folder.
+            entry (ManifestEntry): Scan of the source file.
+            rules_hash (str): Fingerprint of the rules for the file.
+
+        Returns:
+            bool: True if the recorded output is up to date.
+        """
+        return self._records.get(source) == (entry.size, entry.mtime, rules_hash)
+
+    def record(self, source: str, entry: ManifestEntry, rules_hash: str) -> None:
+        """
+        Record a processed file.
+
+        Parameters:
+            source (str): Path of the file relative to the input folder.
+            entry (ManifestEntry): Scan of the source file.
+            rules_hash (str): Fingerprint of the rules applied to the file.
+        """
+        self._records[source] = (entry.size, entry.mtime, rules_hash)
+        self._pending.append(
+            (
+                source,
+                entry.size,
+                entry.mtime,
+                rules_hash,
+                entry.transfer_syntax,
+                entry.encrypted,
+                _pack_tags(entry.tags),
+            )
+        )
+        if (
+            len(self._pending) >= FLUSH_EVERY
+            or time.monotonic() - self._last_flush >= FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered records to disk."""
+        if self._pending:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO processed (source, size, mtime, "
+                    "rules_hash, transfer_syntax, encrypted, tags) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self._pending,
+                )
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def known_entries(self, folder: str) -> Dict[str, ManifestEntry]:
+        """
+        Get the scans of the recorded source files.
+
+        Parameters:
+            folder (str): Input folder the sources are relative to.
+
+        Returns:
+            Dict[str, ManifestEntry]: Scan of every recorded file by its path,
+            to be passed to ScanManifest.build.
+        """
+        self.flush()
+        entries = {}
+        # Most files of a study share the same tags, keep a single copy of each set
+        interned_tags: Dict[bytes, FrozenSet[int]] = {}
+        for (
+            source,
+            size,
+            mtime,
+            transfer_syntax,
+            encrypted,
+            packed,
+        ) in self._connection.execute(
+            "SELECT source, size, mtime, transfer_syntax, encrypted, tags "
+            "FROM processed WHERE tags IS NOT NULL"
+        ):
+            tags = interned_tags.get(packed)
+            if tags is None:
+                tags = interned_tags[packed] = _unpack_tags(packed)
+            path = os.path.join(folder, source)
+            entries[path] = ManifestEntry(
+                path=path,
+                size=size,
+                mtime=mtime,
+                transfer_syntax=transfer_syntax,
+                encrypted=bool(encrypted),
+                tags=tags,
+            )
+        return entries
+
+    def merge(self, output_folder: str) -> int:
+        """
+        Add the records of the index of another output folder, such as a shard.
+
+        Both indexes have to record sources relative to the same input folder.
+        Records of the other index replace records of the same source.
+
+        Parameters:
+            output_folder (str): Output folder of the other index.
+
+        Returns:
+            int: Number of merged records.
+        """
+        self.flush()
+        # Opening the other index adds the columns missing in older versions
+        RunIndex(output_folder).close()
+        index_path = os.path.join(output_folder, INDEX_FILENAME)
+        self._connection.execute("ATTACH DATABASE ? AS other", (index_path,))
+        try:
+            with self._connection:
+                merged = self._connection.execute(
+                    "INSERT OR REPLACE INTO processed (source, size, mtime, "
+                    "rules_hash, transfer_syntax, encrypted, tags) "
+                    "SELECT source, size, mtime, rules_hash, transfer_syntax, "
+                    "encrypted, tags FROM other.processed"
+                ).rowcount
+        finally:
+            self._connection.execute("DETACH DATABASE other")
+        self._records.update(
+            (source, (size, mtime, rules_hash))
+            for source, size, mtime, rules_hash in self._connection.execute(
+                "SELECT source, size, mtime, rules_hash FROM processed"
+            )
+        )
+        return merged
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
+
+    def __enter__(self) -> "RunIndex":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def split_pending(
+    manifest: ScanManifest,
+    plan: AnonymizationPlan,
+    index: RunIndex,
+    output_folder: str,
+) -> Tuple[List[ManifestEntry], List[ManifestEntry]]:
+    """
+    Split the files of a manifest into files to process and up to date files.
+
+    A file is up to date if its source size, modification time and the rules
+    applied to its tags did not change, and its output still exists.
+
+    Parameters:
+        manifest (ScanManifest): Scan of the input folder.
+        plan (AnonymizationPlan): Compiled rules.
+        index (RunIndex): Index of the output folder.
+        output_folder (str): Output folder.
+
+    Returns:
+        Tuple[List[ManifestEntry], List[ManifestEntry]]: Files to process and
+        files which can be skipped.
+    """
+    pending, skipped = [], []
+    for entry in manifest:
+        source = os.path.relpath(entry.path, manifest.folder)
+        if index.is_current(
+            source, entry, plan.fingerprint(entry.tags)
+        ) and os.path.exists(
+            get_output_path(entry.path, manifest.folder, output_folder)
+        ):
+            skipped.append(entry)
+        else:
+            pending.append(entry)
+    return pending, skipped
+
+
+def record_processed(
+    manifest: ScanManifest,
+    plan: AnonymizationPlan,
+    index: RunIndex,
+    entries: List[ManifestEntry],
+) -> None:
+    """
+    Record processed files in the index.
+
+    Parameters:
+        manifest (ScanManifest): Scan of the input folder.
+        plan (AnonymizationPlan): Compiled rules applied to the files.
+        index (RunIndex): Index of the output folder.
+        entries (List[ManifestEntry]): Processed files.
+    """
+    for entry in entries:
+        source = os.path.relpath(entry.path, manifest.folder)
+        index.record(source, entry, plan.fingerprint(entry.tags))
@@ -0,0 +1,264 @@
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Any, ContextManager, Dict, Iterator, List
+
+# Stages of a run in the order they are reported. Stages of single files are
+# summed over all worker processes.
+STAGES = (
+    "scan",
+    "kdf",
+    "read",
+    "redact",
+    "transform",
+    "encrypt",
+    "write",
+    "forward",
+    "index",
+)
+
+# Counters of a run in the order they are reported
+COUNTERS = (
+    "files",
+    "bytes_read",
+    "bytes_written",
+    "tags_changed",
+    "tags_deleted",
+    "tags_encrypted",
+    "errors",
+)
+
+# The run report is stored next to the output folder
+REPORT_SUFFIX = "_report.json"
+
+# Minimum number of seconds between two lines of a metrics stream
+DEFAULT_METRICS_INTERVAL = 5.0
+
+
+def report_path_for(output_folder: str) -> str:
+    """
+    Get the path of the run report of an output folder.
+
+    Parameters:
+        output_folder (str): Output folder.
+
+    Returns:
+        str: Path of the report next to the output folder.
+    """
+    return os.path.normpath(output_folder) + REPORT_SUFFIX
+
+
+class RunMetrics:
+    """
+    Time spent per stage and counters of a run.
+
+    Worker processes collect their own metrics, which are merged into the
+    metrics of the run by the calling process. Metrics contain no Qt objects
+    and can be pickled.
+    """
+
+    def __init__(self):
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.start = time.perf_counter()
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.counters: Counter = Counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Add the time spent in the with block to a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def count_file(self, dcm_file: str, output_filepath: str) -> None:
+        """Count a processed file with its size before and after processing."""
+        self.counters["files"] += 1
+        self.counters["bytes_read"] += os.path.getsize(dcm_file)
+        self.counters["bytes_written"] += os.path.getsize(output_filepath)
+
+    def merge(self, other: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Add the metrics of a worker to the metrics of the run.
+
+        Parameters:
+            other (Dict[str, Dict[str, Any]]): Metrics as returned by as_dict.
+        """
+        for name, seconds in other["seconds"].items():
+            self.seconds[name] += seconds
+        self.counters.update(other["counters"])
+
+    def as_dict(self) -> Dict[str, Dict[str, Any]]:
+        return {"seconds": dict(self.seconds), "counters": dict(self.counters)}
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Summarize the metrics of the run so far.
+
+        Returns:
+            Dict[str, Any]: Start time, elapsed seconds, counters, throughput
+                and the seconds and share of every stage.
+        """
+        return _summarize(self.started, self.elapsed, self.seconds, self.counters)
+
+    def describe(self) -> str:
+        """
+        Describe the stage breakdown of the run in a few lines.
+
+        Returns:
+            str: Share and seconds of every stage, followed by the counters.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"{name}: {stage['share']:.0%} ({stage['seconds']:.1f} s)"
+            for name, stage in snapshot["stages"].items()
+        ]
+        counters = snapshot["counters"]
+        lines.append(
+            f"{counters['files']} files, "
+            f"{counters['bytes_read'] / 1024 / 1024:.1f} MB read, "
+            f"{counters['bytes_written'] / 1024 / 1024:.1f} MB written, "
+            f"{counters['tags_changed']} tags changed, "
+            f"{counters['tags_deleted']} deleted, "
+            f"{counters['tags_encrypted']} encrypted, "
+            f"{counters['errors']} errors"
+        )
+        return "\n".join(lines)
+
+    def write_report(self, path: str, **info: Any) -> None:
+        """
+        Write the run report as JSON.
+
+        Parameters:
+            path (str): Path of the report, see report_path_for.
+            **info (Any): Settings of the run added to the report, such as the
+                input and output folder.
+        """
+        with open(path, "w") as fp:
+            json.dump({**info, **self.snapshot()}, fp, indent=2)
+
+
+def _summarize(
+    started: str, elapsed: float, seconds: Dict[str, float], counters: Counter
+) -> Dict[str, Any]:
+    """Summarize the seconds per stage and the counters of a run."""
+    elapsed = elapsed or 1e-9
+    total = sum(seconds.values()) or 1e-9
+    names = [name for name in STAGES if name in seconds]
+    names += sorted(seconds.keys() - set(STAGES))
+    return {
+        "started": started,
+        "seconds": round(elapsed, 3),
+        "counters": {name: counters[name] for name in COUNTERS},
+        "files_per_second": round(counters["files"] / elapsed, 2),
+        "mb_per_second": round(counters["bytes_read"] / elapsed / 1024 / 1024, 2),
+        "stages": {
+            name: {
+                "seconds": round(seconds[name], 3),
+                "share": round(seconds[name] / total, 3),
+            }
+            for name in names
+        },
+    }
+
+
+def merge_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine the reports of runs which ran side by side, such as shards.
+
+    Counters and stage seconds are summed. The runs are taken to have run at
+    the same time, so the elapsed seconds are those of the longest run and
+    the throughput is that of all runs together.
+
+    Parameters:
+        reports (List[Dict[str, Any]]): Reports as written by write_report.
+
+    Returns:
+        Dict[str, Any]: The combined report, without the settings of the runs.
+    """
+    seconds: Dict[str, float] = defaultdict(float)
+    counters: Counter = Counter()
+    for report in reports:
+        for name, stage in report["stages"].items():
+            seconds[name] += stage["seconds"]
+        counters.update(report["counters"])
+    return _summarize(
+        min(report["started"] for report in reports),
+        max(report["seconds"] for report in reports),
+        seconds,
+        counters,
+    )
+
+
+class NullMetrics:
+    """Metrics of a run without instrumentation, every method does nothing."""
+
+    _stage = nullcontext()
+
+    def stage(self, name: str) -> ContextManager[None]:
+        return self._stage
+
+    def count(self, name: str, n: int = 1) -> None:
+        pass
+
+
+# Used by the processing functions when no metrics are collected
+NO_METRICS = NullMetrics()
+
+
+class MetricsStream:
+    """
+    Append snapshots of the metrics of a run to a JSON lines file.
+
+    ``update`` may be called after every file, a line is only written once
+    ``interval`` seconds have passed since the last one. A last line marked as
+    final is written on close.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        metrics: RunMetrics,
+        interval: float = DEFAULT_METRICS_INTERVAL,
+    ):
+        self.metrics = metrics
+        self.interval = interval
+        self._fp = open(path, "a")
+        self._last_write = time.perf_counter()
+
+    def update(self) -> None:
+        now = time.perf_counter()
+        if now - self._last_write >= self.interval:
+            self._last_write = now
+            self._write(final=False)
+
+    def _write(self, final: bool) -> None:
+        line = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "final": final,
+            **self.metrics.snapshot(),
+        }
+        self._fp.write(json.dumps(line) + "\n")
+        self._fp.flush()
+
+    def close(self) -> None:
+        if not self._fp.closed:
+            self._write(final=True)
+            self._fp.close()
+
+    def __enter__(self) -> "MetricsStream":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
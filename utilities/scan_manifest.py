@@ -0,0 +1,240 @@
+import io
+import os
+from dataclasses import dataclass
+from typing import (
+    BinaryIO,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from utilities.archive_io import SpooledMember, iter_dicom_members
+from utilities.dataset_walker import dataset_tags
+from utilities.encryption_manager import detect_if_encrypted
+from utilities.helper_function import (
+    add_trailing_elements,
+    describe_error,
+    iter_dcm_files,
+    read_dicom_header,
+)
+from utilities.tag_inventory import TagInventory
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """A single DICOM file found while scanning a folder."""
+
+    path: str
+    size: int
+    mtime: float
+    transfer_syntax: str
+    encrypted: bool
+    tags: FrozenSet[int]
+    study_uid: str = ""
+
+
+def _scan_file(
+    path: str,
+    size: int,
+    mtime: float,
+    inventory: TagInventory,
+    interned_tags: Dict[FrozenSet[int], FrozenSet[int]],
+    source: Optional[Union[str, BinaryIO]] = None,
+) -> ManifestEntry:
+    """Read the header of a file, adding its values to the inventory if sampled."""
+    source = path if source is None else source
+    ds, pixel_info = read_dicom_header(source)
+    if pixel_info is not None:
+        add_trailing_elements(ds, source, pixel_info)
+    if inventory.wants_sample(ds):
+        inventory.add_dataset(ds)
+    tags = dataset_tags(ds)
+    if pixel_info is not None:
+        tags.add(pixel_info.tag)
+    tags = frozenset(tags)
+    tags = interned_tags.setdefault(tags, tags)
+
+    file_meta = getattr(ds, "file_meta", None) or {}
+    return ManifestEntry(
+        path=path,
+        size=size,
+        mtime=mtime,
+        transfer_syntax=str(file_meta.get("TransferSyntaxUID", "")),
+        encrypted=detect_if_encrypted(ds),
+        tags=tags,
+        study_uid=str(ds.get("StudyInstanceUID", "")),
+    )
+
+
+class ScanManifest:
+    """
+    Result of a single scan of a folder of DICOM files.
+
+    The manifest is built once per folder selection, reading only the header of
+    every file, and is then shared by the tag table, the anonymization and the
+    decryption so that none of them has to walk or parse the tree again.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        entries: List[ManifestEntry],
+        inventory: TagInventory,
+        errors: Optional[List[Tuple[str, str]]] = None,
+        not_dicom: Optional[List[str]] = None,
+    ):
+        self.folder = folder
+        self.entries = entries
+        self.inventory = inventory
+        self.errors = errors or []
+        # Members of an archive which are not DICOM files, left out of the
+        # output archive
+        self.not_dicom = not_dicom or []
+
+    @classmethod
+    def build(
+        cls,
+        folder: str,
+        sample_per_series: Optional[int] = None,
+        known: Optional[Mapping[str, ManifestEntry]] = None,
+        paths: Optional[Iterable[str]] = None,
+    ) -> "ScanManifest":
+        """
+        Scan a folder and record every DICOM file in it.
+
+        A file whose header can not be read does not stop the scan, it is
+        recorded in the errors of the manifest instead.
+
+        Parameters:
+            folder (str): Path to the folder containing DICOM files.
+            sample_per_series (Optional[int], optional): Number of files per
+                series whose values are added to the tag inventory. Tag presence
+                is always counted for every file. Defaults to None, all files.
+            known (Optional[Mapping[str, ManifestEntry]], optional): Earlier
+                scans by path, e.g. of the files finished by an interrupted
+                run. A file whose size and modification time did not change
+                is taken from them without reading its header, and its values
+                are not added to the tag inventory. Defaults to None.
+            paths (Optional[Iterable[str]], optional): Files of the folder to
+                scan, such as the files of a shard. Defaults to None, every
+                DICOM file in the folder.
+
+        Returns:
+            ScanManifest: The manifest of the folder.
+        """
+        entries = []
+        errors = []
+        inventory = TagInventory(sample_per_series)
+        known = known or {}
+        # Most files of a study share the same tags, keep a single copy of each set
+        interned_tags: Dict[FrozenSet[int], FrozenSet[int]] = {}
+        for path in iter_dcm_files(folder) if paths is None else paths:
+            try:
+                stat = os.stat(path)
+                entry = known.get(path)
+                if (
+                    entry is None
+                    or entry.size != stat.st_size
+                    or entry.mtime != stat.st_mtime
+                ):
+                    entry = _scan_file(
+                        path, stat.st_size, stat.st_mtime, inventory, interned_tags
+                    )
+            except Exception as e:
+                errors.append((path, describe_error(e)))
+                continue
+            inventory.add_file_tags(entry.tags)
+            entries.append(entry)
+        return cls(folder, entries, inventory, errors)
+
+    @classmethod
+    def build_archive(
+        cls, archive_path: str, sample_per_series: Optional[int] = None
+    ) -> "ScanManifest":
+        """
+        Scan the DICOM members of a ZIP or TAR archive without extracting it.
+
+        Members are read one after another, only a single member is held in
+        memory and members larger than SPOOL_THRESHOLD are spooled to a
+        temporary file instead. The path of an entry is the archive path joined
+        with the member name. Members which are not DICOM files are recorded in
+        not_dicom.
+
+        Parameters:
+            archive_path (str): Path of the archive.
+            sample_per_series (Optional[int], optional): Number of files per
+                series whose values are added to the tag inventory. Defaults to
+                None, all files.
+
+        Returns:
+            ScanManifest: The manifest of the archive.
+        """
+        entries = []
+        errors = []
+        not_dicom = []
+        inventory = TagInventory(sample_per_series)
+        interned_tags: Dict[FrozenSet[int], FrozenSet[int]] = {}
+        members = iter_dicom_members(
+            archive_path,
+            skipped_callback=lambda name: not_dicom.append(
+                os.path.join(archive_path, name)
+            ),
+        )
+        for name, mtime, data in members:
+            path = os.path.join(archive_path, name)
+            try:
+                if isinstance(data, SpooledMember):
+                    entry = _scan_file(
+                        path, data.size, mtime, inventory, interned_tags, data.path
+                    )
+                else:
+                    source = io.BytesIO(data)
+                    entry = _scan_file(
+                        path, len(data), mtime, inventory, interned_tags, source
+                    )
+            except Exception as e:
+                errors.append((path, describe_error(e)))
+                continue
+            finally:
+                if isinstance(data, SpooledMember):
+                    data.discard()
+            inventory.add_file_tags(entry.tags)
+            entries.append(entry)
+        return cls(archive_path, entries, inventory, errors, not_dicom)
+
+    @property
+    def tags_set(self) -> Set[Tuple[str, str, str]]:
+        """Unique tags in the form (tag_flag, tag_name, value)."""
+        return self.inventory.tags_set()
+
+    @property
+    def encrypted(self) -> bool:
+        """True if any file of the folder contains encrypted tags."""
+        return any(entry.encrypted for entry in self.entries)
+
+    @property
+    def total_size(self) -> int:
+        """Total size of all files in bytes."""
+        return sum(entry.size for entry in self.entries)
+
+    def paths(self) -> List[str]:
+        """
+        Get the paths of all files in the manifest.
+
+        Returns:
+            List[str]: Paths in discovery order.
+        """
+        return [entry.path for entry in self.entries]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+        return iter(self.entries)
@@ -0,0 +1,295 @@
+import heapq
+import json
+import os
+import shutil
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from utilities.pseudonymizer import mapping_path_for, merge_mapping
+from utilities.quarantine import ERRORS_FILENAME, quarantine_path_for
+from utilities.run_index import INDEX_FILENAME, RunIndex
+from utilities.run_metrics import merge_reports, report_path_for
+from utilities.scan_manifest import ManifestEntry, ScanManifest
+
+# The shard manifest is stored next to the input folder
+SHARDS_SUFFIX = "_shards.json"
+
+# Version of the shard manifest, increased on incompatible changes
+SHARD_MANIFEST_VERSION = 1
+
+# Every shard is written to its own folder next to the output folder
+SHARD_FOLDER_SUFFIX = "_shard"
+
+# Key prefix of the files without StudyInstanceUID, grouped by their folder
+FOLDER_KEY_PREFIX = "folder:"
+
+
+def shard_manifest_path_for(folder: str) -> str:
+    """
+    Get the default path of the shard manifest of an input folder.
+
+    Parameters:
+        folder (str): Input folder.
+
+    Returns:
+        str: Path of the shard manifest next to the input folder.
+    """
+    return os.path.normpath(folder) + SHARDS_SUFFIX
+
+
+def shard_output_path(output_folder: str, index: int) -> str:
+    """
+    Get the folder a shard is written to before it is merged.
+
+    Parameters:
+        output_folder (str): Output folder of the whole run.
+        index (int): Index of the shard.
+
+    Returns:
+        str: Path of the shard folder next to the output folder.
+    """
+    return f"{os.path.normpath(output_folder)}{SHARD_FOLDER_SUFFIX}{index}"
+
+
+def _folder_key(path: str, folder: str) -> str:
+    return FOLDER_KEY_PREFIX + os.path.relpath(os.path.dirname(path), folder)
+
+
+def group_by_study(manifest: ScanManifest) -> Dict[str, List[ManifestEntry]]:
+    """
+    Group the files of a manifest by their study.
+
+    Files without StudyInstanceUID are grouped by the folder they are in, so
+    they still stay together with the files next to them.
+
+    Parameters:
+        manifest (ScanManifest): Scan of the input folder.
+
+    Returns:
+        Dict[str, List[ManifestEntry]]: Files by StudyInstanceUID, or by
+            "folder:" and the folder relative to the input folder.
+    """
+    studies: Dict[str, List[ManifestEntry]] = {}
+    for entry in manifest:
+        key = entry.study_uid or _folder_key(entry.path, manifest.folder)
+        studies.setdefault(key, []).append(entry)
+    return studies
+
+
+@dataclass
+class Shard:
+    """Studies processed together by one process or host."""
+
+    index: int
+    bytes: int = 0
+    studies: List[str] = field(default_factory=list)
+    # Paths relative to the input folder
+    files: List[str] = field(default_factory=list)
+
+
+class ShardPlan:
+    """
+    Split of the files of an input folder into shards of whole studies.
+
+    Every study is processed by a single shard, so the files of a study never
+    end up on two hosts. The plan is written to a JSON shard manifest, which
+    every host reads to process its own shard, and the outputs of all shards
+    are merged into the output folder afterwards.
+    """
+
+    def __init__(self, folder: str, shards: List[Shard]):
+        self.folder = folder
+        self.shards = shards
+
+    @classmethod
+    def plan(cls, manifest: ScanManifest, count: int) -> "ShardPlan":
+        """
+        Split the studies of a manifest into shards of about the same size.
+
+        The largest studies are assigned first, each to the shard with the
+        fewest bytes so far.
+
+        Parameters:
+            manifest (ScanManifest): Scan of the input folder.
+            count (int): Number of shards.
+
+        Returns:
+            ShardPlan: The plan, shards may be empty if there are fewer
+                studies than shards.
+        """
+        files: Dict[str, List[str]] = {}
+        sizes: Dict[str, int] = {}
+        for key, entries in group_by_study(manifest).items():
+            files[key] = [
+                os.path.relpath(entry.path, manifest.folder) for entry in entries
+            ]
+            sizes[key] = sum(entry.size for entry in entries)
+        # Files whose header can not be read go with their folder, the shard
+        # processing them quarantines them
+        for path, _ in manifest.errors:
+            key = _folder_key(path, manifest.folder)
+            files.setdefault(key, []).append(os.path.relpath(path, manifest.folder))
+            sizes.setdefault(key, 0)
+
+        shards = [Shard(index) for index in range(count)]
+        heap = [(0, index) for index in range(count)]
+        for key in sorted(files, key=lambda key: (-sizes[key], key)):
+            _, index = heapq.heappop(heap)
+            shard = shards[index]
+            shard.bytes += sizes[key]
+            shard.studies.append(key)
+            shard.files.extend(files[key])
+            heapq.heappush(heap, (shard.bytes, index))
+        return cls(manifest.folder, shards)
+
+    def paths(self, index: int, folder: Optional[str] = None) -> List[str]:
+        """
+        Get the paths of the files of a shard.
+
+        Parameters:
+            index (int): Index of the shard.
+            folder (Optional[str], optional): Input folder as seen by the
+                host processing the shard. Defaults to the planned folder.
+
+        Returns:
+            List[str]: Paths of the files.
+        """
+        folder = folder or self.folder
+        return [os.path.join(folder, path) for path in self.shards[index].files]
+
+    def write(self, path: str) -> None:
+        """
+        Write the shard manifest.
+
+        Parameters:
+            path (str): Path of the manifest, see shard_manifest_path_for.
+        """
+        with open(path, "w") as fp:
+            json.dump(
+                {
+                    "version": SHARD_MANIFEST_VERSION,
+                    "input": self.folder,
+                    "shards": [asdict(shard) for shard in self.shards],
+                },
+                fp,
+                indent=2,
+            )
+
+    @classmethod
+    def read(cls, path: str) -> "ShardPlan":
+        """
+        Read a shard manifest.
+
+        Parameters:
+            path (str): Path of the manifest.
+
+        Returns:
+            ShardPlan: The plan.
+        """
+        with open(path) as fp:
+            data = json.load(fp)
+        if data.get("version") != SHARD_MANIFEST_VERSION:
+            raise ValueError(
+                f"Unsupported shard manifest version: {data.get('version')}"
+            )
+        return cls(data["input"], [Shard(**shard) for shard in data["shards"]])
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+
+def _move_tree(source: str, target: str, skip: Tuple[str, ...] = ()) -> int:
+    """Move every file of a folder into another folder, return their number."""
+    moved = 0
+    for root, _, files in os.walk(source):
+        relative = os.path.relpath(root, source)
+        os.makedirs(os.path.join(target, relative), exist_ok=True)
+        for name in files:
+            if relative == os.curdir and name in skip:
+                continue
+            shutil.move(os.path.join(root, name), os.path.join(target, relative, name))
+            moved += 1
+    return moved
+
+
+def merge_shards(
+    plan: ShardPlan,
+    output_folder: str,
+    mapping_path: Optional[str] = None,
+    quarantine_folder: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Merge the outputs of all shards of a plan into the output folder.
+
+    The files of every shard folder are moved into the output folder and its
+    run index is merged into the index of the output folder, so a later run
+    on the whole input only processes changed files. Pseudonym mappings,
+    quarantined files and run reports which were written next to the shard
+    folders are merged into those of the input and output folder. The shard
+    folders and their side files are removed afterwards.
+
+    Parameters:
+        plan (ShardPlan): Plan the shards were processed with.
+        output_folder (str): Output folder of the whole run.
+        mapping_path (Optional[str], optional): Mapping file the shard mappings
+            are merged into. Defaults to the mapping file of the input folder.
+        quarantine_folder (Optional[str], optional): Quarantine folder the
+            shard quarantines are merged into. Defaults to the quarantine
+            folder of the input folder.
+
+    Returns:
+        Dict[str, Any]: Number of merged files and failed files, and the
+            combined report of the shards which wrote a report, or None.
+    """
+    shard_folders = [shard_output_path(output_folder, i) for i in range(len(plan))]
+    missing = [folder for folder in shard_folders if not os.path.isdir(folder)]
+    if missing:
+        raise FileNotFoundError(f"Shard output not found: {', '.join(missing)}")
+    mapping_path = mapping_path or mapping_path_for(plan.folder)
+    quarantine_folder = quarantine_folder or quarantine_path_for(plan.folder)
+
+    files = failed = 0
+    reports = []
+    with RunIndex(output_folder) as index:
+        for shard, shard_folder in zip(plan.shards, shard_folders):
+            files += _move_tree(shard_folder, output_folder, (INDEX_FILENAME,))
+            index.merge(shard_folder)
+            shutil.rmtree(shard_folder)
+
+            shard_mapping = mapping_path_for(shard_folder)
+            if os.path.exists(shard_mapping):
+                merge_mapping(mapping_path, shard_mapping)
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(shard_mapping + suffix):
+                        os.remove(shard_mapping + suffix)
+
+            shard_quarantine = quarantine_path_for(shard_folder)
+            if os.path.isdir(shard_quarantine):
+                with open(os.path.join(shard_quarantine, ERRORS_FILENAME)) as fp:
+                    errors = fp.read()
+                _move_tree(shard_quarantine, quarantine_folder, (ERRORS_FILENAME,))
+                with open(os.path.join(quarantine_folder, ERRORS_FILENAME), "a") as fp:
+                    fp.write(errors)
+                failed += errors.count("\n")
+                shutil.rmtree(shard_quarantine)
+
+            shard_report = report_path_for(shard_folder)
+            if os.path.exists(shard_report):
+                with open(shard_report) as fp:
+                    reports.append((shard, json.load(fp)))
+                os.remove(shard_report)
+
+    report = None
+    if reports:
+        report = merge_reports([shard_report for _, shard_report in reports])
+        report["shards"] = [
+            {
+                "index": shard.index,
+                "studies": len(shard.studies),
+                "bytes": shard.bytes,
+                "seconds": shard_report["seconds"],
+                "files": shard_report["counters"]["files"],
+            }
+            for shard, shard_report in reports
+        ]
+    return {"files": files, "failed": failed, "report": report}
@@ -0,0 +1,191 @@
+from collections import Counter
+from typing import Dict, FrozenSet, Hashable, Optional, Set, Tuple
+
+import pydicom
+
+from utilities.dataset_walker import (
+    SequencePath,
+    dictionary_VR,
+    iter_elements,
+    keyword_for_tag,
+)
+
+SERIES_INSTANCE_UID = 0x0020000E
+
+# Distinct values are tracked up to this many per tag, e.g. SOPInstanceUID has
+# one per file and would otherwise grow with the archive
+DISTINCT_VALUE_LIMIT = 1000
+
+# Binary and sequence values are not compared for distinct counts
+_UNCOMPARED_VRS = {"OB", "OD", "OF", "OL", "OV", "OW", "SQ", "UN", None}
+
+
+def _compares_values(VR: Optional[str]) -> bool:
+    """Check if distinct values are counted for a VR."""
+    # Ambiguous dictionary VRs such as "OB or OW" are binary
+    return VR not in _UNCOMPARED_VRS and " or " not in VR
+
+
+class TagStats:
+    """Statistics of a single tag over the scanned files."""
+
+    __slots__ = ("tag", "keyword", "VR", "first_value", "files", "paths", "_distinct")
+
+    def __init__(
+        self, tag: int, keyword: str, VR: Optional[str], first_value: Optional[str]
+    ):
+        self.tag = tag
+        self.keyword = keyword
+        self.VR = VR
+        self.first_value = first_value
+        self.files = 0
+        # Sequences the tag was found in, () for the top level
+        self.paths: Set[SequencePath] = set()
+        self._distinct: Set[Hashable] = set()
+
+    @property
+    def distinct_values(self) -> Optional[int]:
+        """Number of distinct values, None for binary and sequence values."""
+        if not _compares_values(self.VR):
+            return None
+        return len(self._distinct)
+
+    @property
+    def distinct_limit_reached(self) -> bool:
+        """True if there are at least DISTINCT_VALUE_LIMIT distinct values."""
+        return len(self._distinct) >= DISTINCT_VALUE_LIMIT
+
+    def add_value(self, value: Hashable) -> None:
+        if len(self._distinct) < DISTINCT_VALUE_LIMIT:
+            self._distinct.add(value)
+
+    def describe(self, total_files: int) -> str:
+        """
+        Describe the statistics in a single line.
+
+        Parameters:
+            total_files (int): Number of scanned files.
+
+        Returns:
+            str: Human readable statistics.
+        """
+        distinct = self.distinct_values
+        if distinct is None:
+            distinct_text = "n/a"
+        elif self.distinct_limit_reached:
+            distinct_text = f">= {distinct}"
+        else:
+            distinct_text = str(distinct)
+        description = (
+            f"VR: {self.VR or '??'}, present in {self.files} of {total_files} files, "
+            f"distinct values: {distinct_text}"
+        )
+        nested = sorted(
+            " > ".join(keyword_for_tag(tag) or str(tag) for tag in path)
+            for path in self.paths
+            if path
+        )
+        if nested:
+            locations = ["top level"] if () in self.paths else []
+            description += f", in: {', '.join(locations + nested)}"
+        return description
+
+
+class TagInventory:
+    """
+    Index of the tags found in a folder of DICOM files.
+
+    Tag presence is counted for every file from its set of tags. Values are
+    only looked at for sampled files: at most ``sample_per_series`` files of
+    every series, or every file if it is None. Values are compared in their
+    raw, still encoded form, so they are only decoded for the first value shown
+    in the tag table.
+    """
+
+    def __init__(self, sample_per_series: Optional[int] = None):
+        self.sample_per_series = sample_per_series
+        self.stats: Dict[int, TagStats] = {}
+        self.total_files = 0
+        self.sampled_files = 0
+        self._series_samples: Counter = Counter()
+
+    def wants_sample(self, ds: pydicom.Dataset) -> bool:
+        """
+        Check if the values of a dataset should be added to the inventory.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset of the next file.
+
+        Returns:
+            bool: True if the file is sampled.
+        """
+        if self.sample_per_series is None:
+            return True
+        series = ds.get(SERIES_INSTANCE_UID)
+        series_uid = series.value if series is not None else None
+        if self._series_samples[series_uid] >= self.sample_per_series:
+            return False
+        self._series_samples[series_uid] += 1
+        return True
+
+    def add_file_tags(self, tags: FrozenSet[int]) -> None:
+        """
+        Count the tags present in a file.
+
+        Parameters:
+            tags (FrozenSet[int]): Tags of the file.
+        """
+        self.total_files += 1
+        for tag in tags:
+            stats = self.stats.get(tag)
+            if stats is None:
+                stats = self.stats[tag] = self._dictionary_stats(tag)
+            stats.files += 1
+
+    def add_dataset(self, ds: pydicom.Dataset) -> None:
+        """
+        Add the values of a sampled dataset, including the values of sequences.
+
+        Parameters:
+            ds (pydicom.Dataset): Dataset to add.
+        """
+        self.sampled_files += 1
+        for path, parent, tag in iter_elements(ds):
+            # Taken before the element is decoded below
+            raw_value = parent.get_item(tag).value
+            stats = self.stats.get(tag)
+            if stats is None:
+                elem = parent[tag]
+                stats = self.stats[tag] = TagStats(
+                    tag, elem.keyword, elem.VR, str(elem.value)[:20]
+                )
+            elif stats.first_value is None:
+                elem = parent[tag]
+                stats.VR = elem.VR
+                stats.first_value = str(elem.value)[:20]
+            stats.paths.add(path)
+            if not _compares_values(stats.VR):
+                continue
+            try:
+                stats.add_value(raw_value)
+            except TypeError:
+                stats.add_value(str(raw_value))
+
+    def tags_set(self) -> Set[Tuple[str, str, str]]:
+        """
+        Get the tags in the form shown by the tag table.
+
+        Returns:
+            Set[Tuple[str, str, str]]: Set of unique tags in the form
+                (tag_flag, tag_name, value).
+        """
+        return {
+            (str(pydicom.tag.Tag(stats.tag)), stats.keyword, stats.first_value or "")
+            for stats in self.stats.values()
+            if stats.keyword
+        }
+
+    @staticmethod
+    def _dictionary_stats(tag: int) -> TagStats:
+        """Create the statistics of a tag whose value has not been seen."""
+        return TagStats(tag, keyword_for_tag(tag), dictionary_VR(tag), None)
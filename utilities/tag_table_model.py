@@ -0,0 +1,353 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from PyQt6.QtCore import (
+    QAbstractProxyModel,
+    QAbstractTableModel,
+    QEvent,
+    QModelIndex,
+    Qt,
+)
+from PyQt6.QtWidgets import (
+    QApplication,
+    QStyle,
+    QStyledItemDelegate,
+    QStyleOptionButton,
+    QStyleOptionViewItem,
+)
+
+from utilities.actions import ACTION_COLUMNS, Action
+
+HEADER_LABELS = [
+    "Tag (Flag)",
+    "Tag Name",
+    "value",
+    "Unchanged",
+    "Change",
+    "Dummy value",
+    "Delete",
+    "Encrypt",
+    "Pseudonymize",
+]
+VALUE_COLUMN = 2
+UNCHANGED_COLUMN = 3
+
+
+class TagTableModel(QAbstractTableModel):
+    """
+    Tags of the selected folder with the action chosen for each of them.
+
+    Rows are stored column-wise in plain lists and the chosen action as the
+    number of its column in a byte array, so the model stays small for many
+    thousand tags and the view only creates what is visible. Columns 3 to 8
+    hold the actions, their number is what config.ini stores for a tag.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._flags: List[str] = []
+        self._names: List[str] = []
+        self._values: List[str] = []
+        # Lower case copies of the searchable columns
+        self._search_flags: List[str] = []
+        self._search_names: List[str] = []
+        self._search_values: List[str] = []
+        self._actions = array("B")
+        self._rows_by_name: Dict[str, int] = {}
+        self._tooltip: Optional[Callable[[str], Optional[str]]] = None
+        self._batch_depth = 0
+
+    def set_tags(
+        self,
+        tags: Iterable[Tuple[str, str, str]],
+        tooltip: Optional[Callable[[str], Optional[str]]] = None,
+    ) -> None:
+        """
+        Replace the rows of the table, all tags start as "Unchanged".
+
+        Parameters:
+            tags (Iterable[Tuple[str, str, str]]): Tags in the form
+                (tag_flag, tag_name, value), shown in the given order.
+            tooltip (Optional[Callable[[str], Optional[str]]], optional): Returns
+                the tooltip of a tag name, called when it is shown.
+                Defaults to None.
+        """
+        self.beginResetModel()
+        tags = list(tags)
+        self._flags = [tag[0] for tag in tags]
+        self._names = [tag[1] for tag in tags]
+        self._values = [tag[2] for tag in tags]
+        self._search_flags = [flag.lower() for flag in self._flags]
+        self._search_names = [name.lower() for name in self._names]
+        self._search_values = [value.lower() for value in self._values]
+        self._actions = array("B", [UNCHANGED_COLUMN]) * len(tags)
+        self._rows_by_name = {name: row for row, name in enumerate(self._names)}
+        self._tooltip = tooltip
+        self.endResetModel()
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._names)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(HEADER_LABELS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if (
+            orientation == Qt.Orientation.Horizontal
+            and role == Qt.ItemDataRole.DisplayRole
+        ):
+            return HEADER_LABELS[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlag:
+        flags = Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+        if index.column() == VALUE_COLUMN:
+            flags |= Qt.ItemFlag.ItemIsEditable
+        elif index.column() in ACTION_COLUMNS:
+            flags |= Qt.ItemFlag.ItemIsUserCheckable
+        return flags
+
+    def data(self, index: QModelIndex, role=Qt.ItemDataRole.DisplayRole):
+        row, column = index.row(), index.column()
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            if column == 0:
+                return self._flags[row]
+            if column == 1:
+                return self._names[row]
+            if column == VALUE_COLUMN:
+                return self._values[row]
+        elif role == Qt.ItemDataRole.CheckStateRole and column in ACTION_COLUMNS:
+            if self._actions[row] == column:
+                return Qt.CheckState.Checked
+            return Qt.CheckState.Unchecked
+        elif role == Qt.ItemDataRole.ToolTipRole and column == 1 and self._tooltip:
+            return self._tooltip(self._names[row])
+        return None
+
+    def setData(self, index: QModelIndex, value, role=Qt.ItemDataRole.EditRole):
+        row, column = index.row(), index.column()
+        if role == Qt.ItemDataRole.EditRole and column == VALUE_COLUMN:
+            self.set_value(row, str(value))
+            return True
+        if role == Qt.ItemDataRole.CheckStateRole and column in ACTION_COLUMNS:
+            # Actions behave like radio buttons and can only be selected
+            if Qt.CheckState(value) == Qt.CheckState.Checked:
+                self.set_action_column(row, column)
+            return True
+        return False
+
+    def tag_flag(self, row: int) -> str:
+        return self._flags[row]
+
+    def tag_name(self, row: int) -> str:
+        return self._names[row]
+
+    def value(self, row: int) -> str:
+        return self._values[row]
+
+    def set_value(self, row: int, value: str) -> None:
+        self._values[row] = value
+        self._search_values[row] = value.lower()
+        self._row_changed(row, VALUE_COLUMN, VALUE_COLUMN)
+
+    def action_column(self, row: int) -> int:
+        return self._actions[row]
+
+    def action(self, row: int) -> Action:
+        return ACTION_COLUMNS[self._actions[row]]
+
+    def set_action_column(self, row: int, column: int) -> None:
+        """
+        Select the action of a row by the number of its column.
+
+        Parameters:
+            row (int): Row of the tag.
+            column (int): Column of the action, one of ACTION_COLUMNS.
+        """
+        if column not in ACTION_COLUMNS:
+            raise ValueError(f"Column {column} is not an action")
+        self._actions[row] = column
+        self._row_changed(row, min(ACTION_COLUMNS), max(ACTION_COLUMNS))
+
+    def find_row(self, tag_name: str) -> Optional[int]:
+        """Find the row of a tag name, None if the tag is not in the table."""
+        return self._rows_by_name.get(tag_name)
+
+    def matching_rows(self, tag_flag: str, tag_name: str, value: str) -> List[int]:
+        """
+        Find the rows whose columns contain the given lower case texts.
+
+        Parameters:
+            tag_flag (str): Text searched in the tag flag, empty to match all.
+            tag_name (str): Text searched in the tag name, empty to match all.
+            value (str): Text searched in the value, empty to match all.
+
+        Returns:
+            List[int]: Matching rows in ascending order.
+        """
+        rows = range(len(self._names))
+        for search, column in (
+            (tag_flag, self._search_flags),
+            (tag_name, self._search_names),
+            (value, self._search_values),
+        ):
+            if search:
+                rows = [row for row in rows if search in column[row]]
+        return list(rows)
+
+    def has_action(self, action: Action) -> bool:
+        return any(ACTION_COLUMNS[column] is action for column in set(self._actions))
+
+    def rows(self) -> List[Tuple[str, Action, str]]:
+        """
+        Get the table in the form expected by AnonymizationPlan.compile.
+
+        Returns:
+            List[Tuple[str, Action, str]]: One (tag name, action, value) entry per row.
+        """
+        return [
+            (name, ACTION_COLUMNS[column], value)
+            for name, column, value in zip(self._names, self._actions, self._values)
+        ]
+
+    @contextmanager
+    def batch_update(self) -> Iterator[None]:
+        """Change many rows and notify the views once at the end."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._names:
+                self.dataChanged.emit(
+                    self.index(0, 0),
+                    self.index(len(self._names) - 1, len(HEADER_LABELS) - 1),
+                )
+
+    def _row_changed(self, row: int, first_column: int, last_column: int) -> None:
+        if not self._batch_depth:
+            self.dataChanged.emit(
+                self.index(row, first_column), self.index(row, last_column)
+            )
+
+
+class TagFilterProxyModel(QAbstractProxyModel):
+    """
+    Show only the rows whose tag, name and value contain the search texts.
+
+    Works like a QSortFilterProxyModel without sorting, but the visible rows
+    are computed by the source model in a single pass instead of one
+    filterAcceptsRow call per row, so a keystroke in a search field costs the
+    same for a few hundred and for many thousand tags. Rows are only filtered
+    again when the search texts change.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._filters = ("", "", "")
+        self._rows: List[int] = []
+
+    def setSourceModel(self, model: TagTableModel) -> None:
+        self.beginResetModel()
+        super().setSourceModel(model)
+        model.modelReset.connect(self._refilter)
+        model.dataChanged.connect(self._source_data_changed)
+        self._rows = model.matching_rows(*self._filters)
+        self.endResetModel()
+
+    def set_filters(self, tag_flag: str, tag_name: str, value: str) -> None:
+        """
+        Set the search texts, matched case-insensitively. Empty texts match all rows.
+
+        Parameters:
+            tag_flag (str): Text searched in the tag flag.
+            tag_name (str): Text searched in the tag name.
+            value (str): Text searched in the value.
+        """
+        self._filters = (tag_flag.lower(), tag_name.lower(), value.lower())
+        self._refilter()
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(HEADER_LABELS)
+
+    def index(self, row: int, column: int, parent: QModelIndex = QModelIndex()):
+        if parent.isValid() or not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index: QModelIndex = QModelIndex()) -> QModelIndex:
+        return QModelIndex()
+
+    def mapToSource(self, proxy_index: QModelIndex) -> QModelIndex:
+        if not proxy_index.isValid():
+            return QModelIndex()
+        return self.sourceModel().index(
+            self._rows[proxy_index.row()], proxy_index.column()
+        )
+
+    def mapFromSource(self, source_index: QModelIndex) -> QModelIndex:
+        if not source_index.isValid():
+            return QModelIndex()
+        row = bisect_left(self._rows, source_index.row())
+        if row == len(self._rows) or self._rows[row] != source_index.row():
+            return QModelIndex()
+        return self.createIndex(row, source_index.column())
+
+    def _refilter(self) -> None:
+        self.beginResetModel()
+        self._rows = self.sourceModel().matching_rows(*self._filters)
+        self.endResetModel()
+
+    def _source_data_changed(self, top_left: QModelIndex, bottom_right: QModelIndex):
+        # Visible rows are sorted, so the changed source rows map to one range
+        first = bisect_left(self._rows, top_left.row())
+        last = bisect_right(self._rows, bottom_right.row()) - 1
+        if first <= last:
+            self.dataChanged.emit(
+                self.index(first, top_left.column()),
+                self.index(last, bottom_right.column()),
+            )
+
+
+class ActionDelegate(QStyledItemDelegate):
+    """Draw an action cell as a radio button and select it on click or space."""
+
+    def paint(self, painter, option, index):
+        style = option.widget.style() if option.widget else QApplication.style()
+        # Background and selection of the cell, without the check indicator
+        background = QStyleOptionViewItem(option)
+        self.initStyleOption(background, index)
+        background.features &= ~QStyleOptionViewItem.ViewItemFeature.HasCheckIndicator
+        style.drawPrimitive(
+            QStyle.PrimitiveElement.PE_PanelItemViewItem,
+            background,
+            painter,
+            option.widget,
+        )
+        button = QStyleOptionButton()
+        button.rect = option.rect
+        button.state = QStyle.StateFlag.State_Enabled
+        if index.data(Qt.ItemDataRole.CheckStateRole) == Qt.CheckState.Checked:
+            button.state |= QStyle.StateFlag.State_On
+        else:
+            button.state |= QStyle.StateFlag.State_Off
+        style.drawControl(QStyle.ControlElement.CE_RadioButton, button, painter)
+
+    def editorEvent(self, event, model, option, index):
+        if (
+            event.type() == QEvent.Type.MouseButtonRelease
+            and event.button() == Qt.MouseButton.LeftButton
+            and option.rect.contains(event.position().toPoint())
+        ) or (
+            event.type() == QEvent.Type.KeyPress
+            and event.key() in (Qt.Key.Key_Space, Qt.Key.Key_Select)
+        ):
+            return model.setData(
+                index, Qt.CheckState.Checked, Qt.ItemDataRole.CheckStateRole
+            )
+        return False